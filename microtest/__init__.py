@@ -6,8 +6,8 @@ Author: Valtteri Rajalainen
 
 import os
 import sys
-import traceback
-import types
+import contextlib
+import importlib
 
 import microtest.scanner as scanner
 import microtest.core as core
@@ -19,6 +19,11 @@ from microtest.api import *
 CONFIG_SCRIPT_ENV_VARIABLE = 'MICROTEST_ENTRYPOINT'
 DEFAULT_CONFIG_SCRIPT = 'main.py'
 
+OPTIONS = {'--collect-only', '--json'}
+
+#submodules that 'import microtest' doesn't import, loaded on first attribute access
+LAZY_SUBMODULES = ('assertion', 'collector', 'utils')
+
 
 def set_logger(obj: object):
     if core.running:
@@ -31,6 +36,68 @@ def set_module_discovery_regex(regex: str):
     scanner.test_module_regex = regex
 
 
+def ignore_paths(*patterns):
+    """
+    Never scan files or directories whose name matches
+    any of the given fnmatch patterns during test discovery.
+    """
+    scanner.ignore_patterns.extend(patterns)
+
+
+def set_gitignore_enabled(enabled: bool):
+    """
+    Enable or disable skipping the paths ignored in .gitignore files during test discovery.
+    Disabled by default.
+    """
+    scanner.use_gitignore = enabled
+
+
+def set_discovery_index_enabled(enabled: bool):
+    """
+    Enable or disable saving the test discovery results into an index file.
+    """
+    scanner.use_index = enabled
+
+
+def set_workers(count: int):
+    """
+    Execute test modules in count forked worker processes.
+    Has no effect on platforms that don't support forking.
+    """
+    if count < 1:
+        raise ValueError('Worker count must be at least 1')
+    core.workers = count
+
+
+def set_resource_workers(count: int):
+    """
+    Construct at most count independent resources at the same time on a pool of threads.
+    With a count of 1 (the default) the resources are constructed one at a time in the main thread.
+    """
+    if count < 1:
+        raise ValueError('Resource worker count must be at least 1')
+    core.resource_workers = count
+
+
+def set_capacity(token: str, count: int):
+    """
+    Allow count modules requiring the token to be executed at the same time.
+    Tokens have a capacity of one by default, which makes them named locks.
+    """
+    if count < 1:
+        raise ValueError('Capacity must be at least 1')
+    core.capacities[token] = count
+
+
+def set_assertion_rewriting(enabled: bool = True):
+    """
+    Rewrite the assert statements of the executed test modules at import time
+    to record the values of the asserted expressions as they are evaluated.
+    The rewritten modules are cached in __pycache__.
+    """
+    core.rewrite_assertions = enabled
+
+
 exec_name = 'microtest_runner'
 set_logger(DefaultLogger())
 
@@ -43,7 +110,19 @@ def run_from_commandline(args: list):
 
     The most important argument is the tested file/directory path.
     This is expected to be the last argument. If not provided os.getcwd() is used.
+
+    Options start with '--':
+
+        --collect-only  List the tests without executing the test modules.
+        --json          With --collect-only, write the list as JSON.
     """
+    options = [ arg for arg in args if arg.startswith('--') ]
+    args = [ arg for arg in args if not arg.startswith('--') ]
+    for option in options:
+        if option not in OPTIONS:
+            sys.stderr.write(f'Unknown option: {option}.\n')
+            sys.exit(1)
+
     path = cwd = os.getcwd()
     if args:
         path = args.pop(-1)
@@ -55,8 +134,12 @@ def run_from_commandline(args: list):
             path = os.path.join(cwd, path)
 
     path = os.path.abspath(path)
+    collect_only = '--collect-only' in options
     if os.path.isfile(path):
-        core.exec_modules((path,), exec_name)
+        if collect_only:
+            collect_modules((path,), as_json='--json' in options)
+        else:
+            core.exec_modules((path,), exec_name)
         sys.exit(0)
     
     config_file = os.environ.get(CONFIG_SCRIPT_ENV_VARIABLE, DEFAULT_CONFIG_SCRIPT)
@@ -64,7 +147,35 @@ def run_from_commandline(args: list):
         config_file = os.path.join(path, config_file)
     
     if os.path.exists(config_file):
-        core.run_config(config_file, exec_name)
-
-    core.exec_modules(scanner.find_tests(path), exec_name)
+        #keep stdout clean for the JSON output
+        if collect_only and '--json' in options:
+            with contextlib.redirect_stdout(sys.stderr):
+                core.run_config(config_file, exec_name)
+        else:
+            core.run_config(config_file, exec_name)
+
+    modules = scanner.discover_tests(path, only_modules=core.only_modules, excluded_modules=core.excluded_modules)
+    if collect_only:
+        collect_modules(modules, as_json='--json' in options)
+    else:
+        core.exec_modules(modules, exec_name)
     sys.exit(0)
+
+
+def collect_modules(module_paths: tuple, *, as_json: bool = False):
+    """
+    Write the statically collected tests of the modules into stdout.
+    The modules are not executed.
+    """
+    import microtest.collector as collector
+    
+    with core.exec_context:
+        module_paths = core.filter_modules(module_paths, core.only_modules, core.excluded_modules)
+        modules = (collector.collect_module(path) for path in module_paths)
+        collector.write_collected(modules, core.only_groups, core.excluded_groups, as_json=as_json)
+
+
+def __getattr__(name: str):
+    if name in LAZY_SUBMODULES:
+        return importlib.import_module(f'{__name__}.{name}')
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -5,30 +5,32 @@ Author: Valtteri Rajalainen
 """
 
 import os
-import inspect
-import traceback
 import microtest.core as core
 import functools
 
-from microtest.objects import Types
+from microtest.objects import Types, PatchedAttribute
 
 
 __all__ = [
     'test',
+    'parametrize',
     
     'setup',
     'reset',
     'cleanup',
 
     'resource',
+    'shared_resource',
     'utility',
     'on_exit',
     'call',
     'group',
+    'requires',
     
     'run',
     'raises',
     'patch',
+    'local_patch',
     
     'add_resource',
     
@@ -46,6 +48,24 @@ def test(func: Types.Function) -> core.TestObject:
     return test_obj
 
 
+def parametrize(source: Types.Any, *, ids: Types.Callable = None) -> Types.Function:
+    """
+    Register the wrapped function as a test that is executed once for every case in source.
+
+    The source can be a list, a generator or a callable returning an iterator.
+    Cases are pulled from the source one at a time during execution and released
+    after they have been executed. A tuple case is unpacked as the leading arguments
+    of the test function, any other value is passed as the first argument.
+
+    If ids is provided, it is called with each case to create the name of the case.
+    """
+    def wrapper(func: Types.Function) -> core.ParametrizedTest:
+        test_obj = core.ParametrizedTest(func, source, ids)
+        core.collect_test(test_obj)
+        return test_obj
+    return wrapper
+
+
 def setup(func: Types.Function) -> Types.Function:
     fixture = core.get_fixture()
     fixture.register_setup(func)
@@ -72,7 +92,7 @@ def raises(callable: Types.Callable, params: Types.Union[tuple, dict], exc_type:
     Params must be a tuple or a dict. If a dict object is given, they are
     passed as keyword arguments.
     """
-    if not inspect.isclass(exc_type):
+    if not isinstance(exc_type, type):
         raise TypeError('Argument exc_type was not a class.')
 
     try:
@@ -89,30 +109,79 @@ class Patch:
     """
     Dynamically replace an attributes from the given object.
     Use as a context manager.
+
+    Nested patches of the same attribute can be exited in any order,
+    the latest patch that is still active is applied.
+    If local is True, the patch is visible only in the current thread or asyncio task.
     """
+    local = False
+
     def __init__(self, obj: object, **kwargs):
         self.obj = obj
         self.patched_attrs = kwargs
         self.original_attrs = dict()
+        self.entries = list()
 
     def __enter__(self):
-        for attr, value in self.patched_attrs.items():
-            self.original_attrs[attr] = getattr(self.obj, attr)
-            setattr(self.obj, attr, value)
+        try:
+            for attr, value in self.patched_attrs.items():
+                self.original_attrs[attr] = getattr(self.obj, attr)
+                self.entries.append(PatchedAttribute.enter(self.obj, attr, value, local=self.local))
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
         return self
 
     def __exit__(self, exc_type: Types.Class, exc: Exception, tb: Types.Traceback):
-        for attr, value in self.original_attrs.items():
-            setattr(self.obj, attr, value)
+        entries, self.entries = self.entries, list()
+        for entry in reversed(entries):
+            PatchedAttribute.exit(entry)
+
+
+class LocalPatch(Patch):
+    local = True
 
 
 def patch(obj: object, **kwargs) -> Patch:
     return Patch(obj, **kwargs)
 
 
+def local_patch(obj: object, **kwargs) -> LocalPatch:
+    """
+    Like patch, but the replacements are visible only in the current thread or
+    asyncio task, and in the tasks created inside the patch. Other threads and tasks
+    see the original values, so tests running concurrently can patch the same attributes.
+
+    Class attributes are replaced with a descriptor, other attributes with a proxy
+    that forwards calls, attribute access and the common protocols to the value
+    of the current context.
+    """
+    return LocalPatch(obj, **kwargs)
+
+
 def resource(func: Types.Function):
-    obj = core.call_with_resources(func)
-    core.add_resource(func.__name__, obj)
+    """
+    Add the value returned by func as a resource named after the function.
+
+    The function can request other resources, regardless of the order they are
+    declared in. The resources are constructed after the module or the config
+    script has been executed, or when they are requested for the first time.
+    Resources that don't depend on each other are constructed concurrently.
+    """
+    core.add_resource_factory(func.__name__, func)
+
+
+def shared_resource(func: Types.Function):
+    """
+    Create a read-only resource from the bytes returned by func.
+
+    The function can return a bytes-like object or an iterable of bytes chunks.
+    The data is written once into a memory-mapped file and the resource is
+    a zero-copy memoryview of it. Other processes can attach to the same data by
+    receiving microtest.core.shared_resources[name], which can be pickled.
+    """
+    data = core.call_with_resources(func)
+    core.add_shared_resource(func.__name__, data)
 
 
 def utility(obj: object, *, name: str = None):
@@ -152,6 +221,18 @@ def group(name: str) -> Types.Function:
     return wrapper
 
 
+def requires(*tokens, group: str = None):
+    """
+    Declare named locks or capacity tokens required by the current module.
+    If group is provided, the tokens are required by every module that
+    executes tests from that group.
+
+    When running tests in parallel, modules requiring the same token
+    are never executed at the same time, unless the token's capacity allows it.
+    """
+    core.add_requirements(tokens, group=group)
+
+
 def exclude_groups(*args):
     for name in args:
         core.excluded_groups.add(name)
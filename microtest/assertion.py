@@ -1,145 +1,443 @@
 """
 Functions for resolving runtime variable values in AssertionError tracebacks.
 
+The failing assert statement is located from the source of the bottom stack frame
+and parsed into an AST. The operands of the boolean, comparison and conditional
+operators are evaluated once in the frame's namespace and their values are
+substituted into the message. The analysis of each assert statement is cached by
+(filename, lineno), so a repeated failure only costs the evaluation of the operands.
+
+Optionally the assert statements of the test modules are rewritten at import time
+with rewrite_asserts. The rewritten statements record the operand values as they
+are evaluated, so nothing needs to be evaluated again after the failure.
+
 Author: Valtteri Rajalainen
 """
 
-import re
+import ast
 import io
-import traceback
+import copy
+import builtins
+import linecache
 
 from microtest.objects import Types
 
 
-COMMA = ','
-OPERATORS = [
-    'is', 'not', 'and', 'or', 'if', 'else',
-    '==', '!=', '>', '<', '>=', '<=',
-    ]
+RECORD_FUNCTION_NAME = '__microtest_record__'
 
+#names used by the rewritten assert statements, these can't clash with valid identifiers
+REWRITE_MODULE_NAME = '@microtest_assertion'
+VALUES_NAME = '@microtest_values'
 
-def extract_data_from_bottom_tb(traceback: Types.Traceback):
+COMPARISON_OPERATORS = {
+    ast.Eq: '==', ast.NotEq: '!=',
+    ast.Lt: '<', ast.LtE: '<=',
+    ast.Gt: '>', ast.GtE: '>=',
+    ast.Is: 'is', ast.IsNot: 'is not',
+    ast.In: 'in', ast.NotIn: 'not in',
+    }
+
+BOOLEAN_OPERATORS = {
+    ast.And: 'and',
+    ast.Or: 'or',
+    }
+
+#nodes that can appear in an operand skipped due to short-circuiting for it to be evaluated for the message
+PURE_NODES = (
+    ast.Name, ast.Constant, ast.expr_context,
+    ast.Tuple, ast.List, ast.Set, ast.Dict, ast.Starred,
+    ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    ast.operator, ast.unaryop, ast.boolop, ast.cmpop,
+    ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.DictComp, ast.comprehension,
+    ast.keyword,
+    )
+
+#builtin functions that a skipped operand can call, they have no side effects on the builtin types
+PURE_BUILTINS = {
+    'abs', 'all', 'any', 'bool', 'dict', 'float', 'frozenset', 'int', 'isinstance', 'len', 'list',
+    'max', 'min', 'range', 'repr', 'reversed', 'round', 'set', 'sorted', 'str', 'sum', 'tuple', 'type',
+    }
+
+#cache of assert statement line ranges for every parsed file: { filename: [(start, end, node)] }
+assert_statements = dict()
+
+#cache of analyzed assert statements: { (filename, lineno): AssertionAnalysis | None }
+analyses = dict()
+
+
+class AssertionAnalysis:
     """
-    Find the 'root' stack frame of the traceback and return its
-    globals, locals and the original linenumber where exception was raised. 
+    Parsed form of a single assert statement.
+
+    The template is a tree of tuples describing how the message is rendered.
+    Leaves are ('value', index, source) tuples, where index is the index of the
+    recorded operand value. The code object evaluates the asserted expression
+    and records all operand values that are evaluated. Operands skipped due to
+    short-circuiting are evaluated separately with operand_codes only if they
+    can't have side effects, otherwise they are rendered as their source.
     """
-    bottom_tb = traceback
-    while bottom_tb.tb_next is not None:
-        bottom_tb = bottom_tb.tb_next
-
-    globals_ = bottom_tb.tb_frame.f_globals 
-    locals_ = bottom_tb.tb_frame.f_locals
-    return globals_, locals_, bottom_tb.tb_lineno
+    def __init__(self, lineno: int, template: tuple, code: Types.Any, operand_codes: list):
+        self.lineno = lineno
+        self.template = template
+        self.code = code
+        self.operand_codes = operand_codes
 
 
-def escape_strings(assertion: str) -> Types.Tuple[str, Types.Function]:
+class RecordOperands(ast.NodeTransformer):
+    """
+    Wrap every operand of the asserted expression into a call that records its value.
+    The original operand nodes are collected into the operands list.
+    """
+    def __init__(self):
+        self.operands = list()
+
+    def visit_BoolOp(self, node: ast.BoolOp) -> ast.AST:
+        node.values = [ self.visit(value) for value in node.values ]
+        return node
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        node.left = self.visit(node.left)
+        node.comparators = [ self.visit(value) for value in node.comparators ]
+        return node
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        if not isinstance(node.op, ast.Not):
+            return self.record(node)
+        node.operand = self.visit(node.operand)
+        return node
+
+    def visit_IfExp(self, node: ast.IfExp) -> ast.AST:
+        node.test = self.visit(node.test)
+        node.body = self.visit(node.body)
+        node.orelse = self.visit(node.orelse)
+        return node
+
+    def generic_visit(self, node: ast.AST) -> ast.AST:
+        return self.record(node)
+
+    def record(self, node: ast.AST) -> ast.AST:
+        index = ast.Constant(value=len(self.operands))
+        self.operands.append(node)
+        return ast.copy_location(self.create_record_call(index, node), node)
+
+    def create_record_call(self, index: ast.AST, node: ast.AST) -> ast.AST:
+        return ast.Call(
+            func=ast.Name(id=RECORD_FUNCTION_NAME, ctx=ast.Load()),
+            args=[index, node],
+            keywords=[],
+            )
+
+
+class RecordOperandsInto(RecordOperands):
     """
-    Escape all possible strings for correct operator splitting.
+    Record the operand values into a dict in the local variable VALUES_NAME.
+    Used when the assert statements are rewritten at import time.
+    """
+    def create_record_call(self, index: ast.AST, node: ast.AST) -> ast.AST:
+        func = ast.Attribute(
+            value=ast.Name(id=REWRITE_MODULE_NAME, ctx=ast.Load()),
+            attr='record_operand',
+            ctx=ast.Load(),
+            )
+        values = ast.Name(id=VALUES_NAME, ctx=ast.Load())
+        return ast.Call(func=func, args=[values, index, node], keywords=[])
+
 
-    Returns the line with escaped values and a function for reversing this process.
-    Note that the reverse function takes the list of splitted expressions as input.
+class RewriteAsserts(ast.NodeTransformer):
     """
-    escapes = dict()
-    escape_token = ':string:'
-    index = 0
-    
-    string_re = re.compile(r"""("[^"]*")|'[^']*'""")
-    matches = re.finditer(string_re, assertion)
-    for match in matches:
-        escapes[index] = match.group()
-        index += 1
-    line, _ = re.subn(string_re, escape_token, assertion)
+    Rewrite the assert statements of a module to record the values of
+    their operands while the asserted expression is evaluated:
+
+        assert x == f(y), message
 
-    def reverse(parts: list) -> Types.List[str]:
-        results = list()
-        index = 0
+    is transformed into
+
+        if __debug__:
+            @microtest_values = {}
+            if not (record_operand(@microtest_values, 0, x) == record_operand(@microtest_values, 1, f(y))):
+                raise create_assertion_error(@microtest_values, message)
+    """
+    def visit_Assert(self, node: ast.Assert) -> ast.AST:
+        test = RecordOperandsInto().visit(copy.deepcopy(node.test))
+        
+        args = [ ast.Name(id=VALUES_NAME, ctx=ast.Load()) ]
+        if node.msg is not None:
+            args.append(node.msg)
         
-        for part in parts:
-            for match in re.finditer(escape_token, part):
-                part = part.replace(escape_token, escapes[index], 1)
-                index += 1
-            results.append(part.strip())
-        return results
-    
-    return line, reverse
-
-
-def escape_comprehensions(assertion: str) -> Types.Tuple[str, Types.Function]:
-    """
-    Escape all possible list/dict/generator comprehension expressions
-    for correct operator splitting.
-
-    Returns the line with escaped values and a function for reversing this process.
-    Note that the reverse function takes the list of splitted expressions as input.
-    """
-    escapes = dict()
-    create_escape = lambda i: f':comp{i}:'
-    index = 0
-    comp_re = re.compile(r'\([^()]+\)|\[[^[\]]+\]|\{[^{}]+\}')
-    
-    line = assertion
-    match = re.search(comp_re, line)
-    while match:
-        escapes[index] = match.group()
-        line = line.replace(match.group(), create_escape(index), 1)
-        index += 1
-        match = re.search(comp_re, line)
-
-    def reverse(parts: list) -> Types.List[str]:
-        results = list()
-        comp_escape_re = re.compile(r':comp[0-9]+:')
-        create_index = lambda string: int(re.search(r'[0-9]+', string).group())
+        func = ast.Attribute(
+            value=ast.Name(id=REWRITE_MODULE_NAME, ctx=ast.Load()),
+            attr='create_assertion_error',
+            ctx=ast.Load(),
+            )
+        raise_ = ast.Raise(exc=ast.Call(func=func, args=args, keywords=[]), cause=None)
         
-        for part in parts:
-            escape = re.search(comp_escape_re, part)
-            while escape:
-                escape_str = escape.group()
-                index = create_index(escape_str)
-                part = part.replace(escape_str, escapes[index], 1)
-                escape = re.search(comp_escape_re, part)
-            results.append(part.strip())
-        return results
+        body = [
+            ast.Assign(targets=[ast.Name(id=VALUES_NAME, ctx=ast.Store())], value=ast.Dict(keys=[], values=[])),
+            ast.If(test=ast.UnaryOp(op=ast.Not(), operand=test), body=[raise_], orelse=[]),
+            ]
+        for statement in body:
+            ast.copy_location(statement, node)
 
-    return line, reverse
+        statement = ast.If(test=ast.Name(id='__debug__', ctx=ast.Load()), body=body, orelse=[])
+        return ast.copy_location(statement, node)
 
 
-def separate_operators_and_expressions(assertion: str) -> Types.Tuple[Types.List[str], Types.List[str]]:
+def create_template(node: ast.AST, lines: list, counter: list) -> tuple:
     """
-    Split the expressions from the assertion line.
-    Returns a tuple of two lists: (OPERATORS, expressions).
-    Experssion can be an empty string.
+    Create the rendering template for the asserted expression.
+    Operands are numbered in the same order as RecordOperands visits them.
+    """
+    if isinstance(node, ast.BoolOp):
+        op = BOOLEAN_OPERATORS[type(node.op)]
+        return ('boolop', op, [ create_template(value, lines, counter) for value in node.values ])
 
+    if isinstance(node, ast.Compare):
+        left = create_template(node.left, lines, counter)
+        comparisons = [ (COMPARISON_OPERATORS[type(op)], create_template(value, lines, counter)) for op, value in zip(node.ops, node.comparators) ]
+        return ('compare', left, comparisons)
 
-    Examples:
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return ('not', create_template(node.operand, lines, counter))
 
-        'assert x == 10' -> (['=='], ['x', '10'])
-        
-        'assert x == 10 and y < 2' -> (['==', '<'], ['x', '10', 'y', '2'])
-        
-        'assert x is not None' -> (['is', 'not'], ['x', '', 'None'])
-    
-    """
-    context = None
-    line, reverse_string_escape = escape_strings(assertion)
-    line, reverse_comp_escape = escape_comprehensions(line)
-    
-    #check if the asserion had some context attached to it
-    parts = line.split(COMMA)
-    if len(parts) == 2:
-        line, context = parts
-    
-    operator_exp = re.compile('|'.join([ f'(?<!\\w){op}(?=\\s)' for op in OPERATORS ]))
-    ops = re.findall(operator_exp, line)
-    parts = re.split(operator_exp, line)
-
-    if context:
-        #add the context to the end of the assertion
-        parts.append(context.strip())
-        ops.append(COMMA)
-
-    expressions = reverse_comp_escape(parts)
-    expressions = reverse_string_escape(expressions)
-    return ops, expressions
+    if isinstance(node, ast.IfExp):
+        test = create_template(node.test, lines, counter)
+        body = create_template(node.body, lines, counter)
+        orelse = create_template(node.orelse, lines, counter)
+        return ('ifexp', body, test, orelse)
+
+    index = counter[0]
+    counter[0] += 1
+    return ('value', index, get_source_segment(lines, node))
+
+
+def get_called_names(node: ast.AST) -> Types.Any:
+    """
+    Return the names of the builtins called by the operand, or None
+    if the operand may have side effects when it is evaluated.
+    """
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call):
+            if not isinstance(child.func, ast.Name) or child.func.id not in PURE_BUILTINS:
+                return None
+            names.add(child.func.id)
+        elif not isinstance(child, PURE_NODES):
+            return None
+    return names
+
+
+def compile_skipped_operand(node: ast.AST, filename: str) -> Types.Any:
+    """
+    Return (code, called_names) for evaluating the operand if it was skipped,
+    or None if it can't be evaluated safely.
+    """
+    names = get_called_names(node)
+    if names is None:
+        return None
+    return compile(ast.Expression(body=node), filename, 'eval'), names
+
+
+def get_source_segment(lines: list, node: ast.AST) -> str:
+    """
+    Return the source code of the node.
+    Falls back to '...' if the node has no end position information (Python 3.7).
+    """
+    end_lineno = getattr(node, 'end_lineno', None)
+    end_col_offset = getattr(node, 'end_col_offset', None)
+    if end_lineno is None or end_col_offset is None:
+        return '...'
+
+    #col offsets are in UTF-8 bytes
+    segment_lines = [ line.encode() for line in lines[node.lineno - 1:end_lineno] ]
+    if len(segment_lines) == 1:
+        return segment_lines[0][node.col_offset:end_col_offset].decode()
+
+    segment_lines[0] = segment_lines[0][node.col_offset:]
+    segment_lines[-1] = segment_lines[-1][:end_col_offset]
+    return b''.join(segment_lines).decode()
+
+
+def find_assert_statement(filename: str, lineno: int, module_globals: dict) -> Types.Any:
+    """
+    Find the assert statement on the given line of the file.
+    The assert statements of the file are parsed only once.
+    """
+    statements = assert_statements.get(filename)
+    if statements is None:
+        lines = linecache.getlines(filename, module_globals)
+        try:
+            tree = ast.parse(''.join(lines), filename)
+        except (SyntaxError, ValueError):
+            tree = ast.Module(body=[])
+
+        statements = list()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Assert):
+                end_lineno = getattr(node, 'end_lineno', None) or node.lineno
+                statements.append((node.lineno, end_lineno, node))
+        assert_statements[filename] = statements
+
+    for start, end, node in statements:
+        if start <= lineno <= end:
+            return node
+    return None
+
+
+def analyze_assertion(filename: str, lineno: int, module_globals: dict) -> Types.Any:
+    """
+    Return the cached AssertionAnalysis for the assert statement on the given line,
+    or None if no assert statement can be found.
+    """
+    key = (filename, lineno)
+    if key in analyses:
+        return analyses[key]
+
+    analysis = None
+    node = find_assert_statement(filename, lineno, module_globals)
+    if node is not None:
+        lines = linecache.getlines(filename, module_globals)
+        template = create_template(node.test, lines, [0])
+
+        transformer = RecordOperands()
+        expression = ast.Expression(body=transformer.visit(copy.deepcopy(node.test)))
+        ast.fix_missing_locations(expression)
+        code = compile(expression, filename, 'eval')
+
+        operand_codes = [ compile_skipped_operand(operand, filename) for operand in transformer.operands ]
+        analysis = AssertionAnalysis(node.lineno, template, code, operand_codes)
+
+    analyses[key] = analysis
+    return analysis
+
+
+def evaluate_operands(analysis: AssertionAnalysis, globals_: dict, locals_: dict) -> dict:
+    """
+    Evaluate the asserted expression once and return the values
+    of the operands as { index: value }.
+
+    Operands that were skipped due to short-circuiting are evaluated afterwards
+    only if they consist of names, constants, operators and calls to PURE_BUILTINS,
+    which have no side effects on the builtin types. The other skipped operands are
+    missing from the result. If the evaluation raises an exception, the operands
+    that were not evaluated before it are missing as well.
+    """
+    values = dict()
+    def record(index, value):
+        values[index] = value
+        return value
+
+    #comprehensions are evaluated in their own scope, which can't see locals_,
+    #so the locals are merged into the globals
+    namespace = dict(globals_)
+    namespace.update(locals_)
+    namespace[RECORD_FUNCTION_NAME] = record
+
+    try:
+        eval(analysis.code, namespace)
+    except Exception:
+        return values
+
+    for index, operand in enumerate(analysis.operand_codes):
+        if index in values or operand is None:
+            continue
+        code, names = operand
+        #the builtins may be shadowed by anything
+        if any(namespace.get(name, getattr(builtins, name)) is not getattr(builtins, name) for name in names):
+            continue
+        try:
+            values[index] = eval(code, namespace)
+        except Exception:
+            pass
+    return values
+
+
+def record_operand(values: dict, index: int, value: Types.Any) -> Types.Any:
+    values[index] = value
+    return value
+
+
+def create_assertion_error(values: dict, *args) -> AssertionError:
+    """
+    Create the AssertionError raised by a rewritten assert statement.
+    The recorded operand values are stored in exception.operand_values.
+    """
+    exception = AssertionError(*args)
+    exception.operand_values = values
+    return exception
+
+
+def rewrite_asserts(tree: ast.Module) -> ast.Module:
+    """
+    Rewrite all assert statements in the module to record their operand values.
+    The module is returned unmodified if it has no assert statements.
+    """
+    if not any(isinstance(node, ast.Assert) for node in ast.walk(tree)):
+        return tree
+
+    tree = RewriteAsserts().visit(tree)
+
+    #the import must come after the docstring and __future__ imports
+    position = 0
+    for statement in tree.body:
+        is_docstring = position == 0 and ast.get_docstring(tree, clean=False) is not None
+        is_future_import = isinstance(statement, ast.ImportFrom) and statement.module == '__future__'
+        if not (is_docstring or is_future_import):
+            break
+        position += 1
+
+    import_ = ast.Import(names=[ast.alias(name=__name__, asname=REWRITE_MODULE_NAME)])
+    tree.body.insert(position, import_)
+    ast.fix_missing_locations(tree)
+    return tree
+
+
+def render_template(template: tuple, values: dict, parent: str = None) -> str:
+    kind = template[0]
+    if kind == 'value':
+        _, index, source = template
+        return repr(values[index]) if index in values else source
+
+    if kind == 'boolop':
+        _, op, children = template
+        text = f' {op} '.join(render_template(child, values, kind + op) for child in children)
+        needs_parens = parent is not None and parent != kind + op
+
+    elif kind == 'compare':
+        _, left, comparisons = template
+        parts = [render_template(left, values, kind)]
+        for op, child in comparisons:
+            parts.append(op)
+            parts.append(render_template(child, values, kind))
+        text = ' '.join(parts)
+        needs_parens = parent in ('compare', 'not')
+
+    elif kind == 'not':
+        text = 'not ' + render_template(template[1], values, kind)
+        needs_parens = parent == 'compare'
+
+    else:
+        _, body, test, orelse = template
+        body = render_template(body, values, kind)
+        test = render_template(test, values, kind)
+        orelse = render_template(orelse, values, kind)
+        text = f'{body} if {test} else {orelse}'
+        needs_parens = parent is not None
+
+    return f'({text})' if needs_parens else text
+
+
+def extract_data_from_bottom_tb(traceback: Types.Traceback):
+    """
+    Find the 'root' stack frame of the traceback and return its
+    globals, locals and the original linenumber where exception was raised.
+    """
+    bottom_tb = traceback
+    while bottom_tb.tb_next is not None:
+        bottom_tb = bottom_tb.tb_next
+
+    globals_ = bottom_tb.tb_frame.f_globals
+    locals_ = bottom_tb.tb_frame.f_locals
+    return globals_, locals_, bottom_tb.tb_lineno
 
 
 def generate_generic_error_message(exception: Exception, lineno: int) -> str:
@@ -149,12 +447,12 @@ def generate_generic_error_message(exception: Exception, lineno: int) -> str:
     { exception.__class__.__name } in line { lineno }: { str(exception) }
     """
     buffer = io.StringIO()
-    
+
     buffer.write('\n')
     buffer.write(exception.__class__.__name__)
     buffer.write(' on line ')
     buffer.write(str(lineno))
-    
+
     exc_info = str(exception)
     if exc_info:
         buffer.write(':\n\n')
@@ -163,7 +461,7 @@ def generate_generic_error_message(exception: Exception, lineno: int) -> str:
     else:
         buffer.write('\n\n')
 
-    
+
     buffer.seek(0)
     message = buffer.read()
     buffer.close()
@@ -174,44 +472,35 @@ def resolve_assertion_error(exc_type: Types.Class, exception: Exception, tb: Typ
     """
     Resolve the identifier values for a given AssertionError in the error message.
     """
-    tb_lines = traceback.format_exception(exc_type, exception, tb)
-    tb_text = ''.join(tb_lines)
-
     globals_, locals_, lineno = extract_data_from_bottom_tb(tb)
 
-    #find the actual assertion line, return a generic message if not found
-    assert_exp = re.compile(r'(?<=assert )[^\n]+')
-    match = re.search(assert_exp, tb_text)
-    if match is None:
-        return generate_generic_error_message(exception, lineno)
-    assertion_line = match.group()
-    
-    ops, expressions = separate_operators_and_expressions(assertion_line)
-    
-    #evaluate the parsed expressions to their runtime values
-    #return a generic message if fails for some reason
+    bottom_tb = tb
+    while bottom_tb.tb_next is not None:
+        bottom_tb = bottom_tb.tb_next
+    filename = bottom_tb.tb_frame.f_code.co_filename
+
+    #find the actual assert statement, return a generic message if not found
     try:
-        values = [ eval(expression, globals_, locals_) if expression else ':blank:' for expression in expressions]
+        analysis = analyze_assertion(filename, lineno, globals_)
     except Exception:
+        analysis = None
+
+    if analysis is None:
         return generate_generic_error_message(exception, lineno)
-    
+
+    #rewritten assert statements record the values when they are evaluated
+    values = getattr(exception, 'operand_values', None)
+    if values is None:
+        values = evaluate_operands(analysis, globals_, locals_)
+
     buffer = io.StringIO()
-    buffer.write(f'\nAssertionError on line {lineno}:\n\n')
+    buffer.write(f'\nAssertionError on line {analysis.lineno}:\n\n')
     buffer.write('assert ')
-    while values:
-        val = values.pop(0)
-        if val != ':blank:':
-            buffer.write(repr(val))
-        
-        if ops:
-            op = ops.pop(0)
-            if op != COMMA and val != ':blank:':
-                buffer.write(' ')
-            buffer.write(op)
-            buffer.write(' ')
+    buffer.write(render_template(analysis.template, values))
+
+    if exception.args:
+        buffer.write(', ')
+        buffer.write(repr(exception.args[0]))
 
     buffer.write('\n\n')
-    buffer.seek(0)
-    resolved_assertion = buffer.read()
-    buffer.close()
-    return resolved_assertion
+    return buffer.getvalue()
@@ -0,0 +1,302 @@
+"""
+Static collection of tests without executing the test modules.
+
+The modules are parsed with ast and the functions decorated with the microtest
+API (test, parametrize, group, setup, reset, cleanup) are collected from the
+module level. Nothing in the modules is executed, so the tested application
+is never imported.
+
+Tests registered in other ways, for example by calling microtest.test inside
+a loop or a function, can't be found statically. These modules are marked as
+incomplete. The collected information is used for --collect-only and for
+skipping modules which have no tests matching the group filters.
+
+Author: Valtteri Rajalainen
+"""
+
+import ast
+import sys
+import json
+import inspect
+
+import microtest
+from microtest.objects import Types
+
+
+API_MODULES = {'microtest', 'microtest.api'}
+
+TEST_DECORATORS = {'test', 'parametrize'}
+FIXTURE_DECORATORS = {'setup', 'reset', 'cleanup'}
+REGISTERING_NAMES = TEST_DECORATORS | {'group'}
+
+#API functions which don't affect other modules when called at import time
+NO_EFFECT_NAMES = {
+    'raises',
+    'patch',
+    'local_patch',
+    'run',
+    'run_from_commandline',
+    'collect_modules',
+    }
+
+
+def get_public_functions() -> set:
+    return { name for name, value in vars(microtest).items() if not name.startswith('_') and inspect.isfunction(value) }
+
+
+#any other function in the public API, like the resources and the configuration,
+#is assumed to affect other modules when called at import time
+SIDE_EFFECT_NAMES = get_public_functions() - REGISTERING_NAMES - FIXTURE_DECORATORS - NO_EFFECT_NAMES
+
+API_NAMES = REGISTERING_NAMES | FIXTURE_DECORATORS | SIDE_EFFECT_NAMES
+
+
+class CollectedTest:
+    def __init__(self, name: str, lineno: int, group: str = None, parametrized: bool = False):
+        self.name = name
+        self.lineno = lineno
+        self.group = group
+        self.parametrized = parametrized
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'lineno': self.lineno,
+            'group': self.group,
+            'parametrized': self.parametrized,
+            }
+
+
+class CollectedModule:
+    """
+    The statically collected contents of a test module.
+
+    If complete is False, the module may register tests that can't be found statically.
+    If side_effects is True, the module uses the API in a way that affects other modules.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.tests = list()
+        self.fixtures = list()
+        self.complete = True
+        self.side_effects = False
+        self.error = None
+
+    def to_dict(self) -> dict:
+        return {
+            'path': self.path,
+            'tests': [ test.to_dict() for test in self.tests ],
+            'fixtures': self.fixtures,
+            'complete': self.complete,
+            'error': self.error,
+            }
+
+
+class APIResolver:
+    """
+    Resolve which names and attributes of a module refer to the microtest API.
+    """
+    def __init__(self, tree: ast.Module):
+        self.module_names = set()
+        self.names = dict()
+
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    if alias.asname is None:
+                        if alias.name.split('.')[0] == 'microtest':
+                            self.module_names.add('microtest')
+                    elif alias.name in API_MODULES:
+                        self.module_names.add(alias.asname)
+
+            elif isinstance(node, ast.ImportFrom) and node.module in API_MODULES and node.level == 0:
+                for alias in node.names:
+                    if alias.name == '*':
+                        self.names.update((name, name) for name in API_NAMES)
+                    elif alias.name in API_NAMES:
+                        self.names[alias.asname or alias.name] = alias.name
+
+    def resolve(self, node: ast.AST) -> Types.Any:
+        """
+        Return the name of the API function the node refers to, or None.
+        Calls are resolved by the called function.
+        """
+        if isinstance(node, ast.Call):
+            node = node.func
+
+        if isinstance(node, ast.Name):
+            return self.names.get(node.id)
+
+        if not isinstance(node, ast.Attribute) or node.attr not in API_NAMES:
+            return None
+
+        value = node.value
+        if isinstance(value, ast.Attribute) and value.attr == 'api':
+            value = value.value
+        if isinstance(value, ast.Name) and value.id in self.module_names:
+            return node.attr
+        return None
+
+
+def get_module_level_statements(statements: list) -> Types.Iterable:
+    """
+    Yield the statements executed once in the module scope,
+    including the ones inside if, try and with blocks.
+    """
+    for statement in statements:
+        yield statement
+        if isinstance(statement, ast.If):
+            yield from get_module_level_statements(statement.body)
+            yield from get_module_level_statements(statement.orelse)
+
+        elif isinstance(statement, ast.With):
+            yield from get_module_level_statements(statement.body)
+
+        elif isinstance(statement, ast.Try):
+            yield from get_module_level_statements(statement.body)
+            for handler in statement.handlers:
+                yield from get_module_level_statements(handler.body)
+            yield from get_module_level_statements(statement.orelse)
+            yield from get_module_level_statements(statement.finalbody)
+
+
+def get_group_name(decorator: ast.AST) -> Types.Any:
+    """
+    Return the group name given to the group decorator as a string literal,
+    or None if it can't be resolved statically.
+    """
+    args = decorator.args if isinstance(decorator, ast.Call) else list()
+    if len(args) != 1:
+        return None
+    try:
+        name = ast.literal_eval(args[0])
+    except ValueError:
+        return None
+    return name if isinstance(name, str) else None
+
+
+def collect_module(path: str) -> CollectedModule:
+    """
+    Parse the module and collect the tests and fixture functions defined in it.
+    """
+    module = CollectedModule(path)
+    try:
+        with open(path, 'rb') as file:
+            tree = ast.parse(file.read(), path)
+    except (OSError, SyntaxError, ValueError) as exc:
+        module.complete = False
+        module.error = f'{type(exc).__name__}: {exc}'
+        return module
+
+    resolver = APIResolver(tree)
+    handled = set()
+
+    for statement in get_module_level_statements(tree.body):
+        if not isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+
+        names = [ resolver.resolve(decorator) for decorator in statement.decorator_list ]
+        for name in names:
+            if name in FIXTURE_DECORATORS:
+                module.fixtures.append(name)
+
+        if not TEST_DECORATORS.intersection(names):
+            continue
+
+        group = None
+        for decorator, name in zip(statement.decorator_list, names):
+            handled.add(id(decorator))
+            if isinstance(decorator, ast.Call):
+                handled.add(id(decorator.func))
+            if name != 'group':
+                continue
+
+            group = get_group_name(decorator)
+            if group is None:
+                module.complete = False
+
+        module.tests.append(CollectedTest(statement.name, statement.lineno, group, 'parametrize' in names))
+
+    #any other use of the API is either dynamic registration of tests or a side effect
+    for node in ast.walk(tree):
+        if id(node) in handled or not isinstance(node, (ast.Name, ast.Attribute)):
+            continue
+
+        name = resolver.resolve(node)
+        if name in REGISTERING_NAMES:
+            module.complete = False
+        elif name in SIDE_EFFECT_NAMES:
+            module.side_effects = True
+
+    return module
+
+
+def matches_groups(group: Types.Any, only_groups: set, excluded_groups: set) -> bool:
+    if only_groups:
+        return group in only_groups
+    return group not in excluded_groups
+
+
+def filter_collected(module: CollectedModule, only_groups: set, excluded_groups: set) -> list:
+    return [ test for test in module.tests if matches_groups(test.group, only_groups, excluded_groups) ]
+
+
+def can_skip(module: CollectedModule, only_groups: set, excluded_groups: set) -> bool:
+    """
+    Check if executing the module can be skipped, because all of its tests are
+    filtered out by the group filters and executing it can't affect other modules.
+    """
+    if not module.complete or module.side_effects or not module.tests:
+        return False
+    return not filter_collected(module, only_groups, excluded_groups)
+
+
+def skip_unmatched_modules(module_paths: Types.Iterable, only_groups: set, excluded_groups: set) -> Types.Iterable:
+    """
+    Yield the modules that have tests matching the group filters.
+    """
+    for module_path in module_paths:
+        if not can_skip(collect_module(module_path), only_groups, excluded_groups):
+            yield module_path
+
+
+def write_collected(modules: Types.Iterable, only_groups: set, excluded_groups: set, *, stream: Types.Any = None, as_json: bool = False):
+    """
+    Write the collected tests that match the group filters into the stream (sys.stdout by default).
+    Modules without any matching tests are left out, unless they are incomplete.
+    """
+    stream = stream if stream is not None else sys.stdout
+    test_count = 0
+    module_count = 0
+    results = list()
+
+    for module in modules:
+        tests = filter_collected(module, only_groups, excluded_groups)
+        if not tests and module.complete:
+            continue
+
+        test_count += len(tests)
+        module_count += 1
+        if as_json:
+            info = module.to_dict()
+            info['tests'] = [ test.to_dict() for test in tests ]
+            results.append(info)
+            continue
+
+        stream.write(module.path + '\n')
+        if module.error is not None:
+            stream.write(f'    {module.error}\n')
+        elif not module.complete:
+            stream.write('    (some tests may be registered dynamically)\n')
+
+        for test in tests:
+            name = test.name + '[...]' if test.parametrized else test.name
+            group = f' ({test.group})' if test.group is not None else ''
+            stream.write(f'    {name}{group}\n')
+
+    if as_json:
+        json.dump({ 'modules': results, 'tests': test_count }, stream, indent=2)
+        stream.write('\n')
+    else:
+        stream.write(f'\nCollected {test_count} tests from {module_count} modules.\n')
+    stream.flush()
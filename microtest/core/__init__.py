@@ -5,23 +5,33 @@ Author: Valtteri Rajalainen
 """
 
 import functools
+import itertools
 import timeit
-import runpy
 import os
 import sys
 
-from microtest.objects import Module, Result, Types, ExecutionContext
+import microtest.core.loader as loader
+
+from microtest.objects import Module, Result, Types, ExecutionContext, SharedBuffer, LazyModule
 from microtest.core.utils import (
     filter_tests,
     filter_modules,
     capture_exception,
     generate_signature,
+    generate_case_id,
     check_logger_object
 )
 
 
+runpy = LazyModule('runpy')
+futures = LazyModule('concurrent.futures')
+
+
 exec_context = ExecutionContext()
 resources = dict()
+shared_resources = dict()
+#factories registered with microtest.resource that haven't been called yet
+resource_factories = dict()
 utilities = dict()
 
 logger = None
@@ -37,12 +47,26 @@ tests: int = 0
 t_start: float = None
 t_end: float = None
 
+#execution time of the latest test in seconds, loggers can read this in log_test_info
+test_time: float = None
+
 excluded_modules = set()
 only_modules = set()
 
 excluded_groups = set()
 only_groups = set()
 
+rewrite_assertions = False
+
+workers: int = 1
+
+#the number of threads used for constructing independent resources concurrently,
+#by default the resources are constructed in the main thread, as some of them
+#can only be used in the thread that created them (sqlite3 connections, signal handlers)
+resource_workers: int = 1
+capacities = dict()
+group_requirements = dict()
+
 
 class TestObject:
     def __init__(self, func: Types.Function):
@@ -61,11 +85,46 @@ class TestObject:
 
     def __call__(self, *args, **kwargs):
         error = None
+        t_test = timeit.default_timer()
         try:
             self.func(*args, **kwargs)
         except Exception as exc:
             error = exc
-        register_test_results(self, error)
+        register_test_results(self, error, timeit.default_timer() - t_test)
+
+
+class ParametrizedTest(TestObject):
+    """
+    Test object that runs the wrapped function once for every case in source.
+
+    The source can be an iterable or a callable returning an iterator.
+    Cases are pulled from the source one at a time during execution,
+    so only the currently executed case is kept in memory.
+    """
+    def __init__(self, func: Types.Function, source: Types.Any, ids: Types.Callable = None):
+        super().__init__(func)
+        self.source = source
+        self.ids = ids
+
+    def cases(self) -> Types.Iterable:
+        source = self.source() if callable(self.source) else self.source
+        for index, case in enumerate(source):
+            yield TestCase(self, case, generate_case_id(case, index, self.ids))
+
+
+class TestCase(TestObject):
+    """
+    A single case of a ParametrizedTest.
+
+    A tuple case is unpacked as the leading positional arguments of the test
+    function, any other value is passed as the first argument. The remaining
+    arguments are requested from resources normally.
+    """
+    def __init__(self, test: ParametrizedTest, case: Types.Any, case_id: str):
+        args = case if isinstance(case, tuple) else (case,)
+        super().__init__(functools.partial(test.func, *args))
+        self.group = test.group
+        self.__qualname__ = f'{test.__qualname__}[{case_id}]'
 
 
 class Fixture:
@@ -80,12 +139,13 @@ class Fixture:
         self._reset = None
         
         self.setup_done = False
-        self.tests = list()
+        self.tests = iter(list())
+        self.appended = list()
         self.error = None
 
 
     def append(self, test: TestObject):
-        self.tests.append(test)
+        self.appended.append(test)
 
 
     def register_setup(self, func: Types.Function):
@@ -110,6 +170,10 @@ class Fixture:
 
 
     def __iter__(self):
+        #the appended tests are chained once, not one chain per test
+        if self.appended:
+            self.tests = itertools.chain(self.tests, self.appended)
+            self.appended = list()
         return self
 
 
@@ -120,8 +184,9 @@ class Fixture:
         if self.error:
             raise StopIteration
 
-        if self.tests:
-            return self.wrap_test(self.tests.pop(0))
+        test = next(self.tests, None)
+        if test is not None:
+            return self.wrap_test(test)
         
         self.do_cleanup()
         raise StopIteration
@@ -214,25 +279,173 @@ def get_fixture() -> Fixture:
 def call_with_resources(func: Types.Function) -> Types.Any:
     """
     Call the given function with the resources named in
-    function arguments.
+    function arguments. The pending resource factories
+    are called first.
 
     Note that functools.wraps should be used when wrapping microtest.core.TestObjects,
     otherwise the wrapper function's signature must match with the original
     test function's signature.
     """
+    if resource_factories:
+        initialize_resources()
+    return func(**get_resources(func))
+
+
+def get_resources(func: Types.Function) -> dict:
     kwargs = dict()
     signature = generate_signature(func)
     for item in signature:
         if item not in resources.keys():
             raise NameError(f'Undefined resource "{item}"')
         kwargs[item] = resources[item]
-    return func(**kwargs)
+    return kwargs
 
 
 def add_resource(name: str, obj: object):
+    resource_factories.pop(name, None)
     resources[name] = obj
 
 
+def add_resource_factory(name: str, func: Types.Function):
+    """
+    Register func to be called with the resources it requests, its return value
+    is added as a resource. The factories are called by initialize_resources.
+    """
+    resource_factories[name] = func
+
+
+def get_resource_dependencies(factories: dict) -> dict:
+    """
+    Return the names of the pending resources each factory requests.
+
+    NameError is raised if a factory requests a resource that doesn't exist
+    and RuntimeError if the factories depend on each other in a cycle.
+    The invalid factories are removed from resource_factories.
+    """
+    dependencies = dict()
+    for name, func in list(factories.items()):
+        requested = generate_signature(func)
+        for item in requested:
+            if item not in factories and item not in resources:
+                resource_factories.pop(name, None)
+                raise NameError(f'Undefined resource "{item}" requested by resource "{name}"')
+        dependencies[name] = [ item for item in requested if item in factories ]
+
+    #depth-first search, the resources on the current path are marked as visiting
+    state = dict()
+    for root in dependencies:
+        if root in state:
+            continue
+        state[root] = 'visiting'
+        stack = [(root, iter(dependencies[root]))]
+        while stack:
+            name, items = stack[-1]
+            item = next(items, None)
+            if item is None:
+                state[name] = 'done'
+                stack.pop()
+
+            elif state.get(item) == 'visiting':
+                path = [ entry[0] for entry in stack ]
+                cycle = path[path.index(item):] + [item]
+                for member in cycle:
+                    resource_factories.pop(member, None)
+                raise RuntimeError('Resources depend on each other in a cycle: ' + ' -> '.join(cycle))
+
+            elif item not in state:
+                state[item] = 'visiting'
+                stack.append((item, iter(dependencies[item])))
+
+    return dependencies
+
+
+def initialize_resources():
+    """
+    Call the pending resource factories and add the results as resources.
+
+    The factories are called in the order of their dependencies, so a resource
+    can request other resources regardless of the order they were declared in.
+    Factories that don't depend on each other are called concurrently on a
+    pool of resource_workers threads. If a factory raises an exception, the
+    factories that have already started are waited for and the exception
+    is raised. The factories that were not called are kept pending.
+    """
+    dependencies = get_resource_dependencies(resource_factories)
+    factories = dict(resource_factories)
+    resource_factories.clear()
+
+    waiting = { name: set(items) for name, items in dependencies.items() }
+    dependents = { name: list() for name in factories }
+    for name, items in dependencies.items():
+        for item in items:
+            dependents[item].append(name)
+    ready = [ name for name, items in waiting.items() if not items ]
+
+    def build(name: str) -> object:
+        func = factories[name]
+        return func(**get_resources(func))
+
+    def complete(name: str, obj: object):
+        resources[name] = obj
+        del waiting[name]
+        for dependent in dependents[name]:
+            waiting[dependent].discard(name)
+            if not waiting[dependent]:
+                ready.append(dependent)
+
+    try:
+        if resource_workers <= 1 or len(factories) == 1:
+            while ready:
+                name = ready.pop(0)
+                try:
+                    obj = build(name)
+                except Exception:
+                    del waiting[name]
+                    raise
+                complete(name, obj)
+            return
+
+        error = None
+        running = dict()
+        with futures.ThreadPoolExecutor(max_workers=resource_workers, thread_name_prefix='microtest-resource') as executor:
+            while ready or running:
+                while ready and error is None:
+                    name = ready.pop(0)
+                    running[executor.submit(build, name)] = name
+
+                if not running:
+                    break
+                done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is None:
+                        complete(name, future.result())
+                        continue
+                    del waiting[name]
+                    if error is None:
+                        error = future.exception()
+
+        if error is not None:
+            raise error
+
+    finally:
+        for name in waiting:
+            resource_factories.setdefault(name, factories[name])
+
+
+def add_shared_resource(name: str, data: Types.Any):
+    """
+    Store data once into a memory-mapped file and add a read-only
+    memoryview of it as a resource. The SharedBuffer is available in
+    shared_resources for passing to other processes.
+    The file is removed when the execution context exits.
+    """
+    buffer = SharedBuffer.create(data)
+    shared_resources[name] = buffer
+    resources[name] = buffer.view
+    exec_context.add_cleanup_operation(buffer.cleanup)
+
+
 def add_utility(name: str, obj: object):
     utilities[name] = obj
 
@@ -242,18 +455,23 @@ def on_exit(func: Types.Function):
 
 
 @require_init
-def register_test_results(func: Types.Function, exc: Exception):
-    global failed, errors, tests
+def register_test_results(func: Types.Function, exc: Exception, duration: float = None):
     result = Result.OK
-    tests += 1
     if exc:
         result = Result.FAILED if isinstance(exc, AssertionError) else Result.ERROR
-        if result == Result.FAILED:
-            failed += 1
-        else:
-            errors += 1
+    register_result(func.__qualname__, result, exc, duration)
+
+
+def register_result(name: str, result: str, exc: Exception, duration: float = None):
+    global failed, errors, tests, test_time
+    tests += 1
+    test_time = duration
+    if result == Result.FAILED:
+        failed += 1
+    elif result == Result.ERROR:
+        errors += 1
     
-    logger.log_test_info(func.__qualname__, result, exc)
+    logger.log_test_info(name, result, exc)
 
 
 @require_init
@@ -264,29 +482,94 @@ def register_module_exec_error(module_path: str, exc_type: Types.Class, exc: Exc
 
 
 @require_init
-def exec_modules(module_paths: tuple, exec_name: str):
-    global current_module
+def exec_modules(module_paths: Types.Iterable, exec_name: str):
+    """
+    Execute the modules in the order they are received.
+    The module_paths can be a lazy iterator, every module is
+    executed as soon as it is received.
+    """
     with exec_context:
-        for module_path in filter_modules(module_paths, only_modules, excluded_modules):
-            current_module = Module(module_path)
-            logger.log_module_info(module_path)
-            
-            try:
-                runpy.run_path(module_path, init_globals=utilities, run_name=exec_name)
+        module_paths = filter_modules(module_paths, only_modules, excluded_modules)
+        if only_groups or excluded_groups:
+            import microtest.collector as collector
+            module_paths = collector.skip_unmatched_modules(module_paths, only_groups, excluded_groups)
+        
+        if workers > 1:
+            import microtest.core.parallel as parallel
+            if parallel.is_supported():
+                parallel.exec_modules(module_paths, exec_name, workers)
+                return
+        
+        for module_path in module_paths:
+            if not exec_module(module_path, exec_name):
+                break
 
-                for test in filter_tests(current_module, only_groups, excluded_groups):
-                    call_with_resources(test)
 
-            except KeyboardInterrupt:
-                break
+def exec_module(module_path: str, exec_name: str, *, before_tests: Types.Callable = None) -> bool:
+    """
+    Execute a single module and the tests collected from it.
 
-            except SystemExit:
-                break
-            
-            except Exception as exc:
-                exc_type = type(exc)
-                traceback = exc.__traceback__
-                register_module_exec_error(module_path, exc_type, exc, traceback)
+    If before_tests is provided, it is called with the Module
+    object after the module is executed and before the resources
+    declared in it are constructed and any tests are run.
+
+    Returns False if the execution was interrupted by
+    KeyboardInterrupt or SystemExit, True otherwise.
+    """
+    global current_module
+    current_module = Module(module_path)
+    logger.log_module_info(module_path)
+    
+    try:
+        loader.run_path(module_path, init_globals=utilities, run_name=exec_name, rewrite_assertions=rewrite_assertions)
+        
+        #the parallel workers acquire the locks of the module here,
+        #so the resources of the module are constructed while they are held
+        if before_tests is not None:
+            before_tests(current_module)
+        initialize_resources()
+
+        for test in filter_tests(current_module, only_groups, excluded_groups):
+            call_with_resources(test)
+
+    except KeyboardInterrupt:
+        return False
+
+    except SystemExit:
+        return False
+    
+    except Exception as exc:
+        exc_type = type(exc)
+        traceback = exc.__traceback__
+        register_module_exec_error(module_path, exc_type, exc, traceback)
+    
+    return True
+
+
+def get_requirements(module: Module) -> set:
+    """
+    Return the names of locks and capacity tokens required by the module
+    and the groups of the tests inside it that are going to be executed.
+    """
+    requirements = set(module.requires)
+    for test in module.tests:
+        if only_groups and test.group not in only_groups:
+            continue
+        if not only_groups and test.group in excluded_groups:
+            continue
+        requirements.update(group_requirements.get(test.group, set()))
+    return requirements
+
+
+def add_requirements(tokens: tuple, *, group: str = None):
+    global current_module
+    if group is not None:
+        group_requirements.setdefault(group, set()).update(tokens)
+        return
+
+    if current_module is None:
+        current_module = Module('__main__')
+    current_module.requires.update(tokens)
 
 
 def run_current_module():
@@ -297,6 +580,7 @@ def run_current_module():
     
     with exec_context:
         try:
+            initialize_resources()
             for test in filter_tests(current_module, only_groups, excluded_groups):
                 call_with_resources(test)
         
@@ -318,6 +602,8 @@ def run_config(path: str, exec_name: str):
     config_in_process = True
     try:
         runpy.run_path(path, run_name=exec_name)
+        #before the parallel workers are forked, so that they share the resources
+        initialize_resources()
 
     finally:
         config_in_process = False
@@ -0,0 +1,197 @@
+"""
+Compilation and execution of test modules with cached code objects.
+
+runpy.run_path compiles the module from source on every run, because
+scripts don't get __pycache__ entries. The modules executed by microtest
+are compiled once and the code objects are cached in __pycache__ using the
+same timestamp-based format as imported modules, keyed by the magic number,
+mtime and size of the source.
+
+If the assert statements are rewritten, the rewritten code objects are cached
+separately. This cache is keyed by the hash of the source, the Python version
+and REWRITE_VERSION, so later runs skip both parsing and rewriting of unchanged modules.
+
+Author: Valtteri Rajalainen
+"""
+
+import os
+import sys
+import types
+import struct
+import marshal
+import importlib.util
+
+from microtest.objects import Types, LazyModule
+
+
+#only needed when the cache is out of date or the asserts are rewritten
+ast = LazyModule('ast')
+tempfile = LazyModule('tempfile')
+assertion = LazyModule('microtest.assertion')
+
+
+#the name of the optimization level in the cache file name of the rewritten modules:
+#module.cpython-311.opt-microtest.pyc
+REWRITE_CACHE_TAG = 'microtest'
+
+#increment this when the output of assertion.rewrite_asserts changes
+REWRITE_VERSION = 1
+
+
+def get_cache_path(path: str, *, rewrite_assertions: bool = False) -> Types.Any:
+    """
+    Return the path of the cache file for the module,
+    or None if the interpreter does not support bytecode caching.
+    """
+    try:
+        if rewrite_assertions:
+            return importlib.util.cache_from_source(path, optimization=REWRITE_CACHE_TAG)
+        return importlib.util.cache_from_source(path)
+    except (NotImplementedError, ValueError):
+        return None
+
+
+def create_cache_header(source: bytes) -> bytes:
+    """
+    Create the header of a rewritten module's cache file.
+    The optimization level is included, because it decides
+    whether the rewritten assert statements are compiled at all.
+    """
+    info = struct.pack('<II', REWRITE_VERSION, sys.flags.optimize)
+    return importlib.util.MAGIC_NUMBER + info + importlib.util.source_hash(source)
+
+
+def create_timestamp_header(stat: os.stat_result) -> bytes:
+    """
+    Create the header of a timestamp-based .pyc file (PEP 552).
+    """
+    flags = 0
+    mtime = int(stat.st_mtime) & 0xFFFFFFFF
+    size = stat.st_size & 0xFFFFFFFF
+    return importlib.util.MAGIC_NUMBER + struct.pack('<III', flags, mtime, size)
+
+
+def read_cache(cache_path: str, header: bytes) -> Types.Any:
+    """
+    Return the cached code object, or None if the
+    cache does not exist or it is out of date.
+    """
+    try:
+        with open(cache_path, 'rb') as file:
+            data = file.read()
+    except OSError:
+        return None
+
+    if not data.startswith(header):
+        return None
+
+    try:
+        return marshal.loads(data[len(header):])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+def write_cache(cache_path: str, header: bytes, code: Types.Any):
+    """
+    Write the code object into the cache file.
+    The file is replaced atomically, so concurrent
+    readers never see a partially written file.
+    Failures are ignored, the cache is only an optimization.
+    """
+    directory = os.path.dirname(cache_path)
+    temp_path = None
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(header)
+            file.write(marshal.dumps(code))
+        os.replace(temp_path, cache_path)
+
+    except OSError:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def load_code(path: str) -> Types.Any:
+    """
+    Return the compiled code object of the module.
+    """
+    stat = os.stat(path)
+    cache_path = get_cache_path(path)
+    header = create_timestamp_header(stat)
+    if cache_path is not None:
+        code = read_cache(cache_path, header)
+        if code is not None:
+            return code
+
+    with open(path, 'rb') as file:
+        source = file.read()
+
+    code = compile(source, path, 'exec', dont_inherit=True)
+    if cache_path is not None and not sys.dont_write_bytecode:
+        write_cache(cache_path, header, code)
+    return code
+
+
+def load_rewritten_code(path: str) -> Types.Any:
+    """
+    Return the code object of the module with its assert statements rewritten.
+    """
+    with open(path, 'rb') as file:
+        source = file.read()
+
+    cache_path = get_cache_path(path, rewrite_assertions=True)
+    header = create_cache_header(source)
+    if cache_path is not None:
+        code = read_cache(cache_path, header)
+        if code is not None:
+            return code
+
+    tree = assertion.rewrite_asserts(ast.parse(source, path))
+    code = compile(tree, path, 'exec', dont_inherit=True)
+    if cache_path is not None and not sys.dont_write_bytecode:
+        write_cache(cache_path, header, code)
+    return code
+
+
+def run_path(path: str, *, init_globals: dict = None, run_name: str = None, rewrite_assertions: bool = False) -> dict:
+    """
+    Execute the module using the cached code object.
+    Works like runpy.run_path for Python source files.
+    """
+    code = load_rewritten_code(path) if rewrite_assertions else load_code(path)
+
+    module = types.ModuleType(run_name)
+    namespace = module.__dict__
+    if init_globals is not None:
+        namespace.update(init_globals)
+
+    namespace.update(
+        __name__=run_name,
+        __file__=path,
+        __cached__=None,
+        __loader__=None,
+        __package__=run_name.rpartition('.')[0],
+        __spec__=None,
+        )
+
+    sentinel = object()
+    saved_module = sys.modules.get(run_name, sentinel)
+    saved_argv = sys.argv[0] if sys.argv else None
+    sys.modules[run_name] = module
+    if sys.argv:
+        sys.argv[0] = path
+
+    try:
+        exec(code, namespace)
+
+    finally:
+        if saved_module is sentinel:
+            del sys.modules[run_name]
+        else:
+            sys.modules[run_name] = saved_module
+        if sys.argv:
+            sys.argv[0] = saved_argv
+
+    return namespace.copy()
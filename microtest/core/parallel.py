@@ -0,0 +1,305 @@
+"""
+Parallel execution of test modules in forked worker processes.
+
+The workers are forked after the config script is executed, so they share
+all resources and utilities defined during the configuration. Modules can
+declare named locks or capacity tokens with microtest.requires. A module
+is executed only when all of its tokens are available, so two conflicting
+modules never run at the same time.
+
+Author: Valtteri Rajalainen
+"""
+
+import sys
+import collections
+import traceback
+import multiprocessing as mp
+import multiprocessing.connection
+
+import microtest.core as core
+import microtest.assertion as assertion
+
+from microtest.objects import Types, RemoteException, RemoteAssertionError
+
+
+EVENT_BATCH_SIZE = 64
+
+#seconds to wait for a worker to run its cleanup operations and exit before terminating it
+WORKER_EXIT_TIMEOUT = 5.0
+
+
+def is_supported() -> bool:
+    return 'fork' in mp.get_all_start_methods()
+
+
+def create_remote_exception(exc: Exception) -> RemoteException:
+    """
+    Convert the exception into a picklable RemoteException.
+    """
+    exc_type = type(exc)
+    tb = exc.__traceback__
+    traceback_lines = traceback.format_exception(exc_type, exc, tb)
+
+    if not isinstance(exc, AssertionError):
+        return RemoteException(exc_type.__name__, str(exc), traceback_lines)
+
+    try:
+        assertion_message = assertion.resolve_assertion_error(exc_type, exc, tb)
+    except Exception:
+        assertion_message = '\n' + ''.join(traceback.format_exception_only(exc_type, exc)) + '\n'
+    return RemoteAssertionError(exc_type.__name__, str(exc), traceback_lines, assertion_message)
+
+
+class TokenPool:
+    """
+    Book-keeping for named locks and capacity tokens.
+    Every token has a capacity of one unless specified otherwise.
+    """
+    def __init__(self, capacities: dict):
+        self.capacities = capacities
+        self.in_use = collections.Counter()
+
+    def try_acquire(self, tokens: Types.Iterable) -> bool:
+        """
+        Acquire all tokens at once and return True,
+        or acquire nothing and return False.
+        """
+        for token in tokens:
+            if self.in_use[token] >= self.capacities.get(token, 1):
+                return False
+
+        for token in tokens:
+            self.in_use[token] += 1
+        return True
+
+    def release(self, tokens: Types.Iterable):
+        for token in tokens:
+            self.in_use[token] -= 1
+
+
+class RecordingLogger:
+    """
+    Logger used inside the worker processes.
+    Sends the logged events to the main process in batches.
+    """
+    def __init__(self, conn: mp.connection.Connection):
+        self.conn = conn
+        self.events = list()
+
+    def flush(self):
+        if self.events:
+            self.conn.send(('events', self.events))
+            self.events = list()
+
+    def record(self, event: tuple):
+        self.events.append(event)
+        if len(self.events) >= EVENT_BATCH_SIZE:
+            self.flush()
+
+    def log_start_info(self):
+        pass
+
+    def log_module_info(self, module_path: str):
+        self.record(('module', module_path))
+
+    def log_test_info(self, name: str, result: str, exc: Exception):
+        if exc is not None:
+            exc = create_remote_exception(exc)
+        self.record(('test', name, result, exc, core.test_time))
+
+    def log_module_exec_error(self, module_path: str, exc_type: Types.Class, exc: Exception, tb: Types.Traceback):
+        self.record(('error', module_path, create_remote_exception(exc)))
+
+    def log_results(self, tests: int, failed: int, errors: int, time: float):
+        pass
+
+    def terminate(self):
+        pass
+
+
+def run_worker(conn: mp.connection.Connection, exec_name: str):
+    """
+    Worker process main loop.
+    Receives module paths from the main process until None is received.
+    """
+    inherited_operations = list(core.exec_context.on_exit)
+    logger = core.logger = RecordingLogger(conn)
+
+    def acquire_tokens(module):
+        logger.flush()
+        conn.send(('acquire', core.get_requirements(module)))
+        conn.recv()
+
+    try:
+        module_path = conn.recv()
+        while module_path is not None:
+            keep_going = core.exec_module(module_path, exec_name, before_tests=acquire_tokens)
+            logger.flush()
+            conn.send(('done', keep_going))
+            module_path = conn.recv()
+
+    except (EOFError, KeyboardInterrupt):
+        pass
+
+    finally:
+        #only run the cleanup operations registered inside this worker
+        operations = [ func for func in core.exec_context.on_exit if func not in inherited_operations ]
+        for func in operations:
+            func(None, None, None)
+
+
+class ModuleRun:
+    def __init__(self, path: str):
+        self.path = path
+        self.events = list()
+        self.tokens = tuple()
+        self.done = False
+
+
+class Worker:
+    def __init__(self, context: Types.Any, exec_name: str):
+        self.conn, child_conn = mp.Pipe()
+        #not daemonic, so the tests can start processes of their own
+        self.process = context.Process(target=run_worker, args=(child_conn, exec_name))
+        self.process.start()
+        child_conn.close()
+        self.run = None
+
+
+def replay_events(events: list):
+    for event in events:
+        kind = event[0]
+        if kind == 'module':
+            core.logger.log_module_info(event[1])
+
+        elif kind == 'test':
+            _, name, result, exc, duration = event
+            core.register_result(name, result, exc, duration)
+
+        elif kind == 'error':
+            _, module_path, exc = event
+            core.register_module_exec_error(module_path, type(exc), exc, None)
+
+
+def exec_modules(module_paths: Types.Iterable, exec_name: str, worker_count: int):
+    """
+    Execute the modules in worker processes.
+
+    The module_paths can be a lazy iterator, the next module
+    is requested only when a worker becomes available.
+    The workers are started before the first module is requested,
+    so they are never forked while the modules are discovered.
+
+    The output of the first unfinished module is logged as it happens,
+    the output of other modules is buffered until it is their turn.
+    This keeps the output of every module together.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    context = mp.get_context('fork')
+    pool = TokenPool(core.capacities)
+    pending = iter(module_paths)
+    started = collections.deque()
+    waiting = list()
+    workers = dict()
+    processes = list()
+    stopped = False
+
+    def start_worker():
+        worker = Worker(context, exec_name)
+        workers[worker.conn] = worker
+        processes.append(worker.process)
+        return worker
+
+    def advance_output():
+        while started:
+            head = started[0]
+            replay_events(head.events)
+            head.events = list()
+            if not head.done:
+                break
+            started.popleft()
+
+    def dispatch(worker: Worker):
+        module_path = None if stopped else next(pending, None)
+        if module_path is None:
+            worker.conn.send(None)
+            worker.conn.close()
+            del workers[worker.conn]
+            return
+
+        worker.run = ModuleRun(module_path)
+        started.append(worker.run)
+        worker.conn.send(worker.run.path)
+
+    def grant_waiting():
+        for worker in list(waiting):
+            if pool.try_acquire(worker.run.tokens):
+                waiting.remove(worker)
+                worker.conn.send('granted')
+
+    def finish(worker: Worker):
+        worker.run.done = True
+        pool.release(worker.run.tokens)
+        grant_waiting()
+        advance_output()
+
+    try:
+        for _ in range(worker_count):
+            start_worker()
+
+        for worker in list(workers.values()):
+            dispatch(worker)
+
+        while workers:
+            for conn in mp.connection.wait(list(workers.keys())):
+                worker = workers[conn]
+                try:
+                    message, payload = conn.recv()
+
+                except (EOFError, OSError):
+                    info = f'Worker process exited unexpectedly with exit code {worker.process.exitcode}'
+                    exc = RemoteException('RuntimeError', info, [f'RuntimeError: {info}\n'])
+                    worker.run.events.append(('error', worker.run.path, exc))
+                    if worker in waiting:
+                        waiting.remove(worker)
+                        worker.run.tokens = tuple()
+                    finish(worker)
+
+                    conn.close()
+                    del workers[conn]
+                    worker.process.join()
+                    if not stopped:
+                        dispatch(start_worker())
+                    continue
+
+                if message == 'events':
+                    worker.run.events.extend(payload)
+                    advance_output()
+
+                elif message == 'acquire':
+                    worker.run.tokens = tuple(payload)
+                    if pool.try_acquire(worker.run.tokens):
+                        conn.send('granted')
+                    else:
+                        waiting.append(worker)
+
+                elif message == 'done':
+                    stopped = stopped or not payload
+                    finish(worker)
+                    dispatch(worker)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        #the workers that were sent None exit after running their cleanup operations
+        for worker in workers.values():
+            worker.process.terminate()
+        for process in processes:
+            process.join(WORKER_EXIT_TIMEOUT)
+            if process.exitcode is None:
+                process.terminate()
+                process.join()
+        advance_output()
@@ -6,10 +6,16 @@ Author: Valtteri Rajalainen
 
 import os
 import functools
-import inspect
 
 
-from microtest.objects import Module, Types
+from microtest.objects import Module, Types, PathMatcher, LazyModule
+
+
+inspect = LazyModule('inspect')
+
+
+MAX_CASE_ID_LENGTH = 40
+SCALAR_TYPES = (str, int, float, bool, type(None))
 
 
 def capture_exception(func: Types.Function) -> Types.Function:
@@ -53,6 +59,25 @@ def generate_signature(obj: object) -> list:
     return [ param for param in signature.parameters ]
 
 
+def generate_case_id(case: Types.Any, index: int, ids: Types.Callable = None) -> str:
+    """
+    Generate a readable id for a single case of a parametrized test.
+
+    If ids is provided, it is called with the case and its result is used.
+    Cases made of short scalar values are joined with '-',
+    otherwise the index of the case is used.
+    """
+    if ids is not None:
+        return str(ids(case))
+
+    values = case if isinstance(case, tuple) else (case,)
+    if all(isinstance(value, SCALAR_TYPES) for value in values):
+        case_id = '-'.join(str(value) for value in values)
+        if case_id and case_id.isprintable() and len(case_id) <= MAX_CASE_ID_LENGTH:
+            return case_id
+    return str(index)
+
+
 def check_logger_object(obj: object):
     logger_interface = (
         ('log_start_info', list()),
@@ -96,6 +121,9 @@ def filter_tests(module: Module, only_groups: set, excluded_groups: set) -> Type
 
     If included_group is empty, the excluded_group is checked for filters.
 
+    Parametrized tests are expanded lazily into their cases,
+    so the returned tests should be iterated only once.
+
     If the module has a fixture, the tests are passed to the fixture and
     the fixture instance is returned.
     """
@@ -106,48 +134,52 @@ def filter_tests(module: Module, only_groups: set, excluded_groups: set) -> Type
     elif excluded_groups:
         tests = list(filter(lambda test: test.group not in excluded_groups, module.tests))
 
+    tests = expand_cases(tests)
     if module.fixture:
         module.fixture.tests = tests
         return module.fixture
     return tests
 
 
-def filter_modules(modules: tuple, only_modules: set, excluded_modules: set) -> tuple:
+def expand_cases(tests: list) -> Types.Iterable:
+    """
+    Yield the given tests, replacing parametrized tests with their cases.
+    """
+    for test in tests:
+        cases = getattr(test, 'cases', None)
+        if cases is None:
+            yield test
+            continue
+        yield from cases()
+
+
+def filter_modules(modules: Types.Iterable, only_modules: set, excluded_modules: set) -> Types.Iterable:
     """
     Filter the executed modules based on inlcuded_modules and exclude_modules.
 
     These sets can contain restrictions as strings representing filepaths or parts of filepaths.
     If the restriction is an absolute filepath the paths are comapred with '=='.
     Otherwise the comaprison will be 'restriction in path' (path is an absolute filepath).
+    Restrictions containing any of the characters '*?[' are glob patterns (see objects.PathMatcher).
 
     If only_modules is not empty only those modules will be executed,
     even if exclude_modules is not empty.
     
     If exclude_modules is not empty these modules will be filtered out.
-    """
-    def path_meets_restriction(module_path: str, restriction: str) -> bool:
-        if os.path.isabs(restriction):
-            return module_path == restriction
-        return restriction in module_path
 
+    The modules are yielded lazily in the order they are received, every module at most once.
+    """
     if only_modules:
-        filtered_modules = list()
-        for restriction in only_modules:
-            for module_path in modules:
-                if path_meets_restriction(module_path, restriction):
-                    filtered_modules.append(module_path)
-        return tuple(filtered_modules)
-    
-    if not excluded_modules:
-        return modules
-    
-    filtered_modules = list(modules)
-    removed = 0
-    for index, module_path in enumerate(modules):
-        for restriction in excluded_modules:
-            if path_meets_restriction(module_path, restriction):
-                filtered_modules.pop(index - removed)
-                removed += 1
-                break
-    
-    return tuple(filtered_modules)
+        matcher = PathMatcher(only_modules)
+        keep = matcher.matches
+    else:
+        matcher = PathMatcher(excluded_modules)
+        keep = lambda module_path: not matcher.matches(module_path)
+
+    seen = set()
+    for module_path in modules:
+        if module_path in seen:
+            continue
+        seen.add(module_path)
+        if keep(module_path):
+            yield module_path
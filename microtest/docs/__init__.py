@@ -199,7 +199,8 @@ def generate_class_docs(class_, stream):
 
     class_items = vars(class_).items()
     methods = tuple((obj for _, obj in class_items if is_documented_method(obj)))
-    members = { name: value for name, value in class_items if value not in set(methods) and not name.startswith('_') }
+    #not a set, the class attributes may be unhashable (DefaultLogger.RESULT_CHARS is a dict)
+    members = { name: value for name, value in class_items if value not in methods and not name.startswith('_') }
 
     for name, value in members.items():
         generate_member_docs(name, value, stream, indent = 1)
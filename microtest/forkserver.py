@@ -0,0 +1,217 @@
+"""
+Template process used by microtest.utils.ProcessFactory.
+
+The template is a fresh Python interpreter that imports the preloaded
+modules once and then forks a child for every started process. The children
+run the entry point as if the interpreter was started with
+'python -m module args...', without paying for the interpreter startup
+and the imports again.
+
+The factory sends the requests through a socket together with the file
+descriptors the child uses as its stdin and stdout / stderr, and a pipe
+through which the template reports the exit status of the child once it has
+reaped it. The template must not start any threads, as it forks.
+
+Author: Valtteri Rajalainen
+"""
+
+import os
+import sys
+import signal
+import atexit
+import runpy
+import importlib
+import traceback
+import multiprocessing.connection as mp_connection
+import multiprocessing.reduction as reduction
+
+from microtest.objects import Types
+
+
+#executed with 'python -c', the directory of the microtest package is given as the first argument
+BOOTSTRAP = (
+    'import sys; sys.path.insert(0, sys.argv[1]); import microtest.forkserver as forkserver; '
+    'del sys.path[0]; forkserver.main(sys.argv[2:])'
+    )
+
+
+def get_exit_code(code: Types.Any) -> int:
+    """
+    Convert the SystemExit code into the exit status, like the interpreter does.
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write(f'{code}\n')
+    return 1
+
+
+def get_wait_status(status: int) -> int:
+    """
+    Convert a waitpid status into an exit code like multiprocessing.Process.exitcode,
+    negative if the process was killed by a signal.
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_entry_point(entry_point: str, args: list) -> int:
+    """
+    Run the module as __main__, or call the function given as 'module:function',
+    like the console scripts created by pip do.
+    Return the exit status.
+    """
+    module_name, _, func_name = entry_point.partition(':')
+    sys.argv = [entry_point] + list(args)
+    try:
+        if func_name:
+            func = getattr(importlib.import_module(module_name), func_name)
+            code = get_exit_code(func())
+        else:
+            runpy.run_module(module_name, run_name='__main__', alter_sys=True)
+            code = 0
+
+    except SystemExit as exc:
+        code = get_exit_code(exc.code)
+
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    try:
+        atexit._run_exitfuncs()
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+    return code
+
+
+def run_child(request: dict, stdin: int, output: int) -> int:
+    os.dup2(stdin, 0)
+    os.dup2(output, 1)
+    os.dup2(output, 2)
+    os.close(stdin)
+    os.close(output)
+
+    if request['cwd'] is not None:
+        os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+
+    #the children would otherwise produce the same random numbers
+    if 'random' in sys.modules:
+        sys.modules['random'].seed()
+    return run_entry_point(request['entry_point'], request['args'])
+
+
+class Template:
+    """
+    The template process. Forks the children and reports their exit statuses.
+    """
+    def __init__(self, conn: object):
+        self.conn = conn
+        self.children = dict()
+        self.wakeup_reader, self.wakeup_writer = os.pipe()
+        os.set_blocking(self.wakeup_writer, False)
+
+    def serve(self):
+        #the handler only wakes up the main loop through the wakeup fd
+        signal.signal(signal.SIGCHLD, lambda *args: None)
+        signal.set_wakeup_fd(self.wakeup_writer)
+        try:
+            while True:
+                ready = mp_connection.wait([self.conn, self.wakeup_reader])
+                if self.wakeup_reader in ready:
+                    os.read(self.wakeup_reader, 1024)
+                self.reap_children()
+
+                if self.conn in ready:
+                    try:
+                        request = self.conn.recv()
+                    except EOFError:
+                        return
+                    self.fork(request)
+        finally:
+            self.kill_children()
+
+    def fork(self, request: dict):
+        stdin = reduction.recv_handle(self.conn)
+        output = reduction.recv_handle(self.conn)
+        status = mp_connection.Connection(reduction.recv_handle(self.conn))
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                for conn in [self.conn, status] + list(self.children.values()):
+                    conn.close()
+                os.close(self.wakeup_reader)
+                os.close(self.wakeup_writer)
+                code = run_child(request, stdin, output)
+            finally:
+                os._exit(code)
+
+        os.close(stdin)
+        os.close(output)
+        self.children[pid] = status
+        self.conn.send(pid)
+
+    def reap_children(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            self.report_status(pid, status)
+
+    def report_status(self, pid: int, status: int):
+        conn = self.children.pop(pid, None)
+        if conn is None:
+            return
+        try:
+            conn.send(get_wait_status(status))
+        except OSError:
+            pass
+        conn.close()
+
+    def kill_children(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                return
+            self.report_status(pid, status)
+
+
+def main(args: list):
+    """
+    Import the modules given in args[1:] and start forking the requested
+    processes. args[0] is the file descriptor of the socket connected to the factory.
+    """
+    conn = mp_connection.Connection(int(args[0]))
+    try:
+        for module_name in args[1:]:
+            importlib.import_module(module_name)
+    except BaseException:
+        conn.send(('error', traceback.format_exc()))
+        return
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.send(('ready', os.getpid()))
+    Template(conn).serve()
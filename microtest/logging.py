@@ -1,5 +1,5 @@
 """
-Default logger for microtest.
+Default logger for microtest and machine-readable loggers for CI.
 ANSI coloring on Windows is done via colorama:
 
 https://github.com/tartley/colorama
@@ -11,13 +11,41 @@ Author: Valtteri Rajalainen
 import sys
 import os
 import re
-import traceback
 import io
+import timeit
+import threading
+import atexit
+import collections
 
 from typing import NewType
 
-import microtest.assertion as assertion
-from microtest.objects import Result, Output, Types
+import microtest.core as core
+from microtest.objects import Result, Output, Types, LazyModule
+
+
+#imported when needed to keep 'import microtest' fast,
+#xml.sax.saxutils alone pulls in urllib.request and http.client
+traceback = LazyModule('traceback')
+json = LazyModule('json')
+datetime = LazyModule('datetime')
+saxutils = LazyModule('xml.sax.saxutils')
+assertion = LazyModule('microtest.assertion')
+
+
+FLUSH_INTERVAL = 0.5
+WRITER_INTERVAL = 0.1
+WRITER_BATCH_SIZE = 256
+
+_thread_state = threading.local()
+
+
+def get_test_time() -> float:
+    """
+    Return the execution time of the latest test in seconds.
+    Loggers should call this in log_test_info instead of reading
+    microtest.core.test_time, so they work with AsyncLogger too.
+    """
+    return getattr(_thread_state, 'test_time', core.test_time)
 
 
 class Colors:
@@ -26,26 +54,61 @@ class Colors:
     CYAN = '\033[96m'
     RESET = '\033[0m'
 
-    if sys.platform.startswith('win'):
-        try:
-            import colorama
-            colorama.init()
-        
-        except (ModuleNotFoundError, ImportError):
-            info = '\n[ WARNING ]\n'
-            info += 'You are running on a Windows platform where ANSI colors are not natively supported.\n'
-            info += 'To enable coloring please install the colorama package: \n\n > python -m pip install colorama\n\n'
-            sys.stderr.write(info)
+    supported = None
+
+    @classmethod
+    def setup(cls) -> bool:
+        """
+        Check if ANSI colors can be used, initializing colorama on Windows.
+        Done once, when a logger first writes into a terminal.
+        If colorama is not installed, a warning is written and colors are disabled.
+        """
+        if cls.supported is not None:
+            return cls.supported
 
-            input('Press ENTER to continue... ')
-            GREEN = RED = CYAN = RESET = ''
+        cls.supported = True
+        if sys.platform.startswith('win'):
+            try:
+                import colorama
+                colorama.init()
+
+            except (ModuleNotFoundError, ImportError):
+                info = '\n[ WARNING ]\n'
+                info += 'You are running on a Windows platform where ANSI colors are not natively supported.\n'
+                info += 'To enable coloring please install the colorama package: \n\n > python -m pip install colorama\n\n'
+                sys.stderr.write(info)
+                cls.supported = False
+
+        return cls.supported
 
 
 class DefaultLogger:
+    """
+    Logger that writes human-readable output.
+
+    The output mode is one of microtest.objects.Output:
+
+      - DEFAULT: a dotted line with the result for every test
+      - VERBOSE: like DEFAULT, with the execution time of every test
+      - MINIMAL: a single character for every test, written in batches
+                 for every module, with failures listed at the end
+      - PROGRESS: a single live line with the running totals,
+                  repainted at most REFRESH_RATE times per second,
+                  with failures listed at the end
+
+    PROGRESS falls back to MINIMAL if the output is not a terminal.
+    """
     
     MAX_WIDTH = 120
     MIN_WIDTH = 60
     DEFAULT_WIDTH = 75
+    REFRESH_RATE = 10
+
+    RESULT_CHARS = {
+        Result.OK: '.',
+        Result.FAILED: 'F',
+        Result.ERROR: 'E',
+    }
 
     def __init__(self, output_mode=Output.DEFAULT, out: io.StringIO = sys.stdout):
         self.mode = output_mode
@@ -54,10 +117,19 @@ class DefaultLogger:
         self.use_colors = False
         
         if out.isatty():
-            self.use_colors = True
+            self.use_colors = Colors.setup()
             cols, _ = os.get_terminal_size()
             self.width = max(self.MIN_WIDTH, min(cols, self.MAX_WIDTH))
 
+        if self.mode == Output.PROGRESS and not self.use_colors:
+            self.mode = Output.MINIMAL
+
+        self.module_path = None
+        self.result_chars = list()
+        self.failures = list()
+        self.counts = {Result.OK: 0, Result.FAILED: 0, Result.ERROR: 0}
+        self.last_repaint = 0.0
+
 
     def write(self, text: str, *, color = None):
         if not self.use_colors or color is None:
@@ -75,10 +147,53 @@ class DefaultLogger:
 
 
     def format_traceback(self, exc_type, exc, tb):
-        tb_lines = traceback.format_exception(exc_type, exc, tb)
+        tb_lines = getattr(exc, 'traceback_lines', None)
+        if tb_lines is None:
+            tb_lines = traceback.format_exception(exc_type, exc, tb)
         return '\n' + '\n'.join(tb_lines[1:])
 
 
+    def format_failure(self, result: str, exc: Exception) -> str:
+        tb = exc.__traceback__
+        exc_type = type(exc)
+        
+        if result == Result.FAILED:
+            message = getattr(exc, 'assertion_message', None)
+            if message is None:
+                message = assertion.resolve_assertion_error(exc_type, exc, tb)
+            return message
+        
+        return '\nTraceback:\n' + self.format_traceback(exc_type, exc, tb)
+
+
+    def write_result_chars(self, *, end=False):
+        """
+        Write the collected result characters in full lines.
+        If end is True, also the last partial line is written.
+        """
+        while len(self.result_chars) >= self.width or (end and self.result_chars):
+            line = ''.join(self.result_chars[:self.width])
+            del self.result_chars[:self.width]
+            self.write(line + '\n')
+
+
+    def repaint_progress(self, *, force=False):
+        now = timeit.default_timer()
+        if not force and now - self.last_repaint < 1 / self.REFRESH_RATE:
+            return
+
+        self.last_repaint = now
+        tests = sum(self.counts.values())
+        failed = self.counts[Result.FAILED]
+        errors = self.counts[Result.ERROR]
+        line = f'Ran {tests} tests, {failed} failed, {errors} errors'
+        if self.module_path:
+            line += ' - ' + os.path.basename(self.module_path)
+        
+        self.out.write('\r' + line[:self.width - 1].ljust(self.width - 1))
+        self.out.flush()
+
+
     def log_start_info(self):
         self.write(self.format_separator('='))
         self.write('Started testing...\n')
@@ -86,35 +201,76 @@ class DefaultLogger:
 
 
     def log_test_info(self, name: str, result: str, exc: Exception):
-        padding = self.width - len(name) - len(result) - 3
+        self.counts[result] += 1
+
+        if self.mode in (Output.MINIMAL, Output.PROGRESS):
+            if exc:
+                self.failures.append((self.module_path, name, result, self.format_failure(result, exc)))
+            
+            if self.mode == Output.PROGRESS:
+                self.repaint_progress()
+                return
+            
+            self.result_chars.append(self.RESULT_CHARS[result])
+            self.write_result_chars()
+            return
+
+        if self.mode == Output.VERBOSE:
+            result_text = f'{result} ({get_test_time() or 0.0:.3f}s)'
+        else:
+            result_text = result
+        
+        padding = self.width - len(name) - len(result_text) - 3
         self.write(name)
         self.write(' ' + padding * '.' + ' ')
-        self.write(result  + '\n', color = Colors.GREEN if result == Result.OK else Colors.RED)
+        self.write(result_text  + '\n', color = Colors.GREEN if result == Result.OK else Colors.RED)
 
         if exc:
-            tb = exc.__traceback__
-            exc_type = type(exc)
-
-        if result == Result.FAILED:
-            self.write(assertion.resolve_assertion_error(exc_type, exc, tb), color = Colors.RED)
-            return
-
-        if result == Result.ERROR:
-            self.write(f'\nTraceback:\n', color=Colors.RED)
-            self.write(self.format_traceback(exc_type, exc, tb), color = Colors.RED)
-            return
+            self.write(self.format_failure(result, exc), color = Colors.RED)
 
 
     def log_module_exec_error(self, module_path: str, exc_type: Types.Class, exc: Exception, tb: Types.Traceback):
-        self.write('\nTraceback for error raised during module execution:\n', color=Colors.RED)
+        info = '\nTraceback for error raised during module execution:\n'
+        if self.mode in (Output.MINIMAL, Output.PROGRESS):
+            self.failures.append((module_path, '<module>', Result.ERROR, info + self.format_traceback(exc_type, exc, tb)))
+            return
+        
+        self.write(info, color=Colors.RED)
         self.write(self.format_traceback(exc_type, exc, tb), color=Colors.RED)
 
 
     def log_module_info(self, module_path: str):
+        if self.mode == Output.PROGRESS:
+            self.module_path = module_path
+            self.repaint_progress()
+            return
+        
+        if self.mode == Output.MINIMAL:
+            self.write_result_chars(end=True)
+            self.module_path = module_path
+        
         self.write('\n' + module_path + '\n', color = Colors.CYAN)
 
+
+    def log_failures(self):
+        for module_path, name, result, text in self.failures:
+            self.write('\n')
+            self.write(self.format_separator('-'))
+            self.write(f'{result}: {name}', color = Colors.RED)
+            self.write(f' ({module_path})\n' if module_path else '\n')
+            self.write(text, color = Colors.RED)
+        self.failures = list()
+
     
     def log_results(self, tests: int, failed: int, errors: int, time: float):
+        if self.mode == Output.PROGRESS:
+            self.repaint_progress(force=True)
+            self.write('\n')
+        
+        if self.mode == Output.MINIMAL:
+            self.write_result_chars(end=True)
+        
+        self.log_failures()
         self.write('\n')
         self.write(self.format_separator('-'))
         self.write(f'Ran {tests} tests in {time}s.\n\n')
@@ -134,3 +290,311 @@ class DefaultLogger:
     def terminate(self):
         pass
 
+
+def format_exception_text(exc: Exception) -> str:
+    """
+    Return the full traceback of exc as a string.
+    """
+    tb_lines = getattr(exc, 'traceback_lines', None)
+    if tb_lines is None:
+        tb_lines = traceback.format_exception(type(exc), exc, exc.__traceback__)
+    return ''.join(tb_lines)
+
+
+def format_assertion_text(exc: Exception) -> str:
+    """
+    Return the resolved assertion message of exc as a string.
+    """
+    message = getattr(exc, 'assertion_message', None)
+    if message is None:
+        message = assertion.resolve_assertion_error(type(exc), exc, exc.__traceback__)
+    return message.strip()
+
+
+class StreamLogger:
+    """
+    Base class for loggers that write to a file.
+
+    The out argument can be a filepath or a text stream.
+    If a filepath is given, the file is opened for writing and
+    closed when the logger is terminated.
+
+    Output is flushed at module boundaries and at most
+    FLUSH_INTERVAL seconds apart, so partial results can
+    be read even if the test run crashes.
+    """
+    def __init__(self, out: Types.Union[str, io.TextIOBase]):
+        self.close_on_exit = isinstance(out, str)
+        self.out = open(out, 'w', encoding='utf-8') if self.close_on_exit else out
+        self.last_flush = timeit.default_timer()
+        self.module_path = None
+
+
+    def write(self, text: str):
+        self.out.write(text)
+        now = timeit.default_timer()
+        if now - self.last_flush > FLUSH_INTERVAL:
+            self.flush()
+
+
+    def flush(self):
+        self.out.flush()
+        self.last_flush = timeit.default_timer()
+
+
+    def close(self):
+        self.flush()
+        if self.close_on_exit:
+            self.out.close()
+
+
+class JSONLinesLogger(StreamLogger):
+    """
+    Logger that writes every event as a single JSON object per line, as it happens.
+
+    Every object has an "event" key with one of the values:
+    "start", "module", "test", "module_error" or "results".
+    """
+
+    def write_event(self, event: str, **kwargs):
+        data = {'event': event}
+        data.update(kwargs)
+        self.write(json.dumps(data) + '\n')
+
+
+    def format_error(self, exc: Exception) -> dict:
+        error = {
+            'type': getattr(exc, 'type_name', type(exc).__name__),
+            'message': str(exc),
+            'traceback': format_exception_text(exc),
+            }
+        if isinstance(exc, AssertionError):
+            error['assertion'] = format_assertion_text(exc)
+        return error
+
+
+    def log_start_info(self):
+        self.write_event('start', timestamp=datetime.datetime.now().isoformat())
+        self.flush()
+
+
+    def log_module_info(self, module_path: str):
+        self.module_path = module_path
+        self.flush()
+        self.write_event('module', path=module_path)
+
+
+    def log_test_info(self, name: str, result: str, exc: Exception):
+        error = self.format_error(exc) if exc else None
+        self.write_event('test', module=self.module_path, name=name, result=result, time=get_test_time(), error=error)
+
+
+    def log_module_exec_error(self, module_path: str, exc_type: Types.Class, exc: Exception, tb: Types.Traceback):
+        self.write_event('module_error', path=module_path, error=self.format_error(exc))
+        self.flush()
+
+
+    def log_results(self, tests: int, failed: int, errors: int, time: float):
+        self.write_event('results', tests=tests, failed=failed, errors=errors, time=time)
+
+
+    def terminate(self):
+        self.close()
+
+
+class JUnitXMLLogger(StreamLogger):
+    """
+    Logger that writes the results in the JUnit XML format.
+
+    The document is written incrementally: every module is a testsuite
+    element and every test is written as a testcase element as soon as
+    it has been executed. The closing tags are written on terminate.
+    """
+
+    INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+    def __init__(self, out: Types.Union[str, io.TextIOBase]):
+        super().__init__(out)
+        self.suite_open = False
+
+
+    def escape(self, text: str) -> str:
+        return saxutils.escape(self.INVALID_XML_CHARS.sub('', text))
+
+
+    def quote(self, text: str) -> str:
+        return saxutils.quoteattr(self.INVALID_XML_CHARS.sub('', text))
+
+
+    def format_classname(self, module_path: str) -> str:
+        path = os.path.splitext(module_path)[0]
+        try:
+            path = os.path.relpath(path)
+        except ValueError:
+            pass
+        return path.replace(os.sep, '.').strip('.')
+
+
+    def write_testcase(self, name: str, time: float = None, error: Exception = None, tag: str = 'failure'):
+        classname = self.format_classname(self.module_path or '__main__')
+        self.write(f'    <testcase classname={self.quote(classname)} name={self.quote(name)}')
+        if time is not None:
+            self.write(f' time="{time:.6f}"')
+        
+        if error is None:
+            self.write('/>\n')
+            return
+
+        if isinstance(error, AssertionError):
+            details = format_assertion_text(error) + '\n\n' + format_exception_text(error)
+        else:
+            details = format_exception_text(error)
+        
+        error_type = getattr(error, 'type_name', type(error).__name__)
+        self.write('>\n')
+        self.write(f'      <{tag} type={self.quote(error_type)} message={self.quote(str(error))}>')
+        self.write(self.escape(details))
+        self.write(f'</{tag}>\n')
+        self.write('    </testcase>\n')
+
+
+    def close_suite(self):
+        if self.suite_open:
+            self.write('  </testsuite>\n')
+            self.suite_open = False
+
+
+    def log_start_info(self):
+        self.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        timestamp = datetime.datetime.now().isoformat(timespec='seconds')
+        self.write(f'<testsuites name="microtest" timestamp="{timestamp}">\n')
+        self.flush()
+
+
+    def log_module_info(self, module_path: str):
+        self.close_suite()
+        self.flush()
+        self.module_path = module_path
+        self.write(f'  <testsuite name={self.quote(module_path)}>\n')
+        self.suite_open = True
+
+
+    def log_test_info(self, name: str, result: str, exc: Exception):
+        tag = 'failure' if result == Result.FAILED else 'error'
+        self.write_testcase(name, get_test_time(), exc, tag)
+
+
+    def log_module_exec_error(self, module_path: str, exc_type: Types.Class, exc: Exception, tb: Types.Traceback):
+        self.write_testcase('<module>', error=exc, tag='error')
+        self.flush()
+
+
+    def log_results(self, tests: int, failed: int, errors: int, time: float):
+        self.close_suite()
+        self.write(f'  <!-- Ran {tests} tests in {time}s. ERRORS: {errors} FAILED: {failed} -->\n')
+
+
+    def terminate(self):
+        self.close_suite()
+        self.write('</testsuites>\n')
+        self.close()
+
+
+class AsyncLogger:
+    """
+    Wrapper that calls the wrapped logger on a background thread,
+    so slow output never stalls the test execution.
+
+    Events are appended to a queue and the background thread logs them
+    in batches. If the wrapped logger has an "out" attribute, each batch
+    is formatted into a buffer and written with a single write and flush.
+
+    Events with exceptions are logged synchronously after the queue is
+    drained, so assertion values are resolved before any later tests run.
+    The queue is drained on terminate and when the interpreter exits.
+    """
+
+    def __init__(self, logger: object):
+        self.logger = logger
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        
+        self.thread = threading.Thread(target=self.run_writer, daemon=True)
+        self.thread.start()
+        atexit.register(self.drain)
+
+
+    def run_writer(self):
+        while not self.stopped:
+            self.wakeup.wait(WRITER_INTERVAL)
+            self.wakeup.clear()
+            self.drain()
+
+
+    def drain(self):
+        with self.lock:
+            if not self.queue:
+                return
+            
+            out = getattr(self.logger, 'out', None)
+            buffer = io.StringIO() if out is not None else None
+            if buffer is not None:
+                self.logger.out = buffer
+            
+            try:
+                while self.queue:
+                    method_name, args, test_time = self.queue.popleft()
+                    _thread_state.test_time = test_time
+                    getattr(self.logger, method_name)(*args)
+            
+            finally:
+                _thread_state.__dict__.pop('test_time', None)
+                if buffer is not None:
+                    self.logger.out = out
+                    out.write(buffer.getvalue())
+                    out.flush()
+
+
+    def put(self, method_name: str, *args):
+        self.queue.append((method_name, args, core.test_time))
+        if len(self.queue) >= WRITER_BATCH_SIZE:
+            self.wakeup.set()
+
+
+    def call_now(self, method_name: str, *args):
+        self.drain()
+        with self.lock:
+            getattr(self.logger, method_name)(*args)
+
+
+    def log_start_info(self):
+        self.put('log_start_info')
+
+
+    def log_module_info(self, module_path: str):
+        self.put('log_module_info', module_path)
+
+
+    def log_test_info(self, name: str, result: str, exc: Exception):
+        if exc is not None:
+            self.call_now('log_test_info', name, result, exc)
+            return
+        self.put('log_test_info', name, result, exc)
+
+
+    def log_module_exec_error(self, module_path: str, exc_type: Types.Class, exc: Exception, tb: Types.Traceback):
+        self.call_now('log_module_exec_error', module_path, exc_type, exc, tb)
+
+
+    def log_results(self, tests: int, failed: int, errors: int, time: float):
+        self.put('log_results', tests, failed, errors, time)
+
+
+    def terminate(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join()
+        self.drain()
+        self.logger.terminate()
@@ -5,6 +5,39 @@ Author: Valtteri Rajalainen
 """
 
 import typing
+import os
+import re
+import types
+import threading
+import importlib
+import contextvars
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is imported when
+    one of its attributes is accessed for the first time.
+
+    Used for modules that are costly to import and only needed
+    in some code paths, to keep 'import microtest' fast:
+
+        saxutils = LazyModule('xml.sax.saxutils')
+        saxutils.escape(text)  #xml.sax.saxutils is imported here
+    """
+    def __getattr__(self, attr: str):
+        module = self.__dict__.get('_module')
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_module'] = module
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return f'<lazy module {self.__name__!r}>'
+
+
+mmap = LazyModule('mmap')
+tempfile = LazyModule('tempfile')
+
 
 
 class Types:
@@ -24,6 +57,7 @@ class Output:
     MINIMAL = 'minimal'
     VERBOSE = 'verbose'
     DEFAULT = 'default'
+    PROGRESS = 'progress'
 
 
 class Result:
@@ -37,6 +71,255 @@ class Module:
         self.path = path
         self.tests = list()
         self.fixture = None
+        self.requires = set()
+
+
+class PathMatcher:
+    """
+    Match filepaths against a set of module restrictions
+    (see microtest.exclude_modules and microtest.only_modules).
+
+    Absolute restrictions must be equal to the path, relative restrictions
+    must be contained in the path. Restrictions containing any of the
+    characters '*?[' are glob patterns, where '*' matches anything except
+    a path separator and '**' matches anything.
+
+    All restrictions are compiled once: the absolute paths into a set and
+    the rest into a single regex. The relative restrictions without any
+    glob characters are merged into a prefix tree, so the regex doesn't
+    need to try every restriction separately at every position of the path.
+    """
+
+    GLOB_CHARACTERS = '*?['
+
+    def __init__(self, restrictions: Types.Iterable):
+        self.paths = set()
+        self.parents = set()
+        self.has_relative = False
+        self.has_absolute_patterns = False
+
+        substrings = list()
+        patterns = list()
+        relative_patterns = list()
+        for restriction in restrictions:
+            is_pattern = any(char in restriction for char in self.GLOB_CHARACTERS)
+            if os.path.isabs(restriction):
+                if is_pattern:
+                    patterns.append(r'\A' + self.translate_glob(restriction) + r'\Z')
+                    self.has_absolute_patterns = True
+                else:
+                    self.paths.add(restriction)
+                    self.parents.update(self.list_parents(restriction))
+                continue
+
+            self.has_relative = True
+            if is_pattern:
+                relative_patterns.append(self.translate_glob(restriction))
+            else:
+                substrings.append(restriction)
+
+        relative_patterns.append(self.compile_substrings(substrings))
+        self.relative_regex = re.compile('|'.join(pattern for pattern in relative_patterns if pattern) or '(?!)')
+        self.regex = re.compile('|'.join(pattern for pattern in patterns + relative_patterns if pattern) or '(?!)')
+
+    @staticmethod
+    def list_parents(path: str) -> list:
+        parents = list()
+        parent = os.path.dirname(path)
+        while parent != path:
+            parents.append(parent)
+            path, parent = parent, os.path.dirname(parent)
+        return parents
+
+    @staticmethod
+    def translate_glob(pattern: str) -> str:
+        separator = re.escape(os.sep)
+        parts = list()
+        i = 0
+        while i < len(pattern):
+            char = pattern[i]
+            if pattern.startswith('**', i):
+                parts.append('.*')
+                i += 2
+                continue
+
+            if char == '*':
+                parts.append(f'[^{separator}]*')
+            elif char == '?':
+                parts.append(f'[^{separator}]')
+            elif char == '[' and ']' in pattern[i + 1:]:
+                end = pattern.index(']', i + 1)
+                content = pattern[i + 1:end]
+                if content.startswith('!'):
+                    content = '^' + content[1:]
+                parts.append(f'[{content}]')
+                i = end
+            else:
+                parts.append(re.escape(char))
+            i += 1
+
+        return ''.join(parts)
+
+    @staticmethod
+    def compile_substrings(substrings: list) -> str:
+        """
+        Build a regex matching any of the substrings from their prefix tree.
+        """
+        END = ''
+        tree = dict()
+        for substring in substrings:
+            node = tree
+            for char in substring:
+                node = node.setdefault(char, dict())
+            node[END] = True
+
+        if not tree:
+            return ''
+        if END in tree:
+            #the empty substring is contained in every path
+            return '(?:)'
+
+        #built bottom-up without recursion, the depth of the tree is the length of the longest substring
+        built = dict()
+        stack = [(tree, False)]
+        while stack:
+            node, children_built = stack.pop()
+            if END in node:
+                #a shorter substring already matched, longer ones are redundant
+                built[id(node)] = ''
+                continue
+
+            if not children_built:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.values())
+                continue
+
+            branches = [ re.escape(char) + built[id(child)] for char, child in sorted(node.items()) ]
+            built[id(node)] = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+        return built[id(tree)]
+
+    def matches(self, path: str) -> bool:
+        return path in self.paths or self.regex.search(path) is not None
+
+    def matches_part(self, path: str) -> bool:
+        """
+        Check if any of the relative restrictions is contained in the path.
+        If so, they are also contained in every path below it.
+        """
+        return self.relative_regex.search(path) is not None
+
+    def can_match_below(self, dir_path: str) -> bool:
+        """
+        Check if any path inside the directory can match the restrictions.
+        """
+        return self.has_relative or self.has_absolute_patterns or dir_path in self.parents
+
+
+class RemoteException(Exception):
+    """
+    Picklable stand-in for an exception raised in another process.
+
+    Traceback objects can't be pickled, so the traceback is formatted in the
+    original process and stored as traceback_lines. For AssertionErrors the
+    resolved assertion message is stored as assertion_message.
+    """
+    def __init__(self, type_name: str, message: str, traceback_lines: list, assertion_message: str = None):
+        super().__init__(message)
+        self.type_name = type_name
+        self.traceback_lines = traceback_lines
+        self.assertion_message = assertion_message
+
+    def __reduce__(self):
+        args = (self.type_name, str(self), self.traceback_lines, self.assertion_message)
+        return (type(self), args)
+
+
+class RemoteAssertionError(RemoteException, AssertionError):
+    pass
+
+
+class SharedBuffer:
+    """
+    Read-only binary data stored in a memory-mapped file.
+
+    The data is written once by the creating process. Instances can be
+    pickled and sent to other processes, which map the same file instead
+    of copying the data. Only the creating process removes the file.
+    """
+
+    SHARED_MEMORY_DIR = '/dev/shm'
+
+    def __init__(self, path: str, size: int, *, owner=False):
+        self.path = path
+        self.size = size
+        self.owner = owner
+        self._mmap = None
+        self._view = None
+
+    @classmethod
+    def create(cls, data: Types.Union[bytes, Types.Iterable]) -> 'SharedBuffer':
+        """
+        Write data into a new memory-mapped file.
+        Data can be a bytes-like object or an iterable of bytes-like chunks.
+        """
+        directory = cls.SHARED_MEMORY_DIR if os.path.isdir(cls.SHARED_MEMORY_DIR) else None
+        fd, path = tempfile.mkstemp(prefix='microtest-', dir=directory)
+        chunks = (data,) if isinstance(data, (bytes, bytearray, memoryview)) else data
+        size = 0
+        try:
+            with open(fd, 'wb') as file:
+                for chunk in chunks:
+                    size += file.write(chunk)
+        except BaseException:
+            #the data source failed or the memory ran out
+            os.unlink(path)
+            raise
+        return cls(path, size, owner=True)
+
+    @property
+    def view(self) -> memoryview:
+        """
+        A read-only memoryview of the data.
+        The file is mapped into memory on first access.
+        """
+        if self._view is None:
+            if self.size == 0:
+                self._view = memoryview(bytes())
+                return self._view
+            
+            with open(self.path, 'rb') as file:
+                self._mmap = mmap.mmap(file.fileno(), self.size, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        return self._view
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                #some views of the data are still alive, the map is closed when they are released
+                pass
+            self._mmap = None
+
+    def cleanup(self, *args):
+        self.close()
+        if self.owner:
+            self.owner = False
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __getstate__(self):
+        return {'path': self.path, 'size': self.size}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state['path'], state['size'])
 
 
 class ExecutionContext:
@@ -56,3 +339,201 @@ class ExecutionContext:
         if self.on_exit:
             for func in self.on_exit:
                 func(exc_type, exc, tb)
+
+
+class PatchedAttribute:
+    """
+    The active patches of an attribute of an object.
+
+    The patches are kept in the order they were entered and the latest
+    active one is applied, so the patches can be exited in any order.
+
+    Global patches are set on the object. Local patches are kept in a context
+    variable, so they are visible only in the thread or asyncio task that
+    entered them (and in the tasks created by it). While there are local
+    patches, the attribute is replaced with a dispatcher that looks up the value
+    from the current context: a descriptor for classes and a ContextProxy for
+    other objects.
+    """
+    lock = threading.RLock()
+    active = dict()
+
+    def __init__(self, obj: object, attr: str):
+        self.obj = obj
+        self.attr = attr
+        self.is_class = isinstance(obj, type)
+        self.own = True
+        if self.is_class:
+            #the raw value, so that the methods are bound like they would be without the patch
+            owners = [ cls for cls in obj.__mro__ if attr in vars(cls) ]
+            if not owners:
+                raise AttributeError(f'{obj.__name__!r} has no attribute {attr!r}')
+            self.original = vars(owners[0])[attr]
+            self.own = owners[0] is obj
+        else:
+            self.original = getattr(obj, attr)
+
+        #replaced instead of modified, so that it can be read without the lock
+        self.global_patches = tuple()
+        self.local_patches = contextvars.ContextVar(f'microtest.patch.{attr}', default=tuple())
+        self.local_count = 0
+
+    @classmethod
+    def enter(cls, obj: object, attr: str, value: Types.Any, *, local: bool = False) -> 'PatchEntry':
+        with cls.lock:
+            key = (id(obj), attr)
+            patched = cls.active.get(key)
+            if patched is None:
+                patched = cls(obj, attr)
+                cls.active[key] = patched
+
+            entry = PatchEntry(patched, value, local)
+            if local:
+                patched.local_patches.set(patched.local_patches.get() + (entry,))
+                patched.local_count += 1
+            else:
+                patched.global_patches += (entry,)
+            patched.apply()
+            return entry
+
+    @classmethod
+    def exit(cls, entry: 'PatchEntry'):
+        with cls.lock:
+            patched = entry.patched
+            if entry.local:
+                patches = patched.local_patches.get()
+                if entry not in patches:
+                    raise RuntimeError('A local patch must be exited in the same thread or task it was entered in.')
+                patched.local_patches.set(tuple(patch for patch in patches if patch is not entry))
+                patched.local_count -= 1
+            else:
+                patched.global_patches = tuple(patch for patch in patched.global_patches if patch is not entry)
+
+            patched.apply()
+            if not patched.global_patches and not patched.local_count:
+                del cls.active[(id(patched.obj), patched.attr)]
+
+    @property
+    def base_value(self) -> Types.Any:
+        patches = self.global_patches
+        if patches:
+            return patches[-1].value
+        return self.original
+
+    def get_value(self) -> Types.Any:
+        """
+        Return the value of the attribute in the current context.
+        """
+        patches = self.local_patches.get()
+        if patches:
+            return patches[-1].value
+        return self.base_value
+
+    def apply(self):
+        if self.local_count:
+            if self.is_class:
+                value = ContextDescriptor(self)
+            else:
+                value = ContextProxy(self)
+        elif self.global_patches or self.own:
+            value = self.base_value
+        else:
+            delattr(self.obj, self.attr)
+            return
+        setattr(self.obj, self.attr, value)
+
+
+class PatchEntry:
+    def __init__(self, patched: PatchedAttribute, value: Types.Any, local: bool):
+        self.patched = patched
+        self.value = value
+        self.local = local
+
+
+class ContextDescriptor:
+    """
+    Class attribute that binds the value of the patched attribute in the current context.
+    """
+    def __init__(self, patched: PatchedAttribute):
+        self.patched = patched
+
+    def __get__(self, instance: object, owner: type = None) -> Types.Any:
+        value = self.patched.get_value()
+        if hasattr(type(value), '__get__'):
+            return value.__get__(instance, owner)
+        return value
+
+
+def _get_value(proxy: 'ContextProxy') -> Types.Any:
+    return object.__getattribute__(proxy, '_patched').get_value()
+
+
+class ContextProxy:
+    """
+    Stands in for the value of the patched attribute in the current context.
+    Forwards calls, attribute access and the common protocols to the value.
+    """
+    __slots__ = ('_patched',)
+
+    def __init__(self, patched: PatchedAttribute):
+        object.__setattr__(self, '_patched', patched)
+
+    def __getattribute__(self, attr: str) -> Types.Any:
+        return getattr(_get_value(self), attr)
+
+    def __setattr__(self, attr: str, value: Types.Any):
+        setattr(_get_value(self), attr, value)
+
+    def __delattr__(self, attr: str):
+        delattr(_get_value(self), attr)
+
+    def __call__(self, *args, **kwargs):
+        return _get_value(self)(*args, **kwargs)
+
+    def __repr__(self):
+        return repr(_get_value(self))
+
+    def __str__(self):
+        return str(_get_value(self))
+
+    def __bool__(self):
+        return bool(_get_value(self))
+
+    def __len__(self):
+        return len(_get_value(self))
+
+    def __iter__(self):
+        return iter(_get_value(self))
+
+    def __hash__(self):
+        return hash(_get_value(self))
+
+    def __contains__(self, item: Types.Any):
+        return item in _get_value(self)
+
+    def __getitem__(self, key: Types.Any):
+        return _get_value(self)[key]
+
+    def __setitem__(self, key: Types.Any, value: Types.Any):
+        _get_value(self)[key] = value
+
+    def __delitem__(self, key: Types.Any):
+        del _get_value(self)[key]
+
+    def __eq__(self, other: Types.Any):
+        return _get_value(self) == other
+
+    def __ne__(self, other: Types.Any):
+        return _get_value(self) != other
+
+    def __lt__(self, other: Types.Any):
+        return _get_value(self) < other
+
+    def __le__(self, other: Types.Any):
+        return _get_value(self) <= other
+
+    def __gt__(self, other: Types.Any):
+        return _get_value(self) > other
+
+    def __ge__(self, other: Types.Any):
+        return _get_value(self) >= other
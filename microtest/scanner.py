@@ -1,36 +1,451 @@
 """
 Test module discovery implementation.
 
+The directory tree is scanned one level at a time, so modules higher in the
+hierarchy are always found before the modules below them. The directories on
+the same level are scanned concurrently in a thread pool, which is shut down
+before the modules of the level are yielded. The modules are yielded as soon
+as their directory has been scanned, so discover_tests can hand them to be
+executed before the scan has finished. No scanning threads are running while
+the modules are executed, unless the platform can't fork.
+
+The listings of the scanned directories are saved into an index file, keyed
+by the mtime of each directory. Later runs scan again only the directories
+which have changed since. The index is invalidated if the test module regex
+or the ignore patterns change.
+
+Directories matching the ignore patterns, or the rules in .gitignore files if
+use_gitignore is enabled, are never descended into. The same applies to directories that can't contain any
+executed modules because of the module restrictions (see microtest.exclude_modules
+and microtest.only_modules).
+
 Author: Valtteri Rajalainen
 """
 
 import os
 import re
+import time
+import marshal
+import threading
+import fnmatch
+
+from microtest.objects import Types, PathMatcher, LazyModule
 
-from microtest.objects import Types
+
+queue = LazyModule('queue')
+futures = LazyModule('concurrent.futures')
+tempfile = LazyModule('tempfile')
 
 
 test_module_regex = r'tests?_\w+\.py|\w+_tests?\.py|tests?\.py'
 
+#file and directory names (fnmatch patterns) that are never scanned
+ignore_patterns = [
+    '.git',
+    '.hg',
+    '.svn',
+    '__pycache__',
+    'node_modules',
+    'venv',
+    '.venv',
+    '.tox',
+    '.nox',
+    '.mypy_cache',
+    '.pytest_cache',
+    '*.egg-info',
+    ]
+
+#skip the paths ignored in .gitignore files, disabled by default as
+#generated tests are often placed into ignored directories
+use_gitignore = False
+
+#number of threads used for scanning, 1 disables the thread pool
+scan_workers = min(16, (os.cpu_count() or 1) * 2)
+
+#save the scanned directory listings into an index file in root_path/__pycache__
+use_index = True
+
+GITIGNORE_FILENAME = '.gitignore'
+
+INDEX_FILENAME = 'microtest-discovery.index'
+INDEX_VERSION = 1
+
+#directories modified less than this many nanoseconds before the scan are not trusted in the index
+INDEX_MTIME_RESOLUTION = 2 * 10 ** 9
+
+#the compiled test_module_regex: (regex, compiled_regex)
+compiled_regex = None
+
+
+class IgnoreRule:
+    """
+    A single rule from a .gitignore file.
+    The rule is matched against paths relative to the directory of the .gitignore file.
+    """
+    def __init__(self, base_path: str, regex: Types.Any, negate: bool, dir_only: bool):
+        self.base_path = base_path
+        self.regex = regex
+        self.negate = negate
+        self.dir_only = dir_only
+
+    def matches(self, path: str, is_dir: bool) -> bool:
+        if self.dir_only and not is_dir:
+            return False
+        prefix = self.base_path + os.sep
+        if path.startswith(prefix):
+            relative_path = path[len(prefix):]
+        else:
+            relative_path = os.path.relpath(path, self.base_path)
+        relative_path = relative_path.replace(os.sep, '/')
+        return self.regex.fullmatch(relative_path) is not None
+
+
+def translate_gitignore_pattern(pattern: str) -> str:
+    """
+    Translate the .gitignore glob pattern into a regex.
+    """
+    parts = list()
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+            continue
+
+        if pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+            continue
+
+        if char == '*':
+            parts.append('[^/]*')
+
+        elif char == '?':
+            parts.append('[^/]')
+
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+
+        elif char == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            content = pattern[i + 1:end]
+            if content.startswith('!'):
+                content = '^' + content[1:]
+            parts.append(f'[{content}]')
+            i = end
+
+        else:
+            parts.append(re.escape(char))
+        i += 1
+
+    return ''.join(parts)
+
+
+def parse_gitignore(path: str) -> list:
+    """
+    Parse the .gitignore file into a list of IgnoreRules.
+    Returns an empty list if the file can't be read.
+    """
+    try:
+        with open(path, encoding='utf-8', errors='replace') as file:
+            lines = file.read().splitlines()
+    except OSError:
+        return list()
+
+    base_path = os.path.dirname(path)
+    rules = list()
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith('#'):
+            continue
+
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            continue
+
+        #patterns with a slash are relative to the .gitignore, others match on any level
+        if '/' in line:
+            regex = translate_gitignore_pattern(line.lstrip('/'))
+        else:
+            regex = '(?:.*/)?' + translate_gitignore_pattern(line)
+
+        try:
+            rules.append(IgnoreRule(base_path, re.compile(regex), negate, dir_only))
+        except re.error:
+            continue
+
+    return rules
+
+
+def find_parent_gitignore_rules(root_path: str) -> list:
+    """
+    Collect the rules from the .gitignore files in the parent directories
+    of root_path, up to the root of the git repository.
+    Returns an empty list if root_path is not inside a git repository.
+    """
+    parents = list()
+    path = os.path.abspath(root_path)
+    while not os.path.exists(os.path.join(path, '.git')):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return list()
+        path = parent
+        parents.append(path)
+
+    rules = list()
+    for path in reversed(parents):
+        rules.extend(parse_gitignore(os.path.join(path, GITIGNORE_FILENAME)))
+    return rules
+
+
+def is_ignored(path: str, is_dir: bool, rules: list) -> bool:
+    """
+    Check the path against the .gitignore rules, the last matching rule decides.
+    """
+    ignored = False
+    for rule in rules:
+        if ignored == rule.negate and rule.matches(path, is_dir):
+            ignored = not rule.negate
+    return ignored
+
+
+def can_contain_modules(dir_path: str, only_matcher: Types.Any, excluded_matcher: Types.Any) -> bool:
+    """
+    Check if the directory can contain modules that pass the module restrictions.
+    This is only used for pruning, the modules are filtered with core.utils.filter_modules.
+    The matchers are PathMatchers created from only_modules and excluded_modules,
+    only_matcher is None if only_modules is empty.
+    """
+    if only_matcher is not None:
+        return only_matcher.can_match_below(dir_path)
+    return not excluded_matcher.matches_part(dir_path)
+
+
+class DirectoryListing:
+    """
+    The result of scanning a single directory, stored in the discovery index.
+    Only the names of the possible test modules and subdirectories are stored,
+    the .gitignore rules and module restrictions are applied on every run.
+    """
+    def __init__(self, mtime: int, modules: list, subdirectories: list, has_gitignore: bool):
+        self.mtime = mtime
+        self.modules = modules
+        self.subdirectories = subdirectories
+        self.has_gitignore = has_gitignore
+
+    def to_tuple(self) -> tuple:
+        return (self.mtime, self.modules, self.subdirectories, self.has_gitignore)
+
+
+def get_index_path(root_path: str) -> str:
+    return os.path.join(root_path, '__pycache__', INDEX_FILENAME)
 
-def find_tests(root_path: str) -> tuple:
+
+def create_index_key(root_path: str) -> tuple:
+    """
+    The index is invalidated if any of these change.
+    """
+    return (INDEX_VERSION, os.path.abspath(root_path), test_module_regex, tuple(ignore_patterns))
+
+
+def load_index(root_path: str) -> dict:
+    """
+    Load the discovery index: { dir_path: DirectoryListing }.
+    Returns an empty index if the index doesn't exist or it is invalid.
+    """
+    try:
+        with open(get_index_path(root_path), 'rb') as file:
+            key, directories = marshal.load(file)
+    except (OSError, EOFError, ValueError, TypeError):
+        return dict()
+
+    if key != create_index_key(root_path):
+        return dict()
+    return { path: DirectoryListing(*listing) for path, listing in directories.items() }
+
+
+def save_index(root_path: str, index: dict):
+    """
+    Write the discovery index atomically.
+    Failures are ignored, the index is only an optimization.
+    """
+    index_path = get_index_path(root_path)
+    directory = os.path.dirname(index_path)
+    temp_path = None
+
+    #directories modified just before the scan may be modified again within
+    #the resolution of the mtime, these are scanned again on the next run
+    threshold = time.time_ns() - INDEX_MTIME_RESOLUTION
+    directories = dict()
+    for path, listing in index.items():
+        mtime = listing.mtime if listing.mtime is not None and listing.mtime < threshold else None
+        directories[path] = (mtime, ) + listing.to_tuple()[1:]
+    
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            marshal.dump((create_index_key(root_path), directories), file)
+        os.replace(temp_path, index_path)
+
+    except (OSError, ValueError):
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def list_directory(dir_path: str, cached_listing: Types.Any, regex: Types.Any, ignore_regex: Types.Any) -> Types.Any:
+    """
+    Return the DirectoryListing of the directory.
+    The cached listing is used if the mtime of the directory hasn't changed.
+    Returns None if the directory can't be accessed.
+    """
+    try:
+        mtime = os.stat(dir_path).st_mtime_ns
+    except OSError:
+        return None
+
+    if cached_listing is not None and cached_listing.mtime == mtime:
+        return cached_listing
+
+    modules = list()
+    subdirectories = list()
+    has_gitignore = False
+    for entry in scan_directory_safely(dir_path):
+        if entry.name == GITIGNORE_FILENAME:
+            has_gitignore = True
+
+        if ignore_regex.match(entry.name):
+            continue
+
+        if entry.is_dir():
+            subdirectories.append(entry.name)
+        elif regex.fullmatch(entry.name):
+            modules.append(entry.name)
+
+    return DirectoryListing(mtime, modules, subdirectories, has_gitignore)
+
+
+def find_tests(root_path: str, *, only_modules: Types.Iterable = None, excluded_modules: Types.Iterable = None) -> tuple:
     """
     Do a BFS over the directory structure and add all
     filepaths that sadisfy the is_test_module check.
+    See iter_tests for details.
     """
-    modules = []
-    dirs_to_scan = [root_path]
-    
-    while dirs_to_scan:
-        dir_path = dirs_to_scan.pop(0)
-        for entry in scan_directory_safely(dir_path):
-            if entry.is_dir():
-                dirs_to_scan.append(entry.path)
-            
-            elif is_test_module(entry.name):
-                modules.append(entry.path)
+    return tuple(iter_tests(root_path, only_modules=only_modules, excluded_modules=excluded_modules))
+
+
+def discover_tests(root_path: str, *, only_modules: Types.Iterable = None, excluded_modules: Types.Iterable = None) -> Types.Iterable:
+    """
+    Yield the modules found by iter_tests, so they can be executed before the scan has finished.
+
+    If the platform can fork, the scan is advanced in the calling thread whenever the
+    next module is requested. Forking a process while other threads are running may
+    deadlock the child, and the tests (or the parallel workers) may fork at any time.
+    Otherwise the scan continues in a background thread while the modules are executed.
+    """
+    if hasattr(os, 'fork'):
+        yield from iter_tests(root_path, only_modules=only_modules, excluded_modules=excluded_modules)
+        return
+
+    results = queue.Queue()
+    done = object()
+
+    def scan():
+        try:
+            for path in iter_tests(root_path, only_modules=only_modules, excluded_modules=excluded_modules):
+                results.put(path)
+        except Exception as exc:
+            results.put(exc)
+        results.put(done)
+
+    thread = threading.Thread(target=scan, daemon=True)
+    thread.start()
+
+    item = results.get()
+    while item is not done:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+        item = results.get()
+
+
+def iter_tests(root_path: str, *, only_modules: Types.Iterable = None, excluded_modules: Types.Iterable = None) -> Types.Iterable:
+    """
+    Do a BFS over the directory structure and yield all
+    filepaths that sadisfy the is_test_module check.
+    The modules of a directory are yielded as soon as it has been scanned.
+
+    Directories matching the ignore patterns or .gitignore rules are skipped,
+    as well as directories excluded by the module restrictions.
+
+    If use_index is True, the listings of the scanned directories are saved
+    into an index file and only the directories which's mtime has changed
+    are scanned again on the next run.
+    """
+    only_matcher = PathMatcher(only_modules) if only_modules else None
+    excluded_matcher = PathMatcher(excluded_modules or tuple())
+    regex = get_compiled_regex()
+    ignore_regex = re.compile('|'.join(fnmatch.translate(pattern) for pattern in ignore_patterns) or '(?!)')
+    root_rules = find_parent_gitignore_rules(root_path) if use_gitignore else list()
     
-    return tuple(modules)
+    index = load_index(root_path) if use_index else dict()
+    new_index = dict()
+
+    def scan(directory: tuple) -> tuple:
+        dir_path, rules = directory
+        listing = list_directory(dir_path, index.get(dir_path), regex, ignore_regex)
+        if listing is None:
+            return None, list(), list()
+
+        if use_gitignore and listing.has_gitignore:
+            rules = rules + parse_gitignore(os.path.join(dir_path, GITIGNORE_FILENAME))
+
+        modules = list()
+        for name in listing.modules:
+            path = os.path.join(dir_path, name)
+            if not (rules and is_ignored(path, False, rules)):
+                modules.append(path)
+
+        subdirectories = list()
+        for name in listing.subdirectories:
+            path = os.path.join(dir_path, name)
+            if rules and is_ignored(path, True, rules):
+                continue
+            if can_contain_modules(path, only_matcher, excluded_matcher):
+                subdirectories.append((path, rules))
+
+        return listing, modules, subdirectories
+
+    level = [(root_path, root_rules)]
+    while level:
+        if len(level) == 1 or scan_workers <= 1:
+            results = [ scan(directory) for directory in level ]
+        else:
+            #the threads are joined before yielding, the modules may fork when they are executed
+            with futures.ThreadPoolExecutor(max_workers=scan_workers) as executor:
+                results = list(executor.map(scan, level))
+
+        directories = level
+        level = list()
+        for (dir_path, _), (listing, found_modules, subdirectories) in zip(directories, results):
+            if listing is not None:
+                new_index[dir_path] = listing
+            yield from found_modules
+            level.extend(subdirectories)
+
+    if use_index:
+        #keep the listings of the directories pruned by the module restrictions
+        if only_matcher is not None or excluded_matcher.has_relative:
+            for path, listing in index.items():
+                new_index.setdefault(path, listing)
+        save_index(root_path, new_index)
 
 
 def scan_directory_safely(path: str) -> Types.Iterable:
@@ -41,15 +456,26 @@ def scan_directory_safely(path: str) -> Types.Iterable:
     """
     result = iter(list())
     try:
-        result = os.scandir(path)
+        with os.scandir(path) as iterator:
+            result = list(iterator)
     except (FileNotFoundError, PermissionError, OSError):
         pass
-    return result
+    return iter(result)
+
+
+def get_compiled_regex() -> Types.Any:
+    """
+    Return the compiled test_module_regex.
+    The regex is compiled again only if test_module_regex has changed.
+    """
+    global compiled_regex
+    if compiled_regex is None or compiled_regex[0] != test_module_regex:
+        try:
+            compiled_regex = (test_module_regex, re.compile(test_module_regex))
+        except re.error:
+            raise ValueError(f'Failed to compile regex "{test_module_regex}"')
+    return compiled_regex[1]
 
 
 def is_test_module(filename: str):
-    try:
-        exp = re.compile(test_module_regex)    
-    except re.error:
-        raise ValueError(f'Failed to compile regex "{test_module_regex}"')
-    return re.fullmatch(exp, filename) is not None
+    return get_compiled_regex().fullmatch(filename) is not None
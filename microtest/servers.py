@@ -0,0 +1,537 @@
+"""
+Test servers started by microtest.utils.start_wsgi_server
+and microtest.utils.start_smtp_server.
+
+The WSGI server is based on wsgiref.simple_server and it is executed in a
+child process. By default it handles one request at a time, like wsgiref
+does. If a thread count is given, the requests are handled by a pool of threads and HTTP/1.1 connections are
+kept alive between requests, so the server doesn't become the bottleneck
+in concurrency tests.
+
+The SMTP server runs on an asyncio event loop in a background thread of the
+test process and captures the received messages as email.message objects.
+
+Author: Valtteri Rajalainen
+"""
+
+import io
+import sys
+import time
+import email
+import email.policy
+import socket
+import asyncio
+import threading
+import concurrent.futures
+import multiprocessing as mp
+import wsgiref.simple_server
+
+from microtest.objects import Types
+
+
+#seconds an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT = 5.0
+
+MAX_REQUEST_LINE = 65536
+
+
+class ServerStats:
+    """
+    Request counters of a WSGI server, shared with the server process.
+    The counters are updated by the server and can be read by the tests.
+    """
+    FIELDS = ('requests', 'connections', 'total_latency', 'max_latency')
+
+    def __init__(self):
+        self.values = mp.Array('d', len(self.FIELDS))
+
+    def record_connection(self):
+        with self.values.get_lock():
+            self.values[1] += 1
+
+    def record_request(self, latency: float):
+        with self.values.get_lock():
+            self.values[0] += 1
+            self.values[2] += latency
+            self.values[3] = max(self.values[3], latency)
+
+    @property
+    def requests(self) -> int:
+        return int(self.values[0])
+
+    @property
+    def connections(self) -> int:
+        return int(self.values[1])
+
+    @property
+    def mean_latency(self) -> float:
+        """
+        The mean time in seconds from reading the request line to sending the response.
+        """
+        with self.values.get_lock():
+            requests, total = self.values[0], self.values[2]
+        return total / requests if requests else 0.0
+
+    @property
+    def max_latency(self) -> float:
+        return self.values[3]
+
+    def reset(self):
+        with self.values.get_lock():
+            for i in range(len(self.FIELDS)):
+                self.values[i] = 0.0
+
+    def __repr__(self):
+        return f'<ServerStats requests={self.requests} connections={self.connections} mean_latency={self.mean_latency:.6f}>'
+
+
+class RequestBody:
+    """
+    The wsgi.input stream limited to the Content-Length of the request.
+    Applications can read it until EOF without blocking on a kept alive
+    connection, and the unread part is skipped after the response.
+    """
+    def __init__(self, rfile, length: int):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint: int = -1) -> list:
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self) -> bool:
+        """
+        Skip the unread part of the body.
+        Return False if the connection was closed before the end.
+        """
+        while self.remaining:
+            if not self.read(min(self.remaining, 65536)):
+                return False
+        return True
+
+
+class ServerHandler(wsgiref.simple_server.ServerHandler):
+
+    def _flush(self):
+        #responses without Content-Length are streamed as they are written,
+        #the others are flushed by the request handler after recording the request
+        if 'Content-Length' not in self.headers:
+            super()._flush()
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        handler = self.request_handler
+        #without Content-Length the end of the response is marked by closing the connection
+        if 'Content-Length' not in self.headers:
+            handler.close_connection = True
+        if handler.close_connection and handler.protocol_version == 'HTTP/1.1':
+            self.headers['Connection'] = 'close'
+
+
+class WSGIRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    """
+    Request handler that records the request counters
+    and handles multiple requests per connection with HTTP/1.1.
+
+    Responses with a Content-Length are buffered and flushed after the request
+    is recorded, so the counters are up to date when the client receives the
+    response. Streamed responses are sent as they are written and counted
+    once they are complete.
+    """
+    wbufsize = io.DEFAULT_BUFFER_SIZE
+
+    def handle(self):
+        self.server.stats.record_connection()
+        while True:
+            self.close_connection = True
+            self.handle_one_request()
+            self.wfile.flush()
+            if self.close_connection:
+                break
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(MAX_REQUEST_LINE + 1)
+        except (socket.timeout, ConnectionError):
+            self.close_connection = True
+            return
+
+        t_start = time.perf_counter()
+        if len(self.raw_requestline) > MAX_REQUEST_LINE:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+
+        if not self.parse_request():
+            return
+
+        environ = self.get_environ()
+        body = RequestBody(self.rfile, int(self.headers.get('Content-Length') or 0))
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            body = self.rfile
+            self.close_connection = True
+
+        handler = ServerHandler(
+            body, self.wfile, self.get_stderr(), environ,
+            multithread=self.server.multithread,
+            )
+        handler.http_version = self.protocol_version.split('/')[1]
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+        if isinstance(body, RequestBody) and not body.drain():
+            self.close_connection = True
+        self.server.stats.record_request(time.perf_counter() - t_start)
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_TIMEOUT
+    #responses larger than the buffer are written in parts, without TCP_NODELAY
+    #the later parts wait for the delayed ACK of the client on kept alive connections
+    disable_nagle_algorithm = True
+
+
+class WSGIServer(wsgiref.simple_server.WSGIServer):
+    """
+    The wsgiref server, handling one request at a time.
+    """
+    multithread = False
+    handler_class = WSGIRequestHandler
+
+    def __init__(self, address: tuple, stats: ServerStats):
+        self.stats = stats
+        super().__init__(address, self.handler_class)
+
+
+class PooledWSGIServer(WSGIServer):
+    """
+    Server that handles the connections in a pool of threads.
+    """
+    multithread = True
+    handler_class = KeepAliveRequestHandler
+
+    def __init__(self, address: tuple, stats: ServerStats, threads: int):
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        super().__init__(address, stats)
+
+    def process_request(self, request: socket.socket, client_address: tuple):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request: socket.socket, client_address: tuple):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+def run_wsgi_server(host: str, port: int, wsgi_app: object, threads: Types.Any, stats: ServerStats, conn):
+    if threads is None:
+        server = WSGIServer((host, port), stats)
+    else:
+        server = PooledWSGIServer((host, port), stats, threads)
+    server.set_app(wsgi_app)
+
+    with server:
+        conn.send(server.server_address[:2])
+        conn.close()
+        server.serve_forever()
+
+
+class SMTPServer:
+    """
+    SMTP server that captures the received messages, running on
+    an asyncio event loop in a background thread of the test process.
+
+    The messages are parsed into email.message.EmailMessage objects with the
+    envelope in the X-Peer, X-MailFrom and X-RcptTo headers. Use wait_for_messages
+    to block until the messages have arrived.
+
+    Only the commands needed for sending mail are implemented
+    (HELO, EHLO, MAIL, RCPT, DATA, RSET, NOOP, VRFY and QUIT).
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.requested_port = port
+        self.address = None
+        self.loop = None
+        self.thread = None
+        self.server = None
+        self.startup = None
+        self.connections = set()
+        self.received = list()
+        self.condition = threading.Condition()
+        self.last_read = 0
+
+    @property
+    def port(self) -> int:
+        return self.address[1]
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def messages(self) -> list:
+        """
+        A copy of the list of messages received so far.
+        """
+        with self.condition:
+            return list(self.received)
+
+    def start(self, timeout: float = None, *, wait: bool = True):
+        """
+        Start the event loop thread. If wait is True, wait until
+        the server accepts connections, see wait_for_startup.
+        """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='microtest-smtp', daemon=True)
+        self.thread.start()
+
+        self.startup = asyncio.run_coroutine_threadsafe(self.listen(), self.loop)
+        if wait:
+            self.wait_for_startup(timeout)
+
+    def wait_for_startup(self, timeout: float = None) -> tuple:
+        """
+        Wait until the server accepts connections and return the address it is bound to.
+
+        RuntimeError is raised if the server doesn't start in timeout seconds
+        and the errors raised while binding the socket are passed on.
+        The server is stopped in both cases.
+        """
+        try:
+            self.startup.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.startup.cancel()
+            self.stop()
+            raise RuntimeError(f'The SMTP server did not start in {timeout} seconds.')
+        except BaseException:
+            self.stop()
+            raise
+        return self.address
+
+    async def listen(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.requested_port)
+        self.address = self.server.sockets[0].getsockname()[:2]
+
+    def stop(self):
+        """
+        Close the server and its connections and stop the event loop thread.
+        """
+        if self.loop is None or self.loop.is_closed():
+            return
+
+        if self.thread.is_alive():
+            #the server is closed only after it has started listening
+            try:
+                self.startup.result()
+            except (Exception, concurrent.futures.CancelledError):
+                pass
+            asyncio.run_coroutine_threadsafe(self.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        self.loop.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in list(self.connections):
+            writer.close()
+
+    def terminate(self):
+        self.stop()
+
+    def kill(self):
+        self.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def clear(self):
+        """
+        Remove the received messages.
+        """
+        with self.condition:
+            self.received.clear()
+            self.last_read = 0
+
+    def wait_for_messages(self, count: int = 1, timeout: float = None) -> list:
+        """
+        Block until at least count messages have been received and return them.
+        TimeoutError is raised if they don't arrive in timeout seconds.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.received) >= count, timeout):
+                info = f'Received {len(self.received)} messages in {timeout} seconds, expected {count}.'
+                raise TimeoutError(info)
+            return list(self.received)
+
+    def read_output(self, *, read_all=False) -> str:
+        """
+        Return the messages received since the last read as text,
+        in the same format as smtpd.DebuggingServer.
+        If read_all is set to True, all received messages are returned.
+        """
+        with self.condition:
+            messages = self.received if read_all else self.received[self.last_read:]
+            self.last_read = len(self.received)
+
+        output = list()
+        for message in messages:
+            output.append('---------- MESSAGE FOLLOWS ----------\n')
+            output.append(message.as_string())
+            output.append('\n------------ END MESSAGE ------------\n')
+        return ''.join(output)
+
+    def store(self, data: bytes, peer: str, mail_from: str, rcpt_tos: list):
+        message = email.message_from_bytes(data, policy=email.policy.default)
+        message['X-Peer'] = peer
+        message['X-MailFrom'] = mail_from
+        message['X-RcptTo'] = ', '.join(rcpt_tos)
+        with self.condition:
+            self.received.append(message)
+            self.condition.notify_all()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections.add(writer)
+        peer = writer.get_extra_info('peername')[0]
+        mail_from = None
+        rcpt_tos = list()
+
+        def reply(line: str):
+            writer.write(line.encode() + b'\r\n')
+
+        try:
+            reply(f'220 {self.host} microtest SMTP server')
+            while True:
+                await writer.drain()
+                line = await reader.readline()
+                if not line:
+                    break
+
+                command, _, arg = line.decode('utf-8', 'replace').strip().partition(' ')
+                command = command.upper()
+
+                if command == 'HELO':
+                    reply(f'250 {self.host}')
+
+                elif command == 'EHLO':
+                    reply(f'250-{self.host}')
+                    reply('250-8BITMIME')
+                    reply('250 SMTPUTF8')
+
+                elif command == 'MAIL' and arg.upper().startswith('FROM:'):
+                    mail_from = parse_address(arg[5:])
+                    rcpt_tos = list()
+                    reply('250 OK')
+
+                elif command == 'RCPT' and arg.upper().startswith('TO:'):
+                    if mail_from is None:
+                        reply('503 Error: need MAIL command')
+                        continue
+                    rcpt_tos.append(parse_address(arg[3:]))
+                    reply('250 OK')
+
+                elif command == 'DATA':
+                    if not rcpt_tos:
+                        reply('503 Error: need RCPT command')
+                        continue
+                    reply('354 End data with <CR><LF>.<CR><LF>')
+                    await writer.drain()
+                    data = await read_data(reader)
+                    if data is None:
+                        break
+                    self.store(data, peer, mail_from, rcpt_tos)
+                    mail_from = None
+                    rcpt_tos = list()
+                    reply('250 OK')
+
+                elif command == 'RSET':
+                    mail_from = None
+                    rcpt_tos = list()
+                    reply('250 OK')
+
+                elif command == 'NOOP':
+                    reply('250 OK')
+
+                elif command == 'VRFY':
+                    reply('252 Cannot VRFY user')
+
+                elif command == 'QUIT':
+                    reply('221 Bye')
+                    await writer.drain()
+                    break
+
+                else:
+                    reply(f'502 Error: command "{command}" not implemented')
+
+        except ConnectionError:
+            pass
+
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+
+def parse_address(arg: str) -> str:
+    """
+    Return the address from the argument of MAIL FROM or RCPT TO,
+    without the angle brackets and the parameters.
+    """
+    arg = arg.strip()
+    if arg.startswith('<'):
+        return arg[1:arg.find('>')] if '>' in arg else arg[1:]
+    return arg.split(' ')[0]
+
+
+async def read_data(reader: asyncio.StreamReader) -> Types.Any:
+    """
+    Read the message after the DATA command until the line with a single dot.
+    The line endings are converted to newlines. Returns None if the connection is closed before the end.
+    """
+    lines = list()
+    while True:
+        line = await reader.readline()
+        if not line:
+            return None
+        if line in (b'.\r\n', b'.\n'):
+            return b''.join(lines)
+        #dot-stuffing (RFC 5321 4.5.2)
+        if line.startswith(b'.'):
+            line = line[1:]
+        if line.endswith(b'\r\n'):
+            line = line[:-2] + b'\n'
+        lines.append(line)
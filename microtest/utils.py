@@ -6,16 +6,65 @@ Author: Valtteri Rajalainen
 
 import stat
 import os
+import re
 import sys
+import io
+import codecs
+import collections
+import time
 import shutil
 import tempfile
-import subprocess as subp
-import multiprocessing as mp
-import wsgiref.simple_server
-import time
-import socket
+import itertools
+import threading
+
+from microtest.objects import Types, LazyModule
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+subp = LazyModule('subprocess')
+mp = LazyModule('multiprocessing')
+mp_connection = LazyModule('multiprocessing.connection')
+mp_util = LazyModule('multiprocessing.util')
+servers = LazyModule('microtest.servers')
+email_utils = LazyModule('email.utils')
+http_client = LazyModule('http.client')
+futures = LazyModule('concurrent.futures')
+socket = LazyModule('socket')
+mp_reduction = LazyModule('multiprocessing.reduction')
+forkserver = LazyModule('microtest.forkserver')
+signal = LazyModule('signal')
+_json = LazyModule('json')
+urllib_parse = LazyModule('urllib.parse')
+http_cookies = LazyModule('http.cookies')
+wsgiref_headers = LazyModule('wsgiref.headers')
+
+#seconds to wait for a server process to start
+STARTUP_TIMEOUT = 10.0
+
+#the number of output lines kept in memory for each process
+OUTPUT_BUFFER_LINES = 10000
+OUTPUT_CHUNK_SIZE = 65536
+#seconds between reads of an output stream given to Process
+STREAM_POLL_INTERVAL = 0.05
+
+#template directories are placed here if it is available
+MEMORY_ROOT = '/dev/shm'
+
+#the ioctl request for cloning a file (Linux, btrfs and xfs among others)
+FICLONE = 0x40049409
+
+#requests that can be sent again if a reused connection turns out to be closed
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
 
-from microtest.objects import Types
+_memory_root = False
+
+#the processes started by start_function in the current process, terminated on exit
+_children = set()
+_children_pid = None
 
 
 class Namespace:
@@ -67,7 +116,7 @@ class TemporaryDirectory(tempfile.TemporaryDirectory):
     def populate(self, files=list(), dirs=list()):
         for file in files:
             path = os.path.join(self.path, file)
-            open(path, 'x').close()
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
 
         for dir_ in dirs:
             path = os.path.join(self.path, dir_)
@@ -81,6 +130,163 @@ class TemporaryDirectory(tempfile.TemporaryDirectory):
             os.remove(entry.path)
 
 
+class TemplateDirectory(TemporaryDirectory):
+    """
+    A temporary directory that is populated once and cloned for each test.
+
+    The template is placed on tmpfs (/dev/shm) when it is available. The clones
+    are created next to the template, so that files can be cloned with reflinks
+    (copy-on-write) where the filesystem supports them, or hardlinks if requested.
+    Other files are copied. The template must not be modified after it has been cloned.
+    """
+    def __init__(self, *, in_memory: bool = True):
+        self.root = _get_memory_root() if in_memory else None
+        super().__init__(prefix='microtest-template-', dir=self.root)
+        self.entries = None
+        self.reflinks = fcntl is not None and sys.platform.startswith('linux')
+
+    def scan(self) -> dict:
+        """
+        Return the entries of the template as a dict of
+        {relative directory path: {name: (kind, mode, mtime_ns, size)}}.
+        The kind is 'dir', 'file' or 'link'. Scanned once, when first needed.
+        """
+        if self.entries is not None:
+            return self.entries
+
+        self.entries = dict()
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            listing = self.entries[rel_dir] = dict()
+            for entry in os.scandir(os.path.join(self.path, rel_dir)):
+                info = entry.stat(follow_symlinks=False)
+                kind = _get_entry_kind(info)
+                listing[entry.name] = (kind, info.st_mode, info.st_mtime_ns, info.st_size)
+                if kind == 'dir':
+                    stack.append(os.path.join(rel_dir, entry.name))
+        return self.entries
+
+    def clone(self, *, hardlinks: bool = False) -> 'TemplateClone':
+        """
+        Create a copy of the template.
+        With hardlinks the files are shared with the template, so the tests
+        must replace the files instead of modifying them in place.
+        """
+        return TemplateClone(self, hardlinks=hardlinks)
+
+
+class TemplateClone(TemporaryDirectory):
+    """
+    A copy of a TemplateDirectory.
+
+    The copied entries keep the modification times of the template, so
+    reset can find the changed paths by comparing the modification times
+    and sizes with the template, and restore only them.
+    """
+    def __init__(self, template: TemplateDirectory, *, hardlinks: bool = False):
+        super().__init__(prefix='microtest-clone-', dir=template.root)
+        self.template = template
+        self.hardlinks = hardlinks
+        self.copy_dir('')
+
+    def copy_entry(self, rel_path: str, kind: str, mode: int, mtime_ns: int, size: int):
+        source = os.path.join(self.template.path, rel_path)
+        target = os.path.join(self.path, rel_path)
+        if kind == 'dir':
+            os.mkdir(target)
+            self.copy_dir(rel_path)
+            os.chmod(target, stat.S_IMODE(mode))
+            os.utime(target, ns=(mtime_ns, mtime_ns))
+
+        elif kind == 'link':
+            os.symlink(os.readlink(source), target)
+
+        elif self.hardlinks:
+            os.link(source, target)
+
+        else:
+            self.copy_file(source, target, mode, mtime_ns, size)
+
+    def copy_file(self, source: str, target: str, mode: int, mtime_ns: int, size: int):
+        """
+        Copy the file using a single file descriptor for the target,
+        as a reflink if the filesystem supports it.
+        """
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            if size > 0:
+                src_fd = os.open(source, os.O_RDONLY)
+                try:
+                    #the support is checked with the first file
+                    if self.template.reflinks:
+                        self.template.reflinks = _reflink(src_fd, fd)
+                    if not self.template.reflinks:
+                        _copy_contents(src_fd, fd, size)
+                finally:
+                    os.close(src_fd)
+
+            os.fchmod(fd, stat.S_IMODE(mode))
+            os.utime(fd, ns=(mtime_ns, mtime_ns))
+        finally:
+            os.close(fd)
+
+    def copy_dir(self, rel_dir: str):
+        for name, (kind, mode, mtime_ns, size) in self.template.scan()[rel_dir].items():
+            self.copy_entry(os.path.join(rel_dir, name), kind, mode, mtime_ns, size)
+
+    def remove_entry(self, path: str, is_dir: bool):
+        if is_dir:
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def reset(self) -> int:
+        """
+        Restore the contents of the template.
+        Only the paths that have been added, removed or modified are restored.
+        Return the number of restored paths.
+        """
+        return self.reset_dir('')
+
+    def reset_dir(self, rel_dir: str) -> int:
+        expected = self.template.scan()[rel_dir]
+        directory = os.path.join(self.path, rel_dir)
+        restored = 0
+        found = set()
+
+        for entry in os.scandir(directory):
+            rel_path = os.path.join(rel_dir, entry.name)
+            info = entry.stat(follow_symlinks=False)
+            kind = _get_entry_kind(info)
+            expected_info = expected.get(entry.name)
+            if expected_info is not None and expected_info[0] == kind:
+                _, mode, mtime_ns, size = expected_info
+                if kind == 'dir':
+                    found.add(entry.name)
+                    restored += self.reset_dir(rel_path)
+                    continue
+                if kind == 'link' or (info.st_mtime_ns, info.st_size, info.st_mode) == (mtime_ns, size, mode):
+                    found.add(entry.name)
+                    continue
+
+            #changed entries are counted when they are copied back
+            self.remove_entry(entry.path, kind == 'dir')
+            if expected_info is None:
+                restored += 1
+
+        for name, (kind, mode, mtime_ns, size) in expected.items():
+            if name not in found:
+                self.copy_entry(os.path.join(rel_dir, name), kind, mode, mtime_ns, size)
+                restored += 1
+
+        if rel_dir:
+            parent = self.template.scan()[os.path.dirname(rel_dir)]
+            mtime_ns = parent[os.path.basename(rel_dir)][2]
+            os.utime(directory, ns=(mtime_ns, mtime_ns))
+        return restored
+
+
 class UnauthorizedFile:
     """
     Context manager that temporarily removes all user permissions
@@ -142,18 +348,243 @@ class UnauthorizedDirectory:
         os.chmod(self.dir_path, self.dir_mode)
 
 
+class OutputReader:
+    """
+    Reads the output of a child process on a background thread.
+
+    The lines are kept in a ring buffer of at most max_lines lines, older lines
+    are dropped. Use wait_for to block until a line matching a pattern is written
+    and iter_lines to follow the output as it is written.
+
+    The output is read from a function that returns the next chunk of
+    bytes, or an empty bytes object when the process has closed its output.
+    """
+    def __init__(self, read_chunk: Types.Callable, *, max_lines: int = None):
+        self.read_chunk = read_chunk
+        self.lines = collections.deque(maxlen=max_lines if max_lines is not None else OUTPUT_BUFFER_LINES)
+        self.partial = ''
+        self.line_count = 0
+        self.closed = False
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.condition = threading.Condition()
+        self.read_position = (0, 0)
+        self.wait_position = 0
+
+        self.thread = threading.Thread(target=self.read_output, name='microtest-output-reader', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_connection(cls, conn: object, **kwargs) -> 'OutputReader':
+        """
+        Read the output sent from a multiprocessing child with redirect_output.
+        """
+        def read_chunk() -> bytes:
+            try:
+                return conn.recv_bytes()
+            except (EOFError, OSError):
+                conn.close()
+                return b''
+        return cls(read_chunk, **kwargs)
+
+    @classmethod
+    def from_file(cls, file: object, **kwargs) -> 'OutputReader':
+        """
+        Read the output from a binary pipe, for example subprocess.Popen.stdout.
+        """
+        def read_chunk() -> bytes:
+            data = file.read1(OUTPUT_CHUNK_SIZE)
+            if not data:
+                file.close()
+            return data
+        return cls(read_chunk, **kwargs)
+
+    @classmethod
+    def from_stream(cls, stream: object, is_running: Types.Callable, **kwargs) -> 'OutputReader':
+        """
+        Read the output from a seekable text stream, like a temporary file the process
+        writes into. The stream is polled until is_running returns False.
+        """
+        position = 0
+        def read_chunk() -> bytes:
+            nonlocal position
+            while True:
+                #checked before reading, so the output written before the exit is not lost
+                running = is_running()
+                try:
+                    stream.seek(position)
+                    data = stream.read()
+                    position = stream.tell()
+                except (OSError, ValueError):
+                    return b''
+                if data or not running:
+                    return data.encode()
+                time.sleep(STREAM_POLL_INTERVAL)
+        return cls(read_chunk, **kwargs)
+
+    def read_output(self):
+        while True:
+            data = self.read_chunk()
+            text = self.decoder.decode(data, final=not data)
+            with self.condition:
+                lines = (self.partial + text).splitlines(keepends=True)
+                self.partial = ''
+                if lines and not lines[-1].endswith(('\n', '\r')):
+                    self.partial = lines.pop()
+                if not data and self.partial:
+                    lines.append(self.partial)
+                    self.partial = ''
+
+                self.lines.extend(lines)
+                self.line_count += len(lines)
+                if not data:
+                    self.closed = True
+                self.condition.notify_all()
+
+            if not data:
+                return
+
+    def get_lines(self, position: int) -> list:
+        """
+        Return the buffered lines starting from the absolute line index position.
+        The lines that have been dropped from the buffer are skipped.
+        """
+        first = self.line_count - len(self.lines)
+        return list(itertools.islice(self.lines, max(position - first, 0), None))
+
+    def wait_closed(self, timeout: float = None) -> bool:
+        """
+        Wait until the process has closed its output and all of it has been read.
+        """
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def wait_for(self, pattern: Types.Union[str, re.Pattern], timeout: float = None) -> re.Match:
+        """
+        Block until a line matching the regular expression is written
+        and return the match object.
+
+        The lines are searched from the line after the previous match,
+        so a line is matched at most once. TimeoutError is raised if no line
+        matches in timeout seconds and EOFError if the process closes its
+        output before that. The error message includes the latest output.
+        """
+        regex = re.compile(pattern) if isinstance(pattern, str) else pattern
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        with self.condition:
+            while True:
+                lines = self.get_lines(self.wait_position)
+                first = self.line_count - len(lines)
+                for i, line in enumerate(lines):
+                    match = regex.search(line)
+                    if match is not None:
+                        self.wait_position = first + i + 1
+                        return match
+                self.wait_position = self.line_count
+
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if self.closed or (remaining is not None and remaining <= 0):
+                    break
+                self.condition.wait(remaining)
+
+            output = ''.join(self.get_lines(self.line_count - 10)) + self.partial
+            if self.closed:
+                raise EOFError(f'The output closed without a line matching {regex.pattern!r}. Latest output:\n\n{output}')
+            raise TimeoutError(f'No line matching {regex.pattern!r} in {timeout} seconds. Latest output:\n\n{output}')
+
+    def iter_lines(self, timeout: float = None) -> Types.Iterable:
+        """
+        Yield the buffered lines and then the new lines as they are written,
+        until the process closes its output. The lines include the line ending.
+        TimeoutError is raised if no new line is written in timeout seconds.
+        """
+        position = self.line_count - len(self.lines)
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.line_count > position or self.closed, timeout):
+                    raise TimeoutError(f'No output in {timeout} seconds.')
+                lines = self.get_lines(position)
+                position = self.line_count
+                closed = self.closed
+
+            yield from lines
+            if closed and not lines:
+                return
+
+    def read(self, *, read_all: bool = False) -> str:
+        """
+        Return the output written since the previous read,
+        including the incomplete last line.
+        If read_all is True, return all of the buffered output.
+        """
+        with self.condition:
+            position, offset = (0, 0) if read_all else self.read_position
+            #the partially read line has been dropped from the buffer
+            if position < self.line_count - len(self.lines):
+                offset = 0
+            text = ''.join(self.get_lines(position)) + self.partial
+            self.read_position = (self.line_count, len(self.partial))
+            return text[offset:]
+
+    def text(self) -> str:
+        """
+        Return all of the buffered output.
+        """
+        with self.condition:
+            return ''.join(self.lines) + self.partial
+
+
+class PipeWriter(io.RawIOBase):
+    """
+    Writable raw stream that sends the written data through a multiprocessing connection.
+    """
+    def __init__(self, conn: object):
+        self.conn = conn
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self.conn.send_bytes(data)
+        return len(data)
+
+
+def redirect_output(conn: object):
+    """
+    Direct sys.stdout and sys.stderr of a multiprocessing child into the connection.
+    The output is line buffered, so it can be read while the process runs.
+    """
+    stream = io.TextIOWrapper(io.BufferedWriter(PipeWriter(conn)), encoding='utf-8', errors='backslashreplace', line_buffering=True)
+    sys.stdout = sys.stderr = stream
+
+
 class Process:
     """
     A wrapper object that holds refrences to a process object and
-    a text stream where the process's output is directed.
+    an OutputReader that reads the process's output.
 
-    The wrapper process object can be an instance of subprocess.Popen 
-    or multiprocessing.Process.
+    The wrapper process object can be an instance of subprocess.Popen,
+    multiprocessing.Process or ForkedProcess.
+
+    The output is given as an OutputReader, or as a seekable text stream where
+    the process's output is directed (for example a temporary file). The stream
+    is available as Process.stream and it's closed when the process is terminated.
+
+    Servers started with start_wsgi_server report the address they are
+    bound to through startup_conn, once they are ready to accept connections.
+    The address is available as Process.address.
+    For WSGI servers, stats holds the request counters shared with the server.
     """
-    def __init__(self, stream, process):
-        self.last_read = 0
-        self.stream = stream
+    def __init__(self, stream: Types.Any, process, *, startup_conn = None, stats = None):
         self.process = process
+        self.stream = None
+        self.output = stream
+        if not isinstance(stream, OutputReader):
+            self.stream = stream
+            self.output = OutputReader.from_stream(stream, lambda: self.running)
+        self.startup_conn = startup_conn
+        self.stats = stats
+        self._address = None
 
     @property
     def running(self):
@@ -165,24 +596,727 @@ class Process:
         if hasattr(proc, 'poll'):
             return proc.poll() is None
 
+    @property
+    def exitcode(self) -> Types.Any:
+        """
+        The exit code of the process, or None if it is still running.
+        Negative if the process was killed by a signal.
+        """
+        proc = self.process
+        #subprocess.Popen
+        if hasattr(proc, 'poll'):
+            return proc.poll()
+        return proc.exitcode
+
+    @property
+    def address(self) -> tuple:
+        """
+        The (host, port) address the server is bound to.
+        Blocks until the server has started, if it hasn't yet.
+        """
+        if self._address is None and self.startup_conn is not None:
+            self.wait_for_startup()
+        return self._address
+
+    @property
+    def port(self) -> int:
+        return self.address[1]
+
+    def wait_for_startup(self, timeout: float = None) -> tuple:
+        """
+        Wait until the server reports that it is ready to accept
+        connections and return the address it is bound to.
+
+        RuntimeError is raised if the process exits or the server doesn't start
+        in timeout seconds (STARTUP_TIMEOUT by default). The output of the process
+        is included in the error message and the process is terminated.
+        """
+        if self._address is not None or self.startup_conn is None:
+            return self._address
+
+        timeout = timeout if timeout is not None else STARTUP_TIMEOUT
+        ready = mp_connection.wait([self.startup_conn, self.process.sentinel], timeout)
+        if self.startup_conn in ready:
+            try:
+                self._address = tuple(self.startup_conn.recv())
+            except EOFError:
+                pass
+
+        if self._address is None:
+            if ready:
+                info = f'The server process exited with code {self.process.exitcode} during startup.'
+            else:
+                info = f'The server did not start in {timeout} seconds.'
+            self.process.terminate()
+            self.process.join()
+            self.output.wait_closed(1.0)
+            raise RuntimeError(f'{info} Output:\n\n{self.output.text()}')
+
+        self.startup_conn.close()
+        return self._address
+
     def read_output(self, *, read_all=False):
         """
         Read the output that the wrapped process has produced since
-        last read. If read_all is set to True, all output that the
-        process has ever produced will be read.
+        last read. If read_all is set to True, all buffered output
+        (at most OUTPUT_BUFFER_LINES lines) will be read.
+        """
+        return self.output.read(read_all=read_all)
+
+    def wait_for(self, pattern: Types.Union[str, re.Pattern], timeout: float = None) -> re.Match:
+        """
+        Block until the process writes a line matching the regular expression.
+        See OutputReader.wait_for.
+        """
+        return self.output.wait_for(pattern, timeout)
+
+    def iter_lines(self, timeout: float = None) -> Types.Iterable:
+        """
+        Yield the lines written by the process until it exits.
+        See OutputReader.iter_lines.
         """
-        i = self.last_read if not read_all else 0
-        self.last_read = self.stream.tell()
-        self.stream.seek(i)
-        return self.stream.read()
+        return self.output.iter_lines(timeout)
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        Wait for the process to exit and return True if it has exited.
+        """
+        #multiprocessing.Process
+        if hasattr(self.process, 'join'):
+            self.process.join(timeout)
+            return self.process.exitcode is not None
+        #subprocess.Popen
+        try:
+            self.process.wait(timeout)
+        except subp.TimeoutExpired:
+            return False
+        return True
+
+    def close_streams(self):
+        if self.startup_conn is not None:
+            self.startup_conn.close()
+        if self.stream is not None:
+            self.output.wait_closed(1.0)
+            self.stream.close()
 
     def kill(self):
         self.process.kill()
-        self.stream.close()
+        self.join(1.0)
+        self.close_streams()
 
     def terminate(self):
         self.process.terminate()
-        self.stream.close()
+        self.join(1.0)
+        self.close_streams()
+
+
+class ForkedProcess:
+    """
+    A process started by ProcessFactory.
+    Provides the same interface as multiprocessing.Process.
+
+    The process is a child of the template process, which reports
+    the exit code through status_conn once it has reaped the process.
+    """
+    def __init__(self, pid: int, status_conn: object):
+        self.pid = pid
+        self.status_conn = status_conn
+        self.sentinel = status_conn.fileno()
+        self._exitcode = None
+
+    @property
+    def exitcode(self) -> Types.Any:
+        self.join(0)
+        return self._exitcode
+
+    def is_alive(self) -> bool:
+        return self.exitcode is None
+
+    def join(self, timeout: float = None):
+        if self._exitcode is not None or not self.status_conn.poll(timeout):
+            return
+        try:
+            self._exitcode = self.status_conn.recv()
+        except EOFError:
+            #the template process has died, the actual exit code is unknown
+            self._exitcode = -signal.SIGKILL
+        self.status_conn.close()
+
+    def send_signal(self, signum: int):
+        if self.exitcode is None:
+            try:
+                os.kill(self.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class ProcessFactory:
+    """
+    Starts Python processes by forking them from a template process,
+    where the modules given in preload have already been imported.
+
+    The template is a fresh interpreter started with sys.executable, so the
+    processes don't inherit any state of the test process. Starting a process
+    only costs a fork instead of the interpreter startup and the imports.
+    RuntimeError is raised if importing the modules fails or the template
+    doesn't start in timeout seconds (STARTUP_TIMEOUT by default).
+
+    Only available on Unix, as it relies on os.fork.
+    """
+    def __init__(self, preload: Types.Iterable = tuple(), *, timeout: float = None):
+        self.lock = threading.Lock()
+        parent_sock, child_sock = socket.socketpair()
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with parent_sock, child_sock:
+            self.conn = mp_connection.Connection(os.dup(parent_sock.fileno()))
+            fd = child_sock.fileno()
+            cmd = [sys.executable, '-c', forkserver.BOOTSTRAP, package_dir, str(fd)] + list(preload)
+            self.process = subp.Popen(cmd, pass_fds=(fd,), stdin=subp.DEVNULL, stdout=subp.DEVNULL, stderr=subp.DEVNULL)
+
+        timeout = timeout if timeout is not None else STARTUP_TIMEOUT
+        message = None
+        if self.conn.poll(timeout):
+            try:
+                message = self.conn.recv()
+            except EOFError:
+                pass
+
+        if message is None or message[0] != 'ready':
+            self.close()
+            if message is not None:
+                raise RuntimeError(f'Importing the preloaded modules failed:\n\n{message[1]}')
+            raise RuntimeError(f'The template process did not start in {timeout} seconds.')
+
+    @property
+    def running(self) -> bool:
+        return self.process.poll() is None
+
+    def start(
+        self,
+        entry_point: str,
+        args: Types.Iterable = tuple(),
+        *,
+        env: dict = None,
+        stdin: Types.Union[bytes, str] = None,
+        cwd: str = None
+        ) -> Process:
+        """
+        Run the entry point in a new process with the given arguments,
+        like 'python -m entry_point args...'. A function can be given as
+        'module:function', it is called and its return value is used as the exit code.
+
+        The process gets a copy of os.environ unless env is given, and
+        stdin is written to its standard input. Stderr is directed into stdout,
+        the output and the exit code are available through the returned Process.
+        """
+        if isinstance(stdin, str):
+            stdin = stdin.encode()
+
+        request = {
+            'entry_point': entry_point,
+            'args': list(args),
+            'env': dict(env if env is not None else os.environ),
+            'cwd': cwd if cwd is not None else os.getcwd(),
+            }
+
+        stdin_reader, stdin_writer = os.pipe()
+        output_reader, output_writer = os.pipe()
+        status_conn, child_status_conn = mp.Pipe(duplex=False)
+        try:
+            with self.lock:
+                self.conn.send(request)
+                for fd in (stdin_reader, output_writer, child_status_conn.fileno()):
+                    mp_reduction.send_handle(self.conn, fd, self.process.pid)
+                pid = self.conn.recv()
+        except (OSError, EOFError):
+            for fd in (stdin_writer, output_reader):
+                os.close(fd)
+            status_conn.close()
+            raise RuntimeError('The template process has exited.')
+        finally:
+            os.close(stdin_reader)
+            os.close(output_writer)
+            child_status_conn.close()
+
+        self.write_stdin(stdin_writer, stdin)
+        output = OutputReader.from_file(open(output_reader, 'rb'))
+        return Process(output, ForkedProcess(pid, status_conn))
+
+    def run(self, entry_point: str, args: Types.Iterable = tuple(), *, timeout: float = None, **kwargs) -> Process:
+        """
+        Start the process and wait until it has exited and its output has been read.
+        TimeoutError is raised and the process is killed if it doesn't exit in timeout seconds.
+        See ProcessFactory.start for the arguments.
+        """
+        proc = self.start(entry_point, args, **kwargs)
+        if not proc.join(timeout):
+            proc.kill()
+            raise TimeoutError(f'The process did not exit in {timeout} seconds. Output:\n\n{proc.output.text()}')
+        proc.output.wait_closed()
+        return proc
+
+    @staticmethod
+    def write_stdin(fd: int, data: Types.Any):
+        if not data:
+            os.close(fd)
+            return
+
+        def write():
+            with open(fd, 'wb') as pipe:
+                try:
+                    pipe.write(data)
+                except BrokenPipeError:
+                    pass
+
+        #a thread, so that a process not reading its stdin can't block the caller
+        threading.Thread(target=write, name='microtest-stdin-writer', daemon=True).start()
+
+    def close(self):
+        """
+        Stop the template process. The processes still running are killed.
+        """
+        self.conn.close()
+        try:
+            self.process.wait(STARTUP_TIMEOUT)
+        except subp.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Response:
+    """
+    Response returned by WSGIClient and HTTPClient.
+
+    The body is read from the application only when it is accessed.
+    Iterating the response yields the body in the chunks produced by the
+    application without buffering it, the body property buffers the whole body.
+    """
+    def __init__(self, status: str, headers: list, chunks: Types.Iterable, close: Types.Callable):
+        self.status = status
+        self.status_code = int(status.split(' ', 1)[0])
+        self.headers = wsgiref_headers.Headers(headers)
+        self._chunks = chunks
+        self._close = close
+        self._body = None
+        self._consumed = False
+
+    def __iter__(self):
+        if self._body is not None:
+            yield self._body
+            return
+        if self._consumed:
+            raise RuntimeError('The response body has already been consumed.')
+
+        self._consumed = True
+        try:
+            for chunk in self._chunks:
+                if chunk:
+                    yield chunk
+        finally:
+            self.close()
+
+    @property
+    def body(self) -> bytes:
+        if self._body is None:
+            self._body = b''.join(self)
+        return self._body
+
+    @property
+    def text(self) -> str:
+        """
+        The body decoded with the charset of the Content-Type header (UTF-8 by default).
+        """
+        charset = 'utf-8'
+        for param in self.headers.get('Content-Type', '').split(';')[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.lower() == 'charset':
+                charset = value.strip('"')
+        return self.body.decode(charset)
+
+    def json(self) -> Types.Any:
+        return _json.loads(self.body)
+
+    def close(self):
+        """
+        Close the response iterable returned by the application.
+        Called automatically when the body has been read.
+        """
+        if self._close is not None:
+            close, self._close = self._close, None
+            close()
+
+    def __repr__(self):
+        return f'<Response [{self.status}]>'
+
+
+def _encode_body(body: Types.Union[bytes, str], json: Types.Any, form: Types.Any, headers: dict) -> bytes:
+    """
+    Encode the request body given as bytes, JSON or form data
+    and set the Content-Type header for JSON and form data.
+    """
+    if json is not None:
+        headers.setdefault('Content-Type', 'application/json')
+        return _json.dumps(json).encode()
+    if form is not None:
+        headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        return urllib_parse.urlencode(form, doseq=True).encode()
+    if isinstance(body, str):
+        return body.encode()
+    return body
+
+
+class WSGIClient:
+    """
+    A client that calls the WSGI application directly in the test process,
+    without sockets or a server process.
+
+    The requests are converted into PEP 3333 environ dicts. Cookies set by the
+    application are stored and sent with the later requests whose path matches.
+
+    client = WSGIClient(app)
+    response = client.post('/login', form={'username': 'foo', 'password': 'bar'})
+    response = client.get('/api/user', query={'id': 1})
+    assert response.status_code == 200
+    assert response.json()['username'] == 'foo'
+    """
+    def __init__(self, wsgi_app: object, *, host: str = 'localhost', port: int = 80, environ: dict = None):
+        self.app = wsgi_app
+        self.host = host
+        self.port = port
+        self.environ = environ if environ is not None else dict()
+        self.cookies = http_cookies.SimpleCookie()
+        self.errors = io.StringIO()
+
+    def get(self, path: str, **kwargs) -> Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> Response:
+        return self.request('POST', path, **kwargs)
+
+    def create_environ(self, method: str, path: str, query: Types.Any, headers: dict, body: bytes) -> dict:
+        url = urllib_parse.urlsplit(path)
+        query_string = url.query
+        if query:
+            extra = urllib_parse.urlencode(query, doseq=True)
+            query_string = f'{query_string}&{extra}' if query_string else extra
+
+        environ = {
+            'REQUEST_METHOD': method.upper(),
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib_parse.unquote(url.path or '/', 'iso-8859-1'),
+            'QUERY_STRING': query_string,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '127.0.0.1',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': self.errors,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            }
+        environ['HTTP_HOST'] = self.host if self.port == 80 else f'{self.host}:{self.port}'
+
+        cookies = [ f'{name}={morsel.coded_value}' for name, morsel in self.cookies.items()
+            if environ['PATH_INFO'].startswith(morsel['path'] or '/') ]
+        if cookies:
+            environ['HTTP_COOKIE'] = '; '.join(cookies)
+
+        for name, value in headers.items():
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            environ[key] = str(value)
+
+        environ.update(self.environ)
+        return environ
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        *,
+        query: Types.Any = None,
+        headers: dict = None,
+        body: bytes = b'',
+        json: Types.Any = None,
+        form: Types.Any = None,
+        stream: bool = False
+        ) -> Response:
+        """
+        Call the application with the request and return the response.
+
+        The body can be given as bytes, or as an object encoded to JSON (json)
+        or URL encoded form data (form). If stream is True, the body of the
+        response is read from the application only when the response is iterated.
+        """
+        headers = dict(headers) if headers is not None else dict()
+        body = _encode_body(body, json, form, headers)
+        environ = self.create_environ(method, path, query, headers, body)
+        written = list()
+        response_info = dict()
+
+        def start_response(status: str, response_headers: list, exc_info: tuple = None):
+            if exc_info is not None and written:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response_info['status'] = status
+            response_info['headers'] = response_headers
+            return written.append
+
+        result = self.app(environ, start_response)
+        chunks = iter(result)
+        close = getattr(result, 'close', None)
+
+        #the application may call start_response when the first chunk is requested
+        while 'status' not in response_info:
+            try:
+                written.append(next(chunks))
+            except StopIteration:
+                break
+            except BaseException:
+                if close is not None:
+                    close()
+                raise
+
+        if 'status' not in response_info:
+            if close is not None:
+                close()
+            raise RuntimeError('The application did not call start_response.')
+
+        for header, value in response_info['headers']:
+            if header.lower() == 'set-cookie':
+                self.store_cookie(value)
+
+        response = Response(
+            response_info['status'],
+            response_info['headers'],
+            itertools.chain(written, chunks),
+            close
+            )
+        if not stream:
+            response.body
+        return response
+
+    def store_cookie(self, header: str):
+        cookie = http_cookies.SimpleCookie()
+        cookie.load(header)
+        for name, morsel in cookie.items():
+            expires = morsel['expires']
+            #a Max-Age which is not an integer is ignored (RFC 6265, 5.2.2)
+            max_age = str(morsel['max-age'])
+            expired = re.fullmatch(r'-?[0-9]+', max_age) is not None and int(max_age) <= 0
+            if expires:
+                try:
+                    expired = expired or email_utils.parsedate_to_datetime(expires).timestamp() <= time.time()
+                except (TypeError, ValueError):
+                    pass
+
+            if expired:
+                self.cookies.pop(name, None)
+            else:
+                self.cookies[name] = morsel
+
+
+class HTTPClient:
+    """
+    A HTTP/1.1 client for a server started by start_wsgi_server.
+
+    The connections are kept alive and reused across requests and threads.
+    At most pool_size connections are open at a time, requests wait for a free
+    connection when all of them are in use. Use batch to send requests concurrently.
+
+    with HTTPClient(server) as client:
+        response = client.get('/')
+        responses = client.batch([ ('GET', f'/items/{i}') for i in range(100) ])
+    """
+    def __init__(self, server: Types.Union[Process, tuple], *, pool_size: int = 10, timeout: float = 10.0):
+        if pool_size < 1:
+            raise ValueError('The pool size must be at least 1.')
+
+        self.address = server.address if isinstance(server, Process) else tuple(server)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.idle = list()
+        self.open_connections = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def acquire(self) -> Types.Tuple[object, bool]:
+        """
+        Return an idle connection, or a new one if the pool is not full.
+        The second item is True if the connection has been used before.
+        """
+        with self.condition:
+            while not self.idle and self.open_connections >= self.pool_size:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop(), True
+            self.open_connections += 1
+
+        host, port = self.address
+        return http_client.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def release(self, connection: object, *, reusable: bool):
+        with self.condition:
+            if reusable:
+                self.idle.append(connection)
+            else:
+                connection.close()
+                self.open_connections -= 1
+            self.condition.notify()
+
+    def get(self, path: str, **kwargs) -> Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> Response:
+        return self.request('POST', path, **kwargs)
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        *,
+        query: Types.Any = None,
+        headers: dict = None,
+        body: bytes = b'',
+        json: Types.Any = None,
+        form: Types.Any = None
+        ) -> Response:
+        """
+        Send the request and return the response with the body read.
+        The body can be given as bytes, or as an object encoded to JSON (json)
+        or URL encoded form data (form).
+        """
+        headers = dict(headers) if headers is not None else dict()
+        body = _encode_body(body, json, form, headers)
+        if query:
+            separator = '&' if '?' in path else '?'
+            path = path + separator + urllib_parse.urlencode(query, doseq=True)
+
+        while True:
+            connection, reused = self.acquire()
+            sent = False
+            try:
+                connection.request(method, path, body=body or None, headers=headers)
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+
+            except ConnectionError:
+                self.release(connection, reusable=False)
+                #the server may have closed an idle connection, retry with a new one,
+                #unless the server may have already processed a non-idempotent request
+                if reused and (not sent or method.upper() in IDEMPOTENT_METHODS):
+                    continue
+                raise
+
+            except BaseException:
+                self.release(connection, reusable=False)
+                raise
+
+            self.release(connection, reusable=not response.will_close)
+            status = f'{response.status} {response.reason}'
+            return Response(status, response.getheaders(), [data], None)
+
+    def batch(self, requests: Types.Iterable) -> Types.List[Response]:
+        """
+        Send the requests concurrently using all connections of the pool and
+        return the responses in the same order. The requests are tuples of
+        (method, path) or (method, path, kwargs), where kwargs are passed to request.
+        """
+        def send(request: tuple) -> Response:
+            method, path, *kwargs = request
+            return self.request(method, path, **(kwargs[0] if kwargs else dict()))
+
+        with futures.ThreadPoolExecutor(self.pool_size) as executor:
+            return list(executor.map(send, requests))
+
+    def close(self):
+        """
+        Close the idle connections.
+        """
+        with self.condition:
+            for connection in self.idle:
+                connection.close()
+            self.open_connections -= len(self.idle)
+            self.idle.clear()
+
+
+def _get_memory_root() -> Types.Any:
+    """
+    Return the tmpfs directory for in-memory temporary directories,
+    or None if it is not available.
+    """
+    global _memory_root
+    if _memory_root is False:
+        path = MEMORY_ROOT
+        _memory_root = path if os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK) else None
+    return _memory_root
+
+
+def _get_entry_kind(info: os.stat_result) -> str:
+    if stat.S_ISDIR(info.st_mode):
+        return 'dir'
+    if stat.S_ISLNK(info.st_mode):
+        return 'link'
+    return 'file'
+
+
+def _reflink(src_fd: int, dst_fd: int) -> bool:
+    """
+    Make the target file a copy-on-write clone of the source file.
+    Return False if the filesystem doesn't support it.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError:
+        return False
+    return True
+
+
+def _copy_contents(src_fd: int, dst_fd: int, size: int):
+    """
+    Copy the contents of the file in the kernel where possible.
+    """
+    offset = 0
+    if hasattr(os, 'sendfile'):
+        try:
+            while offset < size:
+                sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        except OSError:
+            pass
+
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while True:
+        data = os.read(src_fd, OUTPUT_CHUNK_SIZE)
+        if not data:
+            break
+        os.write(dst_fd, data)
 
 
 def create_temp_dir(*, files=list(), dirs=list()) -> TemporaryDirectory:
@@ -195,6 +1329,16 @@ def create_temp_dir(*, files=list(), dirs=list()) -> TemporaryDirectory:
     return dir_
 
 
+def create_template_dir(*, files=list(), dirs=list(), in_memory: bool = True) -> TemplateDirectory:
+    """
+    Create a TemplateDirectory instance and populate it with
+    the provided files and directories.
+    """
+    template = TemplateDirectory(in_memory=in_memory)
+    template.populate(files, dirs)
+    return template
+
+
 def set_as_unauthorized(path: str) -> Types.Union[UnauthorizedFile, UnauthorizedDirectory]:
     """
     Return a context manager for temporarily restricting access to the path.
@@ -212,61 +1356,131 @@ def set_as_unauthorized(path: str) -> Types.Union[UnauthorizedFile, Unauthorized
     return UnauthorizedDirectory(path)
 
 
-def _wait_for_server_init(host: tuple):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as soc:
-        while True:
-            try:
-                soc.connect(host)
-            
-            except OSError:
-                time.sleep(0.1)
-                continue
-            
-            else:
-                soc.close()
-                break
+def _run_with_output(target: Types.Function, args: tuple, kwargs: dict, output_conn: object):
+    redirect_output(output_conn)
+    target(*args, **kwargs)
+
+
+def _terminate_children(*exc_info):
+    for child in list(_children):
+        if child.is_alive():
+            child.terminate()
+            child.join(1.0)
+        if child.is_alive():
+            child.kill()
+            child.join()
+    _children.clear()
 
 
-def start_smtp_server(*, port: int, wait = True, host: str = '127.0.0.1') -> Process:
+def _add_child(proc: object):
     """
-    Start a debug SMTP server on host:port.
-    If wait is True, this call blocks until a connection can be established with the server.
+    Terminate the process when microtest stops executing tests, or when the
+    current process exits. The children are not daemonic, so they can start
+    processes of their own, and multiprocessing would wait for them to exit.
+    """
+    global _children_pid
+    if _children_pid != os.getpid():
+        #forked processes don't inherit the children or the exit handlers
+        _children.clear()
+        _children_pid = os.getpid()
+        #runs before multiprocessing joins the children, in the main process and in its children
+        mp_util.Finalize(None, _terminate_children, exitpriority=10)
+        core = sys.modules.get('microtest.core')
+        if core is not None and core.running:
+            core.on_exit(_terminate_children)
+
+    _children.difference_update([ child for child in _children if not child.is_alive() ])
+    _children.add(proc)
 
-    Uses the builtin smtd.DebuggingServer.
+
+def start_function(func: Types.Function, *args, **kwargs) -> Process:
     """
-    if not sys.executable:
-        raise RuntimeError('Can\'t find the Python executable (sys.exectuable is None or "")')
-    
-    host_str = ':'.join([host, str(port)])
-    cmd = [sys.executable, '-u', '-m', 'smtpd', '-c', 'DebuggingServer', '-n', host_str]
-    
-    stream = tempfile.TemporaryFile(mode='w+')
-    proc = subp.Popen(cmd, stdout=stream, stderr=stream)
+    Call func(*args, **kwargs) in a multiprocessing child process.
+    The output of the process is available through the returned Process.
+    The process is terminated when microtest stops executing tests, if it is still running.
+    """
+    reader, writer = mp.Pipe(duplex=False)
+    proc = mp.Process(target=_run_with_output, args=(func, args, kwargs, writer))
+    proc.start()
+    _add_child(proc)
+    #the child holds the only reference to the writing end, the reader gets EOF when it exits
+    writer.close()
+    return Process(OutputReader.from_connection(reader), proc)
 
-    if wait:
-        _wait_for_server_init((host, port))
-    return Process(stream, proc)
 
+def start_command(cmd: Types.Union[str, list], **popen_kwargs) -> Process:
+    """
+    Run the command with subprocess.Popen, stderr is directed into stdout.
+    The output of the process is available through the returned Process.
+    The keyword arguments are passed to Popen.
+    """
+    popen_kwargs.setdefault('stdin', subp.DEVNULL)
+    proc = subp.Popen(cmd, stdout=subp.PIPE, stderr=subp.STDOUT, **popen_kwargs)
+    return Process(OutputReader.from_file(proc.stdout), proc)
+
+
+def _start_server_process(target: Types.Function, args: tuple, *, stats: object = None) -> Process:
+    """
+    Start target(*args, conn) in a child process.
+    The target must send the address of the server into conn when it is ready.
+    """
+    reader, writer = mp.Pipe(duplex=False)
+    proc = start_function(target, *args, writer)
+    #recv raises EOFError if the child exits before sending the address
+    writer.close()
+    proc.startup_conn = reader
+    proc.stats = stats
+    return proc
+
+
+def start_smtp_server(*, port: int = 0, wait = True, host: str = '127.0.0.1', timeout: float = None) -> 'microtest.servers.SMTPServer':
+    """
+    Start a SMTP server on host:port that captures the received messages.
+    By default the port is chosen by the operating system,
+    the bound address is available as server.address.
+
+    The server runs on an asyncio event loop in a background thread.
+    If wait is True, this call blocks until the server is ready to accept connections.
+    RuntimeError is raised if it doesn't start in timeout seconds (STARTUP_TIMEOUT by default).
+    Otherwise the address is available after a call to server.wait_for_startup.
 
-def start_wsgi_server(wsgi_app: object, *, port: int, host: str = '127.0.0.1', wait = True) -> Process:
+    See microtest.servers.SMTPServer for accessing the messages.
+    """
+    server = servers.SMTPServer(host, port)
+    server.start(timeout if timeout is not None else STARTUP_TIMEOUT, wait=wait)
+    return server
+
+
+def start_wsgi_server(
+    wsgi_app: object,
+    *,
+    port: int = 0,
+    host: str = '127.0.0.1',
+    wait = True,
+    timeout: float = None,
+    threads: int = None
+    ) -> Process:
     """
     Start a debug web server that serves the WSGI application wsgi_app.
     The provided wsgi_app object must be a valid WSGI application specified by PEP 3333.
-    If wait is True, this call blocks until a connection can be established with the server.
+    By default the port is chosen by the operating system,
+    the bound address is available as Process.address.
 
-    Uses the builtin wsgiref.simple_server.
-    """
-    def run_server(host, port, wsgi_app, stream):
-        sys.stdout = sys.stderr = stream
-        with wsgiref.simple_server.make_server(host, port, wsgi_app) as server:
-            server.serve_forever()
+    If threads is None, the requests are handled one at a time. Otherwise the
+    requests are handled by a pool of threads of the given size and HTTP/1.1
+    connections are kept alive. The request counters are available as Process.stats.
 
+    If wait is True, this call blocks until the server is ready to accept connections.
+    RuntimeError with the output of the server is raised if it doesn't start
+    in timeout seconds (STARTUP_TIMEOUT by default).
 
-    stream = tempfile.TemporaryFile(mode='w+')
-    proc = mp.Process(target=run_server, args=(host, port, wsgi_app, stream))
-    proc.start()
+    Uses the builtin wsgiref.simple_server.
+    """
+    if threads is not None and threads < 1:
+        raise ValueError('The number of threads must be at least 1.')
 
+    stats = servers.ServerStats()
+    proc = _start_server_process(servers.run_wsgi_server, (host, port, wsgi_app, threads, stats), stats=stats)
     if wait:
-        _wait_for_server_init((host, port))
-    return Process(stream, proc)
-
+        proc.wait_for_startup(timeout)
+    return proc
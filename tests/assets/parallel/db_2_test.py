@@ -0,0 +1,7 @@
+import microtest
+
+
+@microtest.group('database')
+@microtest.test
+def test_database():
+    hold_token('db')
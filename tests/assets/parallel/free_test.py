@@ -0,0 +1,6 @@
+import microtest
+
+
+@microtest.test
+def test_unconstrained():
+    assert True
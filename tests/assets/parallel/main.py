@@ -0,0 +1,24 @@
+import os
+import time
+import tempfile
+import microtest
+
+
+@microtest.utility
+def hold_token(name: str):
+    """
+    Create a marker file for the duration of a test.
+    Fails if another process holds the same marker.
+    """
+    path = os.path.join(tempfile.gettempdir(), f'microtest-{os.getppid()}-{name}')
+    fd = os.open(path, os.O_CREAT | os.O_EXCL)
+    try:
+        time.sleep(0.2)
+    finally:
+        os.close(fd)
+        os.remove(path)
+
+
+microtest.set_workers(5)
+microtest.requires('db', group='database')
+print('config executed')
@@ -0,0 +1,17 @@
+import microtest
+
+
+microtest.requires('port:8025')
+
+
+@microtest.resource
+def port_server():
+    #constructed while the lock is held
+    hold_token('port')
+    return 8025
+
+
+@microtest.test
+def test_port(port_server):
+    assert port_server == 8025
+    hold_token('port')
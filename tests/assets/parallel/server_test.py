@@ -0,0 +1,21 @@
+import urllib.request
+import microtest
+
+from microtest.utils import start_wsgi_server
+
+
+def hello_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'Hello']
+
+
+@microtest.test
+def test_server_in_worker():
+    #the worker process must be able to start processes of its own
+    server = start_wsgi_server(hello_app)
+    try:
+        host, port = server.address
+        with urllib.request.urlopen(f'http://{host}:{port}/', timeout=5) as response:
+            assert response.read() == b'Hello'
+    finally:
+        server.terminate()
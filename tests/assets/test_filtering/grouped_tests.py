@@ -0,0 +1,10 @@
+import microtest
+
+
+print('grouped module executed')
+
+
+@microtest.group('slow')
+@microtest.test
+def grouped_case():
+    pass
@@ -3,10 +3,11 @@ import subprocess
 import microtest
 import os
 import tempfile
+import json
 
 
-def run_microtest_as_module(directory: str) -> str:
-    cmd = [sys.executable, '-m', 'microtest', directory]
+def run_microtest_as_module(directory: str, *options) -> str:
+    cmd = [sys.executable, '-m', 'microtest', *options, directory]
     stream = tempfile.TemporaryFile(mode='w+')
     
     proc = subprocess.Popen(cmd, stdout = stream, cwd = directory)
@@ -51,6 +52,7 @@ def test_exclude_groups():
     assert 'config executed' in output
     assert 'slow_test' not in output
     assert 'normal_test' in output
+    assert 'grouped module executed' not in output
 
 
 @microtest.test
@@ -60,3 +62,15 @@ def test_only_groups():
     assert 'config executed' in output
     assert 'slow_test' in output
     assert 'normal_test' not in output
+    assert 'grouped module executed' in output
+    assert 'grouped_case' in output
+
+
+@microtest.test
+def test_collect_only():
+    os.environ['MICROTEST_ENTRYPOINT'] = 'only_slow.py'
+    output = run_microtest_as_module(join_asset_path('test_filtering'), '--collect-only', '--json')
+    data = json.loads(output)
+    names = { test['name'] for module in data['modules'] for test in module['tests'] }
+    assert names == {'slow_test_1', 'slow_test_2', 'super_slow_test', 'grouped_case'}
+    assert data['tests'] == 4
@@ -0,0 +1,39 @@
+import sys
+import subprocess
+import microtest
+import os
+import tempfile
+
+
+def run_microtest_as_module(directory: str) -> str:
+    cmd = [sys.executable, '-m', 'microtest', directory]
+    stream = tempfile.TemporaryFile(mode='w+')
+    
+    proc = subprocess.Popen(cmd, stdout = stream, cwd = directory)
+    proc.wait()
+    
+    stream.seek(0)
+    data =  stream.read()
+    stream.close()
+    return data
+
+
+def join_asset_path(*args):
+    path = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.dirname(path)
+    path = os.path.dirname(path)
+    path = os.path.join(path, 'assets')
+    for name in args:
+        path = os.path.join(path, name)
+    return path
+
+
+@microtest.test
+def test_parallel_execution_with_requirements():
+    os.environ['MICROTEST_ENTRYPOINT'] = 'main.py'
+    output = run_microtest_as_module(join_asset_path('parallel'))
+    assert 'config executed' in output
+    assert 'Ran 6 tests' in output
+    assert 'OK.' in output
+    assert output.count('test_port') == 2
+    assert output.count('test_database') == 2
@@ -0,0 +1,41 @@
+import microtest
+
+
+calls = list()
+microtest.add_resource('offset', 10)
+
+
+def generate_cases():
+    for i in range(3):
+        calls.append(f'generate {i}')
+        yield i, i * i
+
+
+@microtest.parametrize(generate_cases)
+def test_squares(value, square):
+    calls.append(f'test {value}')
+    assert value * value == square
+
+
+@microtest.parametrize(['foo', 'bar'])
+def test_single_values(value):
+    calls.append(value)
+
+
+@microtest.parametrize([1, 2], ids=lambda case: f'case_{case}')
+def test_with_resources(value, offset):
+    assert value + offset > 10
+
+
+@microtest.test
+def test_cases_are_generated_lazily():
+    assert calls == [
+        'generate 0', 'test 0',
+        'generate 1', 'test 1',
+        'generate 2', 'test 2',
+        'foo', 'bar'
+        ]
+
+
+if __name__ == '__main__':
+    microtest.run()
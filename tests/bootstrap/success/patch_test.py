@@ -1,3 +1,6 @@
+import asyncio
+import threading
+
 import microtest
 from microtest.utils import Namespace
 
@@ -15,3 +18,58 @@ def test_patching():
 
     assert namespace.variable == 1
     assert namespace.CONSTANT == 'string'
+
+
+class Service:
+    timeout = 5
+
+    def fetch(self):
+        return 'real'
+
+
+@microtest.test
+def test_exiting_patches_out_of_order():
+    first = microtest.patch(namespace, variable = 2)
+    second = microtest.patch(namespace, variable = 3)
+    first.__enter__()
+    second.__enter__()
+
+    first.__exit__(None, None, None)
+    assert namespace.variable == 3
+    second.__exit__(None, None, None)
+    assert namespace.variable == 1
+
+
+@microtest.test
+def test_local_patches_are_isolated_between_threads():
+    barrier = threading.Barrier(2)
+    results = dict()
+
+    def run(name):
+        with microtest.local_patch(Service, fetch = lambda self: name, timeout = 0):
+            barrier.wait()
+            results[name] = (Service().fetch(), Service.timeout)
+
+    threads = [ threading.Thread(target=run, args=(name,)) for name in ('a', 'b') ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {'a': ('a', 0), 'b': ('b', 0)}
+    assert Service().fetch() == 'real'
+    assert 'fetch' in vars(Service) and Service.timeout == 5
+
+
+@microtest.test
+def test_local_patches_are_isolated_between_tasks():
+    async def run(value, delay):
+        with microtest.local_patch(namespace, CONSTANT = value):
+            await asyncio.sleep(delay)
+            return str(namespace.CONSTANT)
+
+    async def main():
+        return await asyncio.gather(run('first', 0.02), run('second', 0.01))
+
+    assert asyncio.run(main()) == ['first', 'second']
+    assert namespace.CONSTANT == 'string'
@@ -0,0 +1,43 @@
+import threading
+import microtest
+
+
+#the resources are constructed in the main thread by default
+microtest.set_resource_workers(2)
+
+#the factories can only pass the barrier if they are called concurrently
+barrier = threading.Barrier(2, timeout=5)
+
+
+#declared before the resources it depends on
+@microtest.resource
+def graph_pair(graph_left, graph_right):
+    return (graph_left, graph_right)
+
+
+@microtest.resource
+def graph_left():
+    barrier.wait()
+    return threading.current_thread().name
+
+
+@microtest.resource
+def graph_right():
+    barrier.wait()
+    return threading.current_thread().name
+
+
+@microtest.test
+def test_resources_declared_out_of_order(graph_pair, graph_left, graph_right):
+    assert graph_pair == (graph_left, graph_right)
+
+
+@microtest.test
+def test_independent_resources_are_constructed_concurrently(graph_left, graph_right):
+    assert graph_left != graph_right
+    assert not barrier.broken
+
+
+@microtest.cleanup
+def restore_resource_workers():
+    microtest.set_resource_workers(1)
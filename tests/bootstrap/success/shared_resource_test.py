@@ -0,0 +1,51 @@
+import os
+import pickle
+import tempfile
+import microtest
+import microtest.core as core
+
+from microtest.objects import SharedBuffer
+
+
+@microtest.shared_resource
+def corpus():
+    for i in range(4):
+        yield bytes([i]) * 1024
+
+
+@microtest.test
+def test_shared_resource(corpus):
+    assert isinstance(corpus, memoryview)
+    assert corpus.readonly
+    assert len(corpus) == 4096
+    assert corpus[1024:1028] == bytes([1]) * 4
+
+
+@microtest.test
+def test_attaching_to_shared_resource(corpus):
+    buffer = pickle.loads(pickle.dumps(core.shared_resources['corpus']))
+    assert not buffer.owner
+    assert buffer.view == corpus
+    
+    buffer.cleanup()
+    assert os.path.exists(buffer.path)
+
+
+@microtest.test
+def test_failed_write_removes_the_file():
+    directory = SharedBuffer.SHARED_MEMORY_DIR
+    if not os.path.isdir(directory):
+        directory = tempfile.gettempdir()
+    before = set(os.listdir(directory))
+
+    def failing_data():
+        yield b'data'
+        raise ValueError('source failed')
+
+    try:
+        SharedBuffer.create(failing_data())
+    except ValueError:
+        pass
+    else:
+        assert False, 'ValueError was not raised'
+    assert set(os.listdir(directory)) - before == set()
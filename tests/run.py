@@ -11,6 +11,13 @@ BOOTSTRAP_PATH = os.path.join(ROOT_PATH, 'bootstrap')
 UNITTEST_FILES = [
     'assertion_tests.py',
     'scanner_tests.py',
+    'logging_tests.py',
+    'loader_tests.py',
+    'module_filter_tests.py',
+    'collector_tests.py',
+    'import_tests.py',
+    'utils_tests.py',
+    'resources_tests.py',
 ]
 
 
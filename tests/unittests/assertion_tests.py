@@ -116,6 +116,119 @@ class Tests(unittest.TestCase):
         except AssertionError as err:
             result = assertion.resolve_assertion_error(type(err), err, err.__traceback__)
             self.assertTrue("assert {'hello': 'world'} == {}" in result)
+
+
+
+    def test_multiline_assertion(self):
+        x = 1
+        try:
+            assert (
+                x ==
+                2
+            )
+        except AssertionError as err:
+            result = assertion.resolve_assertion_error(type(err), err, err.__traceback__)
+            self.assertTrue('assert 1 == 2' in result)
+
+
+    def test_chained_comparison(self):
+        low, x, high = 0, 5, 3
+        try:
+            assert low < x < high
+        except AssertionError as err:
+            result = assertion.resolve_assertion_error(type(err), err, err.__traceback__)
+            self.assertTrue('assert 0 < 5 < 3' in result)
+
+
+    def test_nested_boolean_operators(self):
+        a, b, c = False, 0, 1
+        try:
+            assert (a or b) and not c
+        except AssertionError as err:
+            result = assertion.resolve_assertion_error(type(err), err, err.__traceback__)
+            self.assertTrue('assert (False or 0) and not 1' in result)
+
+
+    def test_operands_are_evaluated_once(self):
+        calls = list()
+        def func(value):
+            calls.append(value)
+            return value
+
+        try:
+            assert func(1) == func(2)
+        except AssertionError as err:
+            calls.clear()
+            result = assertion.resolve_assertion_error(type(err), err, err.__traceback__)
+            self.assertTrue('assert 1 == 2' in result)
+            self.assertEqual(calls, [1, 2])
+
+
+    def test_skipped_operands_are_not_evaluated(self):
+        calls = list()
+        def side_effect():
+            calls.append(True)
+            return True
+
+        x = None
+        try:
+            assert x is not None and side_effect()
+        except AssertionError as err:
+            result = assertion.resolve_assertion_error(type(err), err, err.__traceback__)
+            self.assertTrue('assert None is not None and side_effect()' in result)
+        self.assertEqual(calls, [])
+
+        try:
+            assert x or not side_effect() or side_effect()
+        except AssertionError as err:
+            calls.clear()
+            result = assertion.resolve_assertion_error(type(err), err, err.__traceback__)
+            self.assertTrue('assert None or not True or True' in result)
+            self.assertEqual(calls, [True, True])
+
+
+    def test_skipped_operands_without_side_effects_are_shown(self):
+        x, items = None, [1, 2]
+        try:
+            assert x and len(items) > 5
+        except AssertionError as err:
+            result = assertion.resolve_assertion_error(type(err), err, err.__traceback__)
+            self.assertTrue('assert None and 2 > 5' in result)
+
+        calls = list()
+        def len(value):
+            calls.append(value)
+            return 0
+
+        try:
+            assert x and len(items) > 5
+        except AssertionError as err:
+            result = assertion.resolve_assertion_error(type(err), err, err.__traceback__)
+            self.assertTrue('assert None and len(items) > 5' in result)
+        self.assertEqual(calls, [])
+
+
+    def test_analysis_is_cached(self):
+        results = list()
+        for i in range(2):
+            try:
+                assert i < 0
+            except AssertionError as err:
+                results.append(assertion.resolve_assertion_error(type(err), err, err.__traceback__))
+                tb = err.__traceback__
+        
+        self.assertTrue('assert 0 < 0' in results[0])
+        self.assertTrue('assert 1 < 0' in results[1])
+        self.assertTrue((tb.tb_frame.f_code.co_filename, tb.tb_lineno) in assertion.analyses)
+
+
+    def test_raised_assertion_error(self):
+        try:
+            raise AssertionError('info')
+        except AssertionError as err:
+            result = assertion.resolve_assertion_error(type(err), err, err.__traceback__)
+            self.assertTrue(result.strip().endswith('info'))
+            self.assertTrue('assert' not in result)
         
 
 if __name__ == '__main__':
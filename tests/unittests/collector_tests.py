@@ -0,0 +1,127 @@
+import unittest
+import tempfile
+import json
+import io
+import os
+
+import microtest.collector as collector
+
+
+MODULE_SOURCE = '''
+import microtest
+import microtest as mt
+from microtest import group as g, setup
+
+
+@setup
+def setup_module():
+    pass
+
+
+@microtest.group('slow')
+@microtest.test
+def test_slow():
+    pass
+
+
+@g('fast')
+@mt.parametrize([1, 2])
+def test_fast(x):
+    pass
+
+
+if True:
+    @microtest.test
+    def test_normal():
+        pass
+
+
+def helper():
+    pass
+'''
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+
+    def create_module(self, source: str) -> str:
+        path = os.path.join(self.dir.name, 'module_test.py')
+        with open(path, 'w') as file:
+            file.write(source)
+        return path
+
+
+    def test_collecting_tests(self):
+        module = collector.collect_module(self.create_module(MODULE_SOURCE))
+        tests = [ (test.name, test.group, test.parametrized) for test in module.tests ]
+        self.assertEqual(tests, [
+            ('test_slow', 'slow', False),
+            ('test_fast', 'fast', True),
+            ('test_normal', None, False),
+            ])
+        self.assertEqual(module.fixtures, ['setup'])
+        self.assertTrue(module.complete)
+        self.assertFalse(module.side_effects)
+
+
+    def test_dynamic_registration(self):
+        source = MODULE_SOURCE + '\nfor name in names:\n    microtest.test(create_test(name))\n'
+        module = collector.collect_module(self.create_module(source))
+        self.assertFalse(module.complete)
+        self.assertFalse(collector.can_skip(module, set(), {'slow', 'fast', None}))
+
+        source = MODULE_SOURCE + '\n@microtest.group(GROUP)\n@microtest.test\ndef test_other():\n    pass\n'
+        module = collector.collect_module(self.create_module(source))
+        self.assertFalse(module.complete)
+
+
+    def test_side_effects(self):
+        source = MODULE_SOURCE + '\nmicrotest.add_resource("foo", 1)\n'
+        module = collector.collect_module(self.create_module(source))
+        self.assertTrue(module.side_effects)
+        self.assertFalse(collector.can_skip(module, {'other'}, set()))
+
+
+    def test_requirements_are_side_effects(self):
+        source = MODULE_SOURCE + '\nmicrotest.requires("db")\n'
+        module = collector.collect_module(self.create_module(source))
+        self.assertTrue(module.side_effects)
+        self.assertFalse(collector.can_skip(module, {'other'}, set()))
+
+        source = MODULE_SOURCE + '\nfrom microtest import set_workers\nset_workers(2)\n'
+        module = collector.collect_module(self.create_module(source))
+        self.assertTrue(module.side_effects)
+
+
+    def test_skipping_modules(self):
+        module = collector.collect_module(self.create_module(MODULE_SOURCE))
+        self.assertTrue(collector.can_skip(module, {'other'}, set()))
+        self.assertFalse(collector.can_skip(module, {'slow'}, set()))
+        self.assertFalse(collector.can_skip(module, set(), {'slow'}))
+
+
+    def test_syntax_error(self):
+        module = collector.collect_module(self.create_module('def test(:\n'))
+        self.assertFalse(module.complete)
+        self.assertTrue(module.error.startswith('SyntaxError'))
+
+
+    def test_json_output(self):
+        module = collector.collect_module(self.create_module(MODULE_SOURCE))
+        stream = io.StringIO()
+        collector.write_collected([module], {'fast'}, set(), stream=stream, as_json=True)
+
+        data = json.loads(stream.getvalue())
+        self.assertEqual(data['tests'], 1)
+        self.assertEqual(data['modules'][0]['tests'][0]['name'], 'test_fast')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+import subprocess
+import sys
+import os
+
+
+#the cumulative import time of 'import microtest' must stay under this budget in milliseconds,
+#wall-clock times vary too much on loaded machines, so the check runs only if the budget is set (e.g. 60)
+IMPORT_BUDGET_MS = float(os.environ.get('MICROTEST_IMPORT_BUDGET_MS') or 0)
+
+#modules that are costly to import and must not be imported by 'import microtest'
+DEFERRED_MODULES = [
+    'xml.sax.saxutils',
+    'urllib.request',
+    'multiprocessing',
+    'wsgiref',
+    'subprocess',
+    'socket',
+    'ast',
+    'inspect',
+    'runpy',
+    'tempfile',
+    'traceback',
+    'json',
+    'datetime',
+    'microtest.assertion',
+    'microtest.utils',
+    ]
+
+#modules only needed by some of the tools, 'import microtest.utils' must not import them
+UTILS_DEFERRED_MODULES = [
+    'subprocess',
+    'multiprocessing',
+    'socket',
+    'concurrent.futures',
+    'json',
+    'urllib.parse',
+    'http.client',
+    'http.cookies',
+    'email.utils',
+    'wsgiref',
+    'microtest.servers',
+    'microtest.forkserver',
+    ]
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run_python(*args) -> str:
+    env = os.environ.copy()
+    env['PYTHONPATH'] = ROOT_PATH
+    #measure with the bytecode cache, like a normal run does
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    proc = subprocess.run([sys.executable, *args], env=env, cwd=ROOT_PATH, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+    return proc.stdout + proc.stderr
+
+
+def measure_import_time() -> float:
+    """
+    Return the cumulative import time of microtest in milliseconds.
+    """
+    output = run_python('-X', 'importtime', '-c', 'import microtest')
+    for line in output.splitlines():
+        _, _, cumulative, name = (part.strip() for part in line.replace(':', '|', 1).split('|'))
+        if name == 'microtest':
+            return int(cumulative) / 1000
+    raise RuntimeError('No import time reported for microtest')
+
+
+class Tests(unittest.TestCase):
+
+    def test_costly_modules_are_deferred(self):
+        code = 'import sys, microtest; print(" ".join(sys.modules))'
+        imported = set(run_python('-c', code).split())
+        self.assertEqual([ name for name in DEFERRED_MODULES if name in imported ], [])
+
+
+    def test_utils_defers_costly_modules(self):
+        code = 'import sys, microtest.utils; print(" ".join(sys.modules))'
+        imported = set(run_python('-c', code).split())
+        self.assertEqual([ name for name in UTILS_DEFERRED_MODULES if name in imported ], [])
+
+
+    def test_submodules_are_available_as_attributes(self):
+        code = 'import microtest; print(microtest.utils.__name__, microtest.assertion.__name__)'
+        self.assertEqual(run_python('-c', code).split(), ['microtest.utils', 'microtest.assertion'])
+
+
+    @unittest.skipUnless(IMPORT_BUDGET_MS, 'set MICROTEST_IMPORT_BUDGET_MS to check the import time')
+    def test_import_time(self):
+        #the first run compiles and caches the bytecode
+        times = [ measure_import_time() for _ in range(4) ][1:]
+        self.assertLess(min(times), IMPORT_BUDGET_MS, f'import microtest took {min(times):.1f} ms')
+
+
+if __name__ == '__main__':
+    unittest.main()
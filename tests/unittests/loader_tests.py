@@ -0,0 +1,125 @@
+import unittest
+import tempfile
+import sys
+import os
+
+import microtest.assertion as assertion
+import microtest.core.loader as loader
+
+
+MODULE_SOURCE = '''"""
+Module docstring.
+"""
+from __future__ import annotations
+
+calls = list()
+
+def func(value):
+    calls.append(value)
+    return value
+
+def test():
+    x = 1
+    assert (
+        func(x) ==
+        func(2)
+    ), 'info'
+
+def test_short_circuit():
+    assert func(0) and func(1)
+
+def test_passing():
+    assert func(1) < func(2)
+'''
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'rewritten_test.py')
+        with open(self.path, 'w') as file:
+            file.write(MODULE_SOURCE)
+
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+
+    def run_failing(self, name: str):
+        namespace = loader.run_path(self.path, run_name='rewritten', rewrite_assertions=True)
+        namespace['calls'].clear()
+        try:
+            namespace[name]()
+        except AssertionError as err:
+            result = assertion.resolve_assertion_error(type(err), err, err.__traceback__)
+            return result, err, list(namespace['calls'])
+        self.fail('AssertionError was not raised')
+
+
+    def test_values_are_recorded_during_evaluation(self):
+        result, err, calls = self.run_failing('test')
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(err.args, ('info',))
+        self.assertEqual(err.operand_values, {0: 1, 1: 2})
+        self.assertTrue("assert 1 == 2, 'info'" in result)
+
+
+    def test_short_circuited_operands_are_not_evaluated(self):
+        result, err, calls = self.run_failing('test_short_circuit')
+        self.assertEqual(calls, [0])
+        self.assertTrue('assert 0 and func(1)' in result)
+
+
+    def test_passing_assertion(self):
+        namespace = loader.run_path(self.path, run_name='rewritten', rewrite_assertions=True)
+        namespace['test_passing']()
+        self.assertEqual(namespace['calls'], [1, 2])
+
+
+    def test_rewritten_code_is_cached(self):
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = False
+        try:
+            loader.run_path(self.path, run_name='rewritten', rewrite_assertions=True)
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+        
+        cache_path = loader.get_cache_path(self.path, rewrite_assertions=True)
+        self.assertTrue(os.path.exists(cache_path))
+
+        with open(self.path, 'rb') as file:
+            header = loader.create_cache_header(file.read())
+        self.assertIsNotNone(loader.read_cache(cache_path, header))
+
+        with open(self.path, 'a') as file:
+            file.write('\nassert True\n')
+        with open(self.path, 'rb') as file:
+            header = loader.create_cache_header(file.read())
+        self.assertIsNone(loader.read_cache(cache_path, header))
+
+
+
+    def test_compiled_code_is_cached(self):
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = False
+        try:
+            namespace = loader.run_path(self.path, init_globals={'spam': 1}, run_name='plain')
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+
+        self.assertEqual(namespace['__name__'], 'plain')
+        self.assertEqual(namespace['spam'], 1)
+        
+        cache_path = loader.get_cache_path(self.path)
+        header = loader.create_timestamp_header(os.stat(self.path))
+        code = loader.read_cache(cache_path, header)
+        self.assertEqual(code.co_filename, self.path)
+
+        os.utime(self.path, (0, 0))
+        header = loader.create_timestamp_header(os.stat(self.path))
+        self.assertIsNone(loader.read_cache(cache_path, header))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import unittest
+import unittest.mock
+import sys
+import io
+import json
+import xml.dom.minidom
+
+import microtest.core as core
+from microtest.logging import JSONLinesLogger, JUnitXMLLogger, AsyncLogger, DefaultLogger, Colors
+from microtest.objects import Result, Output
+
+
+def raise_and_catch(exc: Exception) -> Exception:
+    try:
+        raise exc
+    except Exception as err:
+        return err
+
+
+def log_run(logger):
+    x = 1
+    try:
+        assert x == 2
+    except AssertionError as err:
+        failure = err
+
+    logger.log_start_info()
+    logger.log_module_info('/tests/module_tests.py')
+    logger.log_test_info('test_ok', Result.OK, None)
+    logger.log_test_info('test_failed', Result.FAILED, failure)
+    logger.log_test_info('test_error', Result.ERROR, raise_and_catch(ValueError('<invalid>')))
+    logger.log_module_info('/tests/other_tests.py')
+    
+    exc = raise_and_catch(RuntimeError('\x00module error'))
+    logger.log_module_exec_error('/tests/other_tests.py', type(exc), exc, exc.__traceback__)
+    logger.log_results(3, 1, 2, 0.5)
+
+
+class Tests(unittest.TestCase):
+
+    def test_json_lines_logger(self):
+        out = io.StringIO()
+        logger = JSONLinesLogger(out)
+        log_run(logger)
+        logger.terminate()
+
+        events = [ json.loads(line) for line in out.getvalue().splitlines() ]
+        self.assertEqual([ event['event'] for event in events ], [
+            'start', 'module', 'test', 'test', 'test', 'module', 'module_error', 'results'
+            ])
+        
+        failed = events[3]
+        self.assertEqual(failed['module'], '/tests/module_tests.py')
+        self.assertEqual(failed['result'], Result.FAILED)
+        self.assertTrue('assert 1 == 2' in failed['error']['assertion'])
+        self.assertEqual(events[4]['error']['type'], 'ValueError')
+        self.assertEqual(events[-1]['tests'], 3)
+
+
+    def test_junit_xml_logger(self):
+        out = io.StringIO()
+        logger = JUnitXMLLogger(out)
+        log_run(logger)
+        logger.terminate()
+
+        document = xml.dom.minidom.parseString(out.getvalue())
+        suites = document.getElementsByTagName('testsuite')
+        self.assertEqual(len(suites), 2)
+        self.assertEqual(len(document.getElementsByTagName('testcase')), 4)
+        
+        failure, = document.getElementsByTagName('failure')
+        self.assertTrue('assert 1 == 2' in failure.firstChild.data)
+        
+        errors = document.getElementsByTagName('error')
+        self.assertEqual(errors[0].getAttribute('message'), '<invalid>')
+        self.assertEqual(errors[1].getAttribute('message'), 'module error')
+
+
+
+    def test_async_logger(self):
+        out = io.StringIO()
+        logger = AsyncLogger(JSONLinesLogger(out))
+        logger.log_start_info()
+        logger.log_module_info('/tests/module_tests.py')
+        for i in range(1000):
+            core.test_time = i
+            logger.log_test_info(f'test_{i}', Result.OK, None)
+        
+        exc = raise_and_catch(ValueError())
+        logger.log_test_info('test_error', Result.ERROR, exc)
+        logger.log_results(1001, 0, 1, 0.5)
+        logger.terminate()
+
+        events = [ json.loads(line) for line in out.getvalue().splitlines() ]
+        self.assertEqual(len(events), 1004)
+        self.assertEqual([ event['time'] for event in events[2:-2] ], list(range(1000)))
+        self.assertEqual(events[-2]['name'], 'test_error')
+        self.assertEqual(events[-1]['event'], 'results')
+
+
+
+    def test_minimal_output(self):
+        out = io.StringIO()
+        logger = DefaultLogger(Output.MINIMAL, out)
+        log_run(logger)
+        lines = out.getvalue().splitlines()
+
+        self.assertEqual(lines[lines.index('/tests/module_tests.py') + 1], '.FE')
+        self.assertTrue('test_ok' not in out.getvalue())
+        
+        failures = [ line for line in lines if line.startswith(('FAILED:', 'ERROR:')) and line.endswith(')') ]
+        self.assertEqual(failures, [
+            'FAILED: test_failed (/tests/module_tests.py)',
+            'ERROR: test_error (/tests/module_tests.py)',
+            'ERROR: <module> (/tests/other_tests.py)',
+            ])
+
+
+    def test_colors_without_colorama_on_windows(self):
+        stderr = io.StringIO()
+        patches = [
+            unittest.mock.patch.object(sys, 'platform', 'win32'),
+            unittest.mock.patch.object(sys, 'stderr', stderr),
+            unittest.mock.patch.dict(sys.modules, {'colorama': None}),
+            unittest.mock.patch.object(Colors, 'supported', None),
+            unittest.mock.patch('builtins.input', side_effect=AssertionError('input() blocks the test run')),
+            ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.assertFalse(Colors.setup())
+        self.assertFalse(Colors.setup())
+        self.assertEqual(stderr.getvalue().count('[ WARNING ]'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main(argv=[''], exit=False)
@@ -0,0 +1,81 @@
+import unittest
+import os
+
+from microtest.core.utils import filter_modules
+from microtest.objects import PathMatcher
+
+
+ROOT = os.path.abspath(os.sep)
+
+modules = [
+    os.path.join(ROOT, 'tests', 'test_login.py'),
+    os.path.join(ROOT, 'tests', 'test_registering.py'),
+    os.path.join(ROOT, 'tests', 'test_form_validation.py'),
+    os.path.join(ROOT, 'tests', 'validations', 'test_emails.py'),
+    os.path.join(ROOT, 'tests', 'generated', 'gen_1_test.py'),
+    os.path.join(ROOT, 'tests', 'generated', 'deep', 'gen_2_test.py'),
+]
+
+
+class Tests(unittest.TestCase):
+
+    def test_exclude_substrings(self):
+        result = list(filter_modules(modules, set(), {'validation'}))
+        self.assertEqual(result, [modules[0], modules[1], modules[4], modules[5]])
+
+
+    def test_only_modules_output_is_unique_and_ordered(self):
+        result = list(filter_modules(modules + modules, {'validation', 'test_form', 'login'}, set()))
+        self.assertEqual(result, [modules[0], modules[2], modules[3]])
+
+
+    def test_absolute_paths(self):
+        result = list(filter_modules(modules, {modules[1]}, set()))
+        self.assertEqual(result, [modules[1]])
+
+        result = list(filter_modules(modules, set(), {os.path.join(ROOT, 'tests')}))
+        self.assertEqual(result, modules)
+
+
+    def test_glob_patterns(self):
+        result = list(filter_modules(modules, set(), {'generated' + os.sep + '*_test.py'}))
+        self.assertEqual(result, modules[:4] + [modules[5]])
+
+        result = list(filter_modules(modules, set(), {'generated' + os.sep + '**'}))
+        self.assertEqual(result, modules[:4])
+
+        result = list(filter_modules(modules, {os.path.join(ROOT, 'tests', 'test_*.py')}, set()))
+        self.assertEqual(result, modules[:3])
+
+
+    def test_large_restriction_lists(self):
+        restrictions = { f'generated{os.sep}module_{i}_test.py' for i in range(5000) }
+        restrictions.add('validations')
+        matcher = PathMatcher(restrictions)
+        self.assertTrue(matcher.matches(os.path.join(ROOT, 'tests', 'generated', 'module_4999_test.py')))
+        self.assertTrue(matcher.matches(modules[3]))
+        self.assertFalse(matcher.matches(os.path.join(ROOT, 'tests', 'generated', 'module_5000.py')))
+
+
+    def test_prefix_tree_keeps_shortest_substring(self):
+        matcher = PathMatcher({'api', 'api_v2', 'ap'})
+        self.assertTrue(matcher.matches('/tests/apx/test.py'))
+        self.assertFalse(matcher.matches('/tests/a/test.py'))
+
+
+
+    def test_long_restriction(self):
+        restriction = os.sep.join(['directory'] * 1000)
+        matcher = PathMatcher({restriction})
+        self.assertTrue(matcher.matches(os.path.join(ROOT, restriction, 'test.py')))
+        self.assertFalse(matcher.matches(os.path.join(ROOT, 'directory', 'test.py')))
+
+
+    def test_empty_restriction_matches_everything(self):
+        matcher = PathMatcher({''})
+        self.assertTrue(all(matcher.matches(path) for path in modules))
+        self.assertEqual(list(filter_modules(modules, set(), {''})), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+import threading
+
+import microtest.core as core
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.resources = dict(core.resources)
+        self.workers = core.resource_workers
+        core.resource_factories.clear()
+
+
+    def tearDown(self):
+        core.resources.clear()
+        core.resources.update(self.resources)
+        core.resource_factories.clear()
+        core.resource_workers = self.workers
+
+
+    def test_declaration_order_does_not_matter(self):
+        def squared(numbers):
+            return [ i * i for i in numbers ]
+
+        def numbers():
+            return [1, 2, 3]
+
+        core.add_resource_factory('squared', squared)
+        core.add_resource_factory('numbers', numbers)
+        self.assertEqual(core.call_with_resources(lambda squared: squared), [1, 4, 9])
+        self.assertEqual(core.resource_factories, {})
+
+
+    def test_independent_resources_are_constructed_concurrently(self):
+        core.resource_workers = 4
+        barrier = threading.Barrier(3, timeout=5)
+
+        def slow():
+            barrier.wait()
+            return threading.current_thread().name
+
+        for name in ('database', 'cache', 'corpus'):
+            core.add_resource_factory(name, slow)
+        core.add_resource_factory('app', lambda database, cache, corpus: (database, cache, corpus))
+
+        #the barrier is broken if the factories are not called at the same time
+        core.initialize_resources()
+        self.assertEqual(len(set(core.resources['app'])), 3)
+
+
+    def test_main_thread_by_default(self):
+        self.assertEqual(self.workers, 1)
+        core.add_resource_factory('a', lambda: threading.current_thread())
+        core.add_resource_factory('b', lambda: threading.current_thread())
+        core.initialize_resources()
+        self.assertIs(core.resources['a'], threading.main_thread())
+        self.assertIs(core.resources['b'], threading.main_thread())
+
+
+    def test_sequential_construction(self):
+        core.resource_workers = 1
+        core.add_resource_factory('a', lambda: threading.current_thread())
+        core.add_resource_factory('b', lambda a: a)
+        core.initialize_resources()
+        self.assertIs(core.resources['b'], threading.main_thread())
+
+
+    def test_undefined_resource(self):
+        core.add_resource_factory('a', lambda missing: missing)
+        core.add_resource_factory('b', lambda: 1)
+        with self.assertRaises(NameError):
+            core.initialize_resources()
+
+        core.initialize_resources()
+        self.assertNotIn('a', core.resources)
+        self.assertEqual(core.resources['b'], 1)
+
+
+    def test_cycles(self):
+        core.add_resource_factory('a', lambda c: c)
+        core.add_resource_factory('b', lambda a: a)
+        core.add_resource_factory('c', lambda b: b)
+        with self.assertRaises(RuntimeError) as context:
+            core.initialize_resources()
+        self.assertIn('a -> c -> b -> a', str(context.exception))
+        self.assertEqual(core.resource_factories, {})
+
+
+    def test_failing_factory(self):
+        core.resource_workers = 4
+
+        def fail():
+            raise ValueError('failed')
+
+        core.add_resource_factory('broken', fail)
+        core.add_resource_factory('dependent', lambda broken: broken)
+        core.add_resource_factory('other', lambda: 1)
+        with self.assertRaises(ValueError):
+            core.initialize_resources()
+
+        self.assertEqual(core.resources['other'], 1)
+        self.assertEqual(list(core.resource_factories), ['dependent'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,10 @@
 import unittest
+import threading
 import os
 
 import microtest.scanner as scanner
 from microtest.utils import create_temp_dir
+from microtest.objects import PathMatcher
 
 
 test_files = [
@@ -61,6 +63,132 @@ class Tests(unittest.TestCase):
                 self.assertTrue(path not in modules)
 
 
+    def test_ignore_patterns(self):
+        temp_dir = Tests.temp_dir
+        modules = scanner.find_tests(temp_dir.path)
+        
+        scanner.ignore_patterns.append('sub*')
+        try:
+            pruned_modules = scanner.find_tests(temp_dir.path)
+        finally:
+            scanner.ignore_patterns.remove('sub*')
+
+        subdir_path = os.path.join(temp_dir.path, 'dir', 'subdir')
+        self.assertEqual(
+            set(pruned_modules),
+            set(path for path in modules if not path.startswith(subdir_path))
+            )
+
+
+    def test_excluded_directories_are_not_scanned(self):
+        temp_dir = Tests.temp_dir
+        modules = scanner.find_tests(temp_dir.path, excluded_modules={'subdir'})
+        self.assertTrue(len(modules) > 0)
+        self.assertTrue(all('subdir' not in path for path in modules))
+
+        subdir_path = os.path.join(temp_dir.path, 'dir', 'subdir')
+        self.assertFalse(scanner.can_contain_modules(subdir_path, None, PathMatcher({'subdir'})))
+        self.assertFalse(scanner.can_contain_modules(subdir_path, PathMatcher({os.path.join(temp_dir.path, 'test_module.py')}), None))
+        self.assertTrue(scanner.can_contain_modules(subdir_path, PathMatcher({'test_module.py'}), None))
+
+
+    def test_gitignore(self):
+        with create_temp_dir(dirs=['build', 'src', 'src/generated']) as path:
+            for dir_ in ['', 'build', 'src', 'src/generated']:
+                for name in ['test_a.py', 'test_b.py']:
+                    open(os.path.join(path, dir_, name), 'x').close()
+
+            with open(os.path.join(path, '.gitignore'), 'w') as file:
+                file.write('# comment\nbuild/\ntest_*.py\n!test_a.py\n')
+            with open(os.path.join(path, 'src', '.gitignore'), 'w') as file:
+                file.write('/generated\n')
+            
+            #disabled by default
+            modules = scanner.find_tests(path)
+            self.assertEqual(len(modules), 8)
+
+            scanner.use_gitignore = True
+            try:
+                modules = scanner.find_tests(path)
+            finally:
+                scanner.use_gitignore = False
+            self.assertEqual(
+                set(modules),
+                { os.path.join(path, 'test_a.py'), os.path.join(path, 'src', 'test_a.py') }
+                )
+
+
+    def test_breadth_first_order(self):
+        temp_dir = Tests.temp_dir
+        modules = scanner.find_tests(temp_dir.path)
+        depths = [ path.count(os.sep) for path in modules ]
+        self.assertEqual(depths, sorted(depths))
+
+
+    def test_discovery_index(self):
+        with create_temp_dir(dirs=['dir']) as path:
+            dir_path = os.path.join(path, 'dir')
+            open(os.path.join(dir_path, 'test_a.py'), 'x').close()
+            for directory in [path, dir_path]:
+                os.utime(directory, ns=(10 ** 9, 10 ** 9))
+
+            modules = scanner.find_tests(path)
+            self.assertEqual(modules, (os.path.join(dir_path, 'test_a.py'), ))
+            self.assertTrue(os.path.exists(scanner.get_index_path(path)))
+            os.utime(path, ns=(10 ** 9, 10 ** 9))
+
+            #the cached listing is used while the mtime of the directory is unchanged
+            open(os.path.join(dir_path, 'test_b.py'), 'x').close()
+            os.utime(dir_path, ns=(10 ** 9, 10 ** 9))
+            self.assertEqual(len(scanner.find_tests(path)), 1)
+
+            os.utime(dir_path, ns=(2 * 10 ** 9, 2 * 10 ** 9))
+            self.assertEqual(len(scanner.find_tests(path)), 2)
+
+            #changing the regex invalidates the index
+            regex = scanner.test_module_regex
+            scanner.test_module_regex = r'test_a\.py'
+            try:
+                self.assertEqual(scanner.load_index(path), dict())
+                self.assertEqual(len(scanner.find_tests(path)), 1)
+            finally:
+                scanner.test_module_regex = regex
+
+
+    def test_discover_tests(self):
+        temp_dir = Tests.temp_dir
+        modules = scanner.find_tests(temp_dir.path)
+        self.assertEqual(tuple(scanner.discover_tests(temp_dir.path)), modules)
+
+        regex = scanner.test_module_regex
+        scanner.test_module_regex = '('
+        try:
+            with self.assertRaises(ValueError):
+                tuple(scanner.discover_tests(temp_dir.path))
+        finally:
+            scanner.test_module_regex = regex
+
+
+    def test_no_threads_while_modules_are_executed(self):
+        temp_dir = create_temp_dir(dirs=['a', 'b', 'a/c', 'b/d'])
+        self.addCleanup(temp_dir.cleanup)
+        for dir_ in ('a', 'b', 'a/c', 'b/d'):
+            open(os.path.join(temp_dir.path, dir_, 'module_test.py'), 'x').close()
+
+        workers = scanner.scan_workers
+        scanner.scan_workers = 4
+        try:
+            threads = set(threading.enumerate())
+            modules = list()
+            for path in scanner.discover_tests(temp_dir.path):
+                #the modules may fork when they are executed
+                self.assertEqual(set(threading.enumerate()), threads)
+                modules.append(path)
+        finally:
+            scanner.scan_workers = workers
+        self.assertEqual(len(modules), 4)
+
+
     @classmethod
     def tearDownClass(cls):
         cls.temp_dir.cleanup()
@@ -0,0 +1,507 @@
+import unittest
+import unittest.mock
+import urllib.request
+import http.client
+import threading
+import smtplib
+import time
+import json
+import queue
+import sys
+import os
+import signal
+import subprocess
+import tempfile
+import multiprocessing
+import wsgiref.validate
+
+import microtest.utils as utils
+import microtest.servers as servers
+
+
+def hello_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'Hello']
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    if environ['PATH_INFO'] == '/slow':
+        time.sleep(0.2)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'echo:' + body]
+
+
+def streaming_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    yield b'first'
+    time.sleep(1.5)
+    yield b'second'
+
+
+def subprocess_app(environ, start_response):
+    #the application starts a multiprocessing child of its own
+    proc = multiprocessing.Process(target=time.sleep, args=(0,))
+    proc.start()
+    proc.join()
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [f'exitcode:{proc.exitcode}'.encode()]
+
+
+def session_app(environ, start_response):
+    path = environ['PATH_INFO']
+    body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+    if path == '/login':
+        start_response('302 Found', [('Content-Type', 'text/plain'), ('Set-Cookie', 'session=1234; Path=/'), ('Location', '/')])
+        return [body]
+
+    if path == '/logout':
+        start_response('200 OK', [('Content-Type', 'text/plain'), ('Set-Cookie', 'session=; Max-Age=0; Path=/')])
+        return [b'']
+
+    if path == '/stream':
+        def generate():
+            start_response('200 OK', [('Content-Type', 'text/plain; charset=latin-1')])
+            for i in range(3):
+                yield f'{i}\xe4'.encode('latin-1')
+        return generate()
+
+    info = {
+        'cookie': environ.get('HTTP_COOKIE'),
+        'query': environ['QUERY_STRING'],
+        'content_type': environ.get('CONTENT_TYPE'),
+        'body': body.decode(),
+        }
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps(info).encode()]
+
+
+def count_to(n: int):
+    for i in range(n):
+        print(f'line {i}')
+        time.sleep(0.01)
+    print('done', end='')
+
+
+CLI_MODULE = '''
+import sys
+import os
+import time
+
+
+def main():
+    print('main', sys.argv[1:])
+    return 3
+
+
+def wait():
+    time.sleep(30)
+
+
+if __name__ == '__main__':
+    data = sys.stdin.read()
+    print('args', sys.argv[1:], os.environ.get('CLI_VALUE'), len(data))
+    sys.stderr.write('error\\n')
+    sys.exit(int(sys.argv[1]))
+'''
+
+
+def never_ready(conn):
+    print('starting...')
+    time.sleep(30)
+
+
+class Tests(unittest.TestCase):
+
+    def start(self, proc: utils.Process) -> utils.Process:
+        self.addCleanup(proc.terminate)
+        return proc
+
+
+    def test_wsgi_server_port_is_assigned(self):
+        proc = self.start(utils.start_wsgi_server(hello_app))
+        host, port = proc.address
+        self.assertEqual(host, '127.0.0.1')
+        self.assertNotEqual(port, 0)
+
+        with urllib.request.urlopen(f'http://{host}:{port}/') as response:
+            self.assertEqual(response.read(), b'Hello')
+
+
+    def test_startup_error_includes_output(self):
+        proc = self.start(utils.start_wsgi_server(hello_app))
+        with self.assertRaises(RuntimeError) as context:
+            utils.start_wsgi_server(hello_app, port=proc.port)
+        self.assertIn('exited', str(context.exception))
+        self.assertIn('OSError', str(context.exception))
+
+
+    def test_startup_timeout(self):
+        proc = utils._start_server_process(never_ready, tuple())
+        t_start = time.perf_counter()
+        with self.assertRaises(RuntimeError) as context:
+            proc.wait_for_startup(0.5)
+
+        self.assertLess(time.perf_counter() - t_start, 5)
+        self.assertIn('did not start in 0.5 seconds', str(context.exception))
+        self.assertIn('starting...', str(context.exception))
+        self.assertFalse(proc.running)
+
+
+    def test_keep_alive(self):
+        proc = self.start(utils.start_wsgi_server(echo_app, threads=2))
+        connection = http.client.HTTPConnection(*proc.address)
+        self.addCleanup(connection.close)
+        for body in (b'', b'foo', b'bar'):
+            connection.request('POST', '/', body=body)
+            response = connection.getresponse()
+            self.assertEqual(response.version, 11)
+            self.assertEqual(response.read(), b'echo:' + body)
+
+        self.assertEqual(proc.stats.requests, 3)
+        self.assertEqual(proc.stats.connections, 1)
+
+
+    def test_requests_are_handled_concurrently(self):
+        proc = self.start(utils.start_wsgi_server(echo_app, threads=8))
+        def request():
+            connection = http.client.HTTPConnection(*proc.address)
+            connection.request('GET', '/slow')
+            connection.getresponse().read()
+            connection.close()
+
+        threads = [ threading.Thread(target=request) for _ in range(8) ]
+        t_start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLess(time.perf_counter() - t_start, 8 * 0.2)
+        self.assertEqual(proc.stats.requests, 8)
+        self.assertGreaterEqual(proc.stats.mean_latency, 0.2)
+        self.assertGreaterEqual(proc.stats.max_latency, proc.stats.mean_latency)
+
+        proc.stats.reset()
+        self.assertEqual(proc.stats.requests, 0)
+
+
+    def test_wsgi_client_bodies(self):
+        client = utils.WSGIClient(wsgiref.validate.validator(session_app))
+        response = client.get('/info?a=1', query={'b': [2, 3]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['query'], 'a=1&b=2&b=3')
+
+        info = client.post('/info', json={'key': 'value'}).json()
+        self.assertEqual(info['content_type'], 'application/json')
+        self.assertEqual(json.loads(info['body']), {'key': 'value'})
+
+        info = client.post('/info', form={'name': 'foo bar'}).json()
+        self.assertEqual(info['content_type'], 'application/x-www-form-urlencoded')
+        self.assertEqual(info['body'], 'name=foo+bar')
+
+
+    def test_wsgi_client_cookies(self):
+        client = utils.WSGIClient(wsgiref.validate.validator(session_app))
+        response = client.post('/login', form={'user': 'foo'})
+        self.assertEqual(response.status, '302 Found')
+        self.assertEqual(response.headers['location'], '/')
+        self.assertEqual(client.get('/info').json()['cookie'], 'session=1234')
+
+        client.get('/logout')
+        self.assertIsNone(client.get('/info').json()['cookie'])
+
+
+    def test_wsgi_client_ignores_invalid_max_age(self):
+        client = utils.WSGIClient(session_app)
+        client.store_cookie('session=1234; Max-Age=abc; Path=/')
+        self.assertEqual(client.get('/info').json()['cookie'], 'session=1234')
+
+        client.store_cookie('session=1234; Max-Age=+0; Path=/')
+        self.assertEqual(client.get('/info').json()['cookie'], 'session=1234')
+
+        client.store_cookie('session=; Max-Age=-1; Path=/')
+        self.assertIsNone(client.get('/info').json()['cookie'])
+
+
+    def test_wsgi_client_streaming(self):
+        client = utils.WSGIClient(session_app)
+        response = client.get('/stream', stream=True)
+        self.assertEqual(response.status_code, 200)
+
+        chunks = iter(response)
+        self.assertEqual(next(chunks), '0\xe4'.encode('latin-1'))
+        self.assertEqual(list(chunks), ['1\xe4'.encode('latin-1'), '2\xe4'.encode('latin-1')])
+        with self.assertRaises(RuntimeError):
+            response.body
+
+        self.assertEqual(client.get('/stream').text, '0\xe41\xe42\xe4')
+
+
+    def test_http_client_reuses_connections(self):
+        proc = self.start(utils.start_wsgi_server(echo_app, threads=4))
+        with utils.HTTPClient(proc, pool_size=4) as client:
+            self.assertEqual(client.post('/', json=[1, 2]).body, b'echo:[1, 2]')
+
+            requests = [ ('POST', '/', {'body': str(i).encode()}) for i in range(50) ]
+            responses = client.batch(requests)
+            self.assertEqual([ response.body for response in responses ], [ f'echo:{i}'.encode() for i in range(50) ])
+            self.assertLessEqual(client.open_connections, 4)
+
+        self.assertEqual(proc.stats.requests, 51)
+        self.assertLessEqual(proc.stats.connections, 4)
+
+
+    def test_wsgi_server_can_start_processes(self):
+        proc = self.start(utils.start_wsgi_server(subprocess_app))
+        with urllib.request.urlopen(f'http://{proc.address[0]}:{proc.port}/', timeout=5) as response:
+            self.assertEqual(response.read(), b'exitcode:0')
+
+
+    def test_servers_are_terminated_on_exit(self):
+        code = (
+            'import microtest.utils as utils; '
+            'proc = utils.start_wsgi_server(lambda environ, start_response: []); '
+            'print(proc.process.pid, flush=True)'
+            )
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(utils.__file__)))
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, timeout=10, env=env)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with self.assertRaises(ProcessLookupError):
+            os.kill(int(result.stdout), 0)
+
+
+    def test_wsgi_server_streams_responses(self):
+        for threads in (None, 2):
+            proc = self.start(utils.start_wsgi_server(streaming_app, threads=threads))
+            connection = http.client.HTTPConnection(*proc.address, timeout=5)
+            self.addCleanup(connection.close)
+            started = time.perf_counter()
+            connection.request('GET', '/')
+            response = connection.getresponse()
+            self.assertEqual(response.read(5), b'first')
+            self.assertLess(time.perf_counter() - started, 1.0)
+            self.assertEqual(response.read(), b'second')
+
+
+    def test_http_client_retries_closed_connections(self):
+        #the forked server inherits the patched timeout
+        with unittest.mock.patch.object(servers.KeepAliveRequestHandler, 'timeout', 0.1):
+            proc = self.start(utils.start_wsgi_server(echo_app, threads=1))
+
+        with utils.HTTPClient(proc, pool_size=1) as client:
+            self.assertEqual(client.get('/').status_code, 200)
+            time.sleep(0.5)
+            self.assertEqual(client.get('/').status_code, 200)
+        self.assertEqual(proc.stats.connections, 2)
+
+
+    def test_http_client_retries_only_idempotent_requests(self):
+        proc = self.start(utils.start_wsgi_server(echo_app, threads=1))
+        getresponse = http.client.HTTPConnection.getresponse
+        calls = list()
+
+        #the connection is lost after the request was sent on a reused connection
+        def lose_first_response(connection):
+            calls.append(connection)
+            if len(calls) == 1:
+                raise ConnectionResetError()
+            return getresponse(connection)
+
+        with utils.HTTPClient(proc, pool_size=1) as client:
+            client.get('/')
+            with unittest.mock.patch.object(http.client.HTTPConnection, 'getresponse', lose_first_response):
+                with self.assertRaises(ConnectionResetError):
+                    client.post('/', body=b'data')
+                self.assertEqual(len(calls), 1)
+
+            calls.clear()
+            client.get('/')
+            with unittest.mock.patch.object(http.client.HTTPConnection, 'getresponse', lose_first_response):
+                self.assertEqual(client.get('/').status_code, 200)
+                self.assertEqual(len(calls), 2)
+
+
+    def test_http_client_without_keep_alive(self):
+        proc = self.start(utils.start_wsgi_server(echo_app))
+        with utils.HTTPClient(proc) as client:
+            responses = client.batch([ ('GET', '/') ] * 5)
+            self.assertEqual([ response.status_code for response in responses ], [200] * 5)
+            self.assertEqual(client.open_connections, 0)
+        self.assertEqual(proc.stats.connections, 5)
+
+
+    def test_process_with_output_stream(self):
+        stream = tempfile.TemporaryFile(mode='w+')
+        code = 'import time; print("first", flush=True); time.sleep(0.3); print("second")'
+        proc = utils.Process(stream, subprocess.Popen([sys.executable, '-c', code], stdout=stream))
+        self.assertIs(proc.stream, stream)
+        self.assertEqual(proc.wait_for('first', timeout=5).string, 'first\n')
+        self.assertTrue(proc.join(5))
+        self.assertTrue(proc.output.wait_closed(5))
+        self.assertEqual(proc.read_output(read_all=True), 'first\nsecond\n')
+
+        proc.terminate()
+        self.assertTrue(stream.closed)
+
+
+    def test_output_reader_buffers_lines(self):
+        chunks = queue.Queue()
+        for chunk in (b'ab', b'c\nd', 'e\xe4'.encode()[:-1], 'e\xe4'.encode()[-1:] + b'\nf'):
+            chunks.put(chunk)
+
+        reader = utils.OutputReader(chunks.get, max_lines=2)
+        self.assertEqual(reader.wait_for('de').string, 'de\xe4\n')
+        self.assertEqual(reader.read(), 'abc\nde\xe4\nf')
+
+        chunks.put(b'g\nh\n')
+        self.assertEqual(reader.wait_for(r'^h$').group(), 'h')
+        self.assertEqual(reader.read(), 'g\nh\n')
+        self.assertEqual(reader.read(read_all=True), 'fg\nh\n')
+
+        chunks.put(b'')
+        self.assertTrue(reader.wait_closed(5))
+        self.assertEqual(list(reader.iter_lines()), ['fg\n', 'h\n'])
+
+
+    def test_wait_for_output(self):
+        proc = self.start(utils.start_function(count_to, 20))
+        match = proc.wait_for(r'line (1\d)', timeout=5)
+        self.assertEqual(match.group(1), '10')
+        self.assertEqual(proc.wait_for('line 1', timeout=5).string, 'line 11\n')
+
+        with self.assertRaises(EOFError):
+            proc.wait_for('line 20', timeout=5)
+        self.assertTrue(proc.read_output(read_all=True).endswith('line 19\ndone'))
+
+        proc = self.start(utils.start_function(time.sleep, 10))
+        with self.assertRaises(TimeoutError):
+            proc.wait_for('never', timeout=0.1)
+
+
+    def test_command_output(self):
+        code = 'import sys; print("ready", flush=True); sys.stderr.write("error\\n")'
+        proc = self.start(utils.start_command([sys.executable, '-c', code]))
+        self.assertEqual(proc.wait_for('ready', timeout=5).string, 'ready\n')
+        self.assertEqual(sorted(proc.iter_lines(timeout=5)), ['error\n', 'ready\n'])
+
+
+    def test_smtp_server(self):
+        with utils.start_smtp_server() as server:
+            def send():
+                time.sleep(0.1)
+                with smtplib.SMTP(*server.address) as client:
+                    client.sendmail('sender@example.com', ['a@example.com', 'b@example.com'], 'Subject: Hello\n\nWorld\n.\n')
+                    client.sendmail('sender@example.com', ['a@example.com'], 'Subject: Again\n\n')
+
+            thread = threading.Thread(target=send)
+            thread.start()
+            messages = server.wait_for_messages(2, timeout=5)
+            thread.join()
+
+            self.assertEqual([ message['Subject'] for message in messages ], ['Hello', 'Again'])
+            self.assertEqual(messages[0]['X-MailFrom'], 'sender@example.com')
+            self.assertEqual(messages[0]['X-RcptTo'], 'a@example.com, b@example.com')
+            self.assertEqual(messages[0].get_content(), 'World\n.\n')
+            self.assertIn('Subject: Again', server.read_output())
+            self.assertEqual(server.read_output(), '')
+
+            with self.assertRaises(TimeoutError):
+                server.wait_for_messages(3, timeout=0.1)
+
+        self.assertFalse(server.running)
+
+
+    def test_smtp_server_without_waiting(self):
+        with utils.start_smtp_server(wait=False) as server:
+            address = server.wait_for_startup(5)
+            self.assertEqual(address, server.address)
+            with smtplib.SMTP(*address) as client:
+                client.sendmail('sender@example.com', ['a@example.com'], 'Subject: Hello\n\n')
+            message, = server.wait_for_messages(1, timeout=5)
+            self.assertEqual(message['Subject'], 'Hello')
+
+        #stopping doesn't leave the server listening if it is still starting
+        server = utils.start_smtp_server(wait=False)
+        server.terminate()
+        self.assertFalse(server.running)
+        self.assertFalse(server.server.is_serving())
+
+
+    def test_template_clone_reset(self):
+        template = utils.create_template_dir(files=['a.txt', 'c.txt'], dirs=['sub', 'sub/empty'])
+        self.addCleanup(template.cleanup)
+        template.populate(files=['sub/b.txt'])
+        with open(os.path.join(template.path, 'a.txt'), 'w') as file:
+            file.write('template')
+
+        clone = template.clone()
+        self.addCleanup(clone.cleanup)
+        with open(os.path.join(clone.path, 'a.txt')) as file:
+            self.assertEqual(file.read(), 'template')
+        self.assertTrue(os.path.isdir(os.path.join(clone.path, 'sub', 'empty')))
+        self.assertEqual(clone.reset(), 0)
+
+        with open(os.path.join(clone.path, 'a.txt'), 'w') as file:
+            file.write('changed')
+        os.remove(os.path.join(clone.path, 'sub', 'b.txt'))
+        os.rmdir(os.path.join(clone.path, 'sub', 'empty'))
+        os.chmod(os.path.join(clone.path, 'c.txt'), 0o600)
+        with open(os.path.join(clone.path, 'new.txt'), 'w') as file:
+            file.write('new')
+
+        self.assertEqual(clone.reset(), 5)
+        self.assertEqual(clone.reset(), 0)
+        self.assertEqual(sorted(os.listdir(clone.path)), ['a.txt', 'c.txt', 'sub'])
+        self.assertEqual(sorted(os.listdir(os.path.join(clone.path, 'sub'))), ['b.txt', 'empty'])
+        with open(os.path.join(clone.path, 'a.txt')) as file:
+            self.assertEqual(file.read(), 'template')
+
+
+    def test_template_clone_hardlinks(self):
+        template = utils.create_template_dir(files=['a.txt'])
+        self.addCleanup(template.cleanup)
+        clone = template.clone(hardlinks=True)
+        self.addCleanup(clone.cleanup)
+
+        source = os.stat(os.path.join(template.path, 'a.txt'))
+        target = os.stat(os.path.join(clone.path, 'a.txt'))
+        self.assertEqual(source.st_ino, target.st_ino)
+
+
+
+    def test_process_factory(self):
+        directory = utils.create_temp_dir()
+        self.addCleanup(directory.cleanup)
+        with open(os.path.join(directory.path, 'cli_app.py'), 'w') as file:
+            file.write(CLI_MODULE)
+
+        factory = utils.ProcessFactory(['json'])
+        self.addCleanup(factory.close)
+
+        proc = factory.run('cli_app', ['5'], env={'CLI_VALUE': 'foo'}, stdin='x' * 100000, cwd=directory.path, timeout=5)
+        self.assertEqual(proc.exitcode, 5)
+        self.assertEqual(proc.read_output(), "args ['5'] foo 100000\nerror\n")
+
+        proc = factory.run('cli_app:main', ['a'], cwd=directory.path, timeout=5)
+        self.assertEqual(proc.exitcode, 3)
+        self.assertEqual(proc.read_output(), "main ['a']\n")
+
+        proc = self.start(factory.start('time:sleep'))
+        self.assertEqual(proc.wait_for('TypeError', timeout=5).group(), 'TypeError')
+        self.assertTrue(proc.join(5))
+        self.assertEqual(proc.exitcode, 1)
+
+        proc = factory.start('cli_app:wait', cwd=directory.path)
+        self.assertTrue(proc.running)
+        proc.terminate()
+        self.assertEqual(proc.exitcode, -signal.SIGTERM)
+
+        factory.close()
+        self.assertFalse(factory.running)
+        with self.assertRaises(RuntimeError):
+            utils.ProcessFactory(['microtest_nonexistent_module'])
+
+
+if __name__ == '__main__':
+    unittest.main()